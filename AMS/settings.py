@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -20,13 +21,16 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'my_app.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'my_app.audit.AuditUserMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'my_app.profiling.ProfilerMiddleware',
 ]
 
 ROOT_URLCONF = 'AMS.urls'
@@ -55,6 +59,33 @@ DATABASES = {
     }
 }
 
+# Deployments with several workers need a shared cache (see `manage.py check --deploy`):
+# the data versions behind ETags and cached figures are kept in it.
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', 'ams-default'),
+    }
+}
+
+# Session storage. 'cached_db' serves reads from the cache and only falls back to
+# django_session on a miss; 'signed_cookies' keeps sessions out of the database entirely.
+# With a per-process cache a session ended in one worker would live on in the others'
+# caches, so it defaults to plain 'db' there.
+_shared_cache = not CACHES['default']['BACKEND'].endswith(('.LocMemCache', '.DummyCache'))
+SESSION_ENGINE = os.environ.get(
+    'SESSION_ENGINE',
+    'django.contrib.sessions.backends.cached_db' if _shared_cache else 'django.contrib.sessions.backends.db',
+)
+
+AUTHENTICATION_BACKENDS = [
+    'my_app.backends.CachedModelBackend',
+]
+
+# Seconds the session user (and its tenant profile) is kept in the cache; only with a
+# shared cache, where a change made in one worker is seen by all of them.
+USER_CACHE_TIMEOUT = int(os.environ.get('USER_CACHE_TIMEOUT', 60))
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -83,6 +114,12 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
 
+# Uploaded property and unit photos. Only their renditions (MEDIA_ROOT/photos/r/) are ever
+# served: by the app, or, better, straight from the web server with the same year-long
+# Cache-Control, since their names change with their content. Originals stay private.
+MEDIA_URL = '/media/'
+MEDIA_ROOT = os.environ.get('MEDIA_ROOT', str(BASE_DIR / 'media'))
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MPESA_ENVIRONMENT = 'sandbox'
@@ -93,3 +130,88 @@ MPESA_EXPRESS_SHORTCODE = '174379'
 MPESA_PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'
 MPESA_INITIATOR_USERNAME = 'testapi'
 MPESA_INITIATOR_SECURITY_CREDENTIAL = 'Safaricom999!*!'
+MPESA_CALLBACK_URL = os.environ.get('MPESA_CALLBACK_URL', 'https://mydomain.com/mpesa/callback/')
+# Overrides the Daraja host picked from MPESA_ENVIRONMENT, e.g. to use `manage.py fake_daraja`
+MPESA_API_BASE_URL = os.environ.get('MPESA_API_BASE_URL')
+
+# Upper bound for ?wait= on the payment status endpoint, and how often a waiting
+# request re-checks for callbacks that were handled by another worker. A waiting request
+# only gives its thread back under ASGI (AMS.asgi:application behind an ASGI server such as
+# uvicorn); under WSGI every one of them holds a worker for the whole wait.
+MPESA_STATUS_MAX_WAIT = 25
+MPESA_STATUS_RECHECK_SECONDS = 1
+
+# STK push token buckets as (burst, pushes refilled per minute): per tenant, and for the
+# whole app to stay under Daraja's rate limits; see my_app/throttling.py. A push for the
+# same tenant and amount within MPESA_STK_DEDUP_SECONDS of another returns that one.
+MPESA_STK_TENANT_LIMIT = (3, 2)
+MPESA_STK_GLOBAL_LIMIT = (30, 600)
+MPESA_STK_DEDUP_SECONDS = 90
+
+# STK pushes still without a callback this long after they were sent are looked up with
+# Daraja's STK query by the poll_stk_pushes job, MPESA_STK_QUERY_CONCURRENCY at a time, and
+# marked expired after MPESA_STK_QUERY_MAX_ATTEMPTS queries go unanswered
+MPESA_STK_QUERY_AFTER_SECONDS = 90
+MPESA_STK_QUERY_CONCURRENCY = 8
+MPESA_STK_QUERY_MAX_ATTEMPTS = 5
+
+# Staff-only request profiling (?_profile=1 or an X-Profile header); see my_app/profiling.py
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '1') == '1'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', str(BASE_DIR / 'profiles'))
+PROFILE_KEEP = 100
+PROFILE_SAMPLE_INTERVAL = 0.001
+
+# /metrics takes `Authorization: Bearer <METRICS_TOKEN>`, and is closed while no token is set.
+# METRICS_ALLOWED_NETWORKS (comma separated, e.g. 127.0.0.0/8) lets those in without it: only
+# set it when the app is not behind a proxy, where every request comes from loopback.
+# Run gunicorn with PROMETHEUS_MULTIPROC_DIR to aggregate across workers.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_NETWORKS = [net.strip() for net in os.environ.get('METRICS_ALLOWED_NETWORKS', '').split(',') if net.strip()]
+
+# Collections forecast on the financial report (my_app/forecasting.py); refresh it ahead of
+# time with `manage.py forecast_collections --refresh`
+FORECAST_MONTHS = 3
+FORECAST_CACHE_TIMEOUT = 60 * 60
+
+# Completed payments older than this many months are moved to PaymentArchive by
+# `manage.py archive_payments` (run it nightly); see my_app/archive.py
+PAYMENT_ARCHIVE_AFTER_MONTHS = 24
+PAYMENT_ARCHIVE_BATCH_SIZE = 5000
+
+# Audit trail of property, unit, tenant and payment changes (my_app/audit.py). Entries are
+# buffered in memory and written by a background thread in batches.
+AUDIT_ENABLED = os.environ.get('AUDIT_ENABLED', '1') == '1'
+AUDIT_BATCH_SIZE = 500
+AUDIT_FLUSH_INTERVAL = 2.0
+
+# Deleted properties are hidden at once and removed for good, with their units, by
+# `manage.py purge_properties` after this many days; see my_app/deletion.py
+PROPERTY_PURGE_AFTER_DAYS = 30
+PROPERTY_PURGE_BATCH_SIZE = 500
+
+# Scheduled jobs (my_app/jobs.py) are run by `manage.py run_scheduler` workers on any
+# number of nodes, coordinated through leases in the database; see my_app/scheduler.py
+SCHEDULER_LEASE_SECONDS = 60
+SCHEDULER_POLL_SECONDS = 15
+SCHEDULER_MAX_ATTEMPTS = 3
+
+# Photos are resized into WebP and JPEG renditions PHOTO_WIDTHS pixels wide by PHOTO_WORKERS
+# background threads per process once the upload is saved, and by the process_photos job for
+# anything those missed; see my_app/photos.py. 0 workers leaves it all to the job.
+PHOTO_WIDTHS = [320, 640, 1280]
+PHOTO_WORKERS = int(os.environ.get('PHOTO_WORKERS', 2))
+PHOTO_MAX_UPLOAD_MB = 15
+PHOTO_PROCESSING_TIMEOUT = 300
+PHOTO_MAX_ATTEMPTS = 3
+
+# Public vacancy search at /vacancies/ (my_app/vacancies.py). Facet counts are cached until
+# a unit or property changes; pages may be cached by browsers and proxies for VACANCY_MAX_AGE.
+VACANCY_PAGE_SIZE = 24
+VACANCY_FACET_CACHE_TIMEOUT = 60 * 60
+VACANCY_MAX_AGE = 60
+
+# Staff who are not superusers only see the properties they manage, and the units, tenants
+# and payments under them (my_app/models.py, ScopedQuerySet). Each user's property ids are
+# cached until a property changes; per-manager dashboard figures for DASHBOARD_CACHE_TIMEOUT.
+SCOPE_CACHE_TIMEOUT = 60 * 60
+DASHBOARD_CACHE_TIMEOUT = 5 * 60
@@ -1,21 +1,55 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin import AdminSite
 from django import forms
-from .models import Property, Unit, Tenant, Payment
+from django.shortcuts import render
+from . import deletion, lifecycle, photos
+from .models import Property, Unit, Tenant, Payment, AuditLog, JobLease, RentAdjustment, RentSchedule, StkPush, Photo
 
 AdminSite.actions_selection_counter = True
 AdminSite.empty_value_display = ''
 
 
+class DeletedFilter(admin.SimpleListFilter):
+    title = 'deleted'
+    parameter_name = 'deleted'
+    
+    def lookups(self, request, model_admin):
+        return [('no', 'No'), ('yes', 'Yes')]
+    
+    def queryset(self, request, queryset):
+        if self.value() in ('yes', 'no'):
+            return queryset.filter(deleted_at__isnull=self.value() == 'no')
+        return queryset
+
+
 @admin.register(Property)
 class PropertyAdmin(admin.ModelAdmin):
-    list_display = ['name', 'property_type', 'city', 'total_units', 'tenant_count', 'status']
-    list_filter = ['status', 'property_type', 'city']
+    list_display = ['name', 'property_type', 'city', 'total_units', 'tenant_count', 'status', 'deleted_at']
+    list_filter = [DeletedFilter, 'status', 'property_type', 'city']
     search_fields = ['name', 'address', 'city']
     ordering = ['-created_at']
+    readonly_fields = ['deleted_at']
+    actions = ['restore']
     
-    actions_on_top = False
-    actions_on_bottom = False
+    def get_queryset(self, request):
+        # Deleted properties stay listed until purged, so they can be restored
+        return Property.all_objects.all()
+    
+    def delete_model(self, request, obj):
+        deletion.soft_delete_properties(Property.all_objects.filter(pk=obj.pk))
+    
+    def delete_queryset(self, request, queryset):
+        deletion.soft_delete_properties(queryset)
+    
+    def get_deleted_objects(self, objs, request):
+        # Only soft-deletes, so skip the collector walking every unit and status change
+        perms_needed = set() if self.has_delete_permission(request) else {Property._meta.verbose_name}
+        return [str(obj) for obj in objs], {Property._meta.verbose_name_plural: len(objs)}, perms_needed, []
+    
+    @admin.action(description='Restore selected deleted properties')
+    def restore(self, request, queryset):
+        restored = deletion.restore_properties(queryset)
+        self.message_user(request, f'{restored} propert{"y" if restored == 1 else "ies"} restored.')
     
     def tenant_count(self, obj):
         """Count tenants in this property"""
@@ -23,6 +57,40 @@ class PropertyAdmin(admin.ModelAdmin):
     tenant_count.short_description = 'Tenants'
 
 
+class LeaseRenewalForm(forms.Form):
+    end_date = forms.DateField(widget=forms.TextInput(attrs={'placeholder': 'YYYY-MM-DD'}))
+    rent_amount = forms.DecimalField(required=False, max_digits=10, decimal_places=2, min_value=0,
+                                     help_text='Leave blank to keep the current rent')
+
+
+class AssignUnitsForm(forms.Form):
+    property = forms.ModelChoiceField(queryset=Property.objects.all())
+
+
+def _bulk_action_form(modeladmin, request, queryset, form, title):
+    """Intermediate page asking for an action's parameters; posts back to the same action."""
+    return render(request, 'admin/my_app/bulk_action.html', {
+        **modeladmin.admin_site.each_context(request),
+        'title': title,
+        'opts': modeladmin.model._meta,
+        'form': form,
+        'action': request.POST['action'],
+        'selected_ids': list(queryset.values_list('pk', flat=True)),
+    })
+
+
+def _unit_status_action(status, label):
+    @admin.action(description=f'Set selected units to {label}')
+    def action(modeladmin, request, queryset):
+        changed, skipped = lifecycle.set_unit_status(queryset, status)
+        modeladmin.message_user(request, f'{changed} unit(s) set to {label}.')
+        if skipped:
+            modeladmin.message_user(request, f'{skipped} unit(s) with an active tenant were left unchanged.',
+                                    messages.WARNING)
+    action.__name__ = f'set_{status}'
+    return action
+
+
 @admin.register(Unit)
 class UnitAdmin(admin.ModelAdmin):
     list_display = ['unit_number', 'property', 'unit_type', 'rent_amount', 'status']
@@ -32,8 +100,7 @@ class UnitAdmin(admin.ModelAdmin):
     
     exclude = ['is_occupied']
     
-    actions_on_top = False
-    actions_on_bottom = False
+    actions = [_unit_status_action(status, label.lower()) for status, label in Unit.STATUS_CHOICES]
     
     class Media:
         css = {
@@ -55,8 +122,7 @@ class TenantAdmin(admin.ModelAdmin):
     search_fields = ['first_name', 'last_name', 'email', 'phone']
     ordering = ['last_name', 'first_name']
     
-    actions_on_top = False
-    actions_on_bottom = False
+    actions = ['move_out', 'renew_leases', 'assign_to_vacant_units']
     
     class Media:
         css = {
@@ -79,6 +145,30 @@ class TenantAdmin(admin.ModelAdmin):
     def full_name(self, obj):
         return f"{obj.first_name} {obj.last_name}"
     full_name.short_description = 'Name'
+    
+    @admin.action(description='Move selected tenants out today')
+    def move_out(self, request, queryset):
+        moved, freed = lifecycle.move_out(queryset)
+        self.message_user(request, f'{moved} tenant(s) moved out, {freed} unit(s) now available.')
+    
+    @admin.action(description='Renew leases of selected tenants')
+    def renew_leases(self, request, queryset):
+        form = LeaseRenewalForm(request.POST if 'apply' in request.POST else None)
+        if not form.is_valid():
+            return _bulk_action_form(self, request, queryset, form, 'Renew leases')
+        renewed = lifecycle.renew_leases(queryset, form.cleaned_data['end_date'], form.cleaned_data['rent_amount'])
+        self.message_user(request, f"{renewed} lease(s) renewed until {form.cleaned_data['end_date']}.")
+    
+    @admin.action(description='Assign selected tenants to vacant units')
+    def assign_to_vacant_units(self, request, queryset):
+        form = AssignUnitsForm(request.POST if 'apply' in request.POST else None)
+        if not form.is_valid():
+            return _bulk_action_form(self, request, queryset, form, 'Assign to vacant units')
+        property_obj = form.cleaned_data['property']
+        assigned, left = lifecycle.assign_to_vacant_units(queryset, property_obj)
+        self.message_user(request, f'{assigned} tenant(s) assigned to units in {property_obj}.')
+        if left:
+            self.message_user(request, f'{left} tenant(s) not assigned: not enough vacant units.', messages.WARNING)
 
 
 @admin.register(Payment)
@@ -110,3 +200,96 @@ class PaymentAdmin(admin.ModelAdmin):
             field.empty_label = ''
         return field
 
+
+
+@admin.register(Photo)
+class PhotoAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'property', 'unit', 'caption', 'width', 'height', 'status', 'attempts', 'created_at']
+    list_filter = ['status']
+    search_fields = ['caption', 'property__name', 'unit__unit_number']
+    date_hierarchy = 'created_at'
+    list_select_related = ['property', 'unit__property']
+    raw_id_fields = ['property', 'unit']
+    actions = ['retry']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    @admin.action(description='Make the renditions again')
+    def retry(self, request, queryset):
+        ids = list(queryset.exclude(status='processing').values_list('pk', flat=True))
+        Photo.objects.filter(pk__in=ids).update(status='pending', attempts=0, error='')
+        photos.enqueue(ids)
+        self.message_user(request, f'{len(ids)} photo(s) queued')
+
+
+@admin.register(StkPush)
+class StkPushAdmin(admin.ModelAdmin):
+    list_display = ['checkout_request_id', 'tenant', 'amount', 'status', 'source', 'queries', 'created_at', 'answered_at']
+    list_filter = ['status', 'source']
+    search_fields = ['checkout_request_id', 'phone_number']
+    date_hierarchy = 'created_at'
+    list_select_related = ['tenant']
+    raw_id_fields = ['tenant']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(RentSchedule)
+class RentScheduleAdmin(admin.ModelAdmin):
+    list_display = ['effective_from', 'unit', 'tenant', 'previous_amount', 'rent_amount', 'adjustment']
+    list_filter = ['effective_from']
+    search_fields = ['unit__unit_number', 'tenant__first_name', 'tenant__last_name']
+    list_select_related = ['unit', 'unit__property', 'tenant', 'adjustment']
+    raw_id_fields = ['unit', 'tenant', 'adjustment']
+
+
+@admin.register(RentAdjustment)
+class RentAdjustmentAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'applies_to', 'property', 'unit_type', 'leases_changed', 'units_changed',
+                    'created_by', 'created_at', 'applied_at']
+    list_filter = ['applies_to', 'kind']
+    list_select_related = ['property', 'created_by']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(AuditLog)
+class AuditLogAdmin(admin.ModelAdmin):
+    list_display = ['created_at', 'user', 'action', 'model', 'object_id']
+    list_filter = ['action', 'model']
+    search_fields = ['user__username']
+    date_hierarchy = 'created_at'
+    list_select_related = ['user']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(JobLease)
+class JobLeaseAdmin(admin.ModelAdmin):
+    list_display = ['job', 'shard', 'slot', 'status', 'owner', 'expires_at', 'attempts', 'finished_at']
+    list_filter = ['status', 'job']
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,312 @@
+"""
+Read-only JSON API (v1) for properties, units, tenants and payments.
+
+Rows are serialized straight from values(), so only the requested columns are selected
+and joins are added only for related fields that were asked for (e.g. `property_name`).
+Like the HTML views, staff only get the rows of the properties they manage. Payments
+include archived ones (my_app/archive.py) whenever the from/to filters reach back to them.
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.http import JsonResponse
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import require_GET, require_POST
+
+from . import audit
+from .caching import bump_model_version
+from .archive import reaches_archive
+from .filters import FilterError, filter_properties, filter_units, filter_tenants, filter_payments, date_param
+from .forms import PaymentBatchItemForm
+from .metrics import record_payments_created
+from .models import Property, Unit, Tenant, Payment, PaymentArchive
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 1000
+
+
+def _fields(*names, **related):
+    """Map public field names to ORM paths; plain names map to themselves."""
+    fields = {name: name for name in names}
+    fields.update(related)
+    return fields
+
+
+RESOURCES = {
+    'properties': {
+        'model': Property,
+        'filter': filter_properties,
+        'fields': _fields(
+            'id', 'name', 'property_type', 'address', 'city', 'county', 'description',
+            'total_units', 'status', 'manager_id', 'created_at', 'updated_at',
+        ),
+        'default_fields': ['id', 'name', 'property_type', 'city', 'county', 'total_units', 'status'],
+    },
+    'units': {
+        'model': Unit,
+        'filter': filter_units,
+        'fields': _fields(
+            'id', 'property_id', 'unit_number', 'unit_type', 'floor', 'bedrooms', 'bathrooms',
+            'rent_amount', 'deposit_amount', 'status', 'is_occupied', 'description',
+            'created_at', 'updated_at',
+            property_name='property__name',
+        ),
+        'default_fields': ['id', 'property_id', 'unit_number', 'unit_type', 'rent_amount', 'status'],
+    },
+    'tenants': {
+        'model': Tenant,
+        'filter': filter_tenants,
+        'fields': _fields(
+            'id', 'user_id', 'first_name', 'last_name', 'email', 'phone', 'id_number', 'unit_id',
+            'lease_start_date', 'lease_end_date', 'rent_amount', 'deposit_paid',
+            'emergency_contact_name', 'emergency_contact_phone', 'status', 'notes',
+            'created_at', 'updated_at',
+            unit_number='unit__unit_number',
+            property_id='unit__property_id',
+            property_name='unit__property__name',
+        ),
+        'default_fields': ['id', 'first_name', 'last_name', 'email', 'phone', 'unit_id', 'status'],
+    },
+    'payments': {
+        'model': Payment,
+        # Archived payments keep their ids, so both tables page together by id
+        'archive': PaymentArchive,
+        'filter': filter_payments,
+        'fields': _fields(
+            'id', 'tenant_id', 'amount', 'payment_type', 'payment_method', 'payment_date',
+            'reference_number', 'description', 'status', 'checkout_request_id',
+            'period_start', 'period_end', 'created_at', 'updated_at',
+            tenant_last_name='tenant__last_name',
+            tenant_first_name='tenant__first_name',
+            unit_id='tenant__unit_id',
+            property_id='tenant__unit__property_id',
+            property_name='tenant__unit__property__name',
+        ),
+        'default_fields': ['id', 'tenant_id', 'amount', 'payment_type', 'payment_method',
+                           'payment_date', 'status'],
+    },
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_staff_required(view_func):
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return JsonResponse({'error': 'Authentication required'}, status=401)
+        if not (request.user.is_staff or request.user.is_superuser):
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+        try:
+            return view_func(request, *args, **kwargs)
+        except ApiError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        except FilterError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+    return wrapper
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(json.dumps({'after': pk}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        pk = int(json.loads(base64.urlsafe_b64decode(padded))['after'])
+    except (binascii.Error, ValueError, KeyError, TypeError, OverflowError):
+        raise ApiError('Invalid cursor')
+    # Beyond a 64-bit primary key the filter itself would fail
+    if not 0 <= pk < 2 ** 63:
+        raise ApiError('Invalid cursor')
+    return pk
+
+
+def _selected_fields(resource, params):
+    requested = params.get('fields', '')
+    if not requested:
+        return resource['default_fields']
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in resource['fields']]
+    if unknown:
+        raise ApiError(f"Unknown fields: {', '.join(unknown)}. "
+                       f"Available: {', '.join(resource['fields'])}")
+    if 'id' not in names:
+        names.insert(0, 'id')
+    return names
+
+
+def _project(queryset, resource, names):
+    """values() projection: plain columns by name, related columns through F() aliases."""
+    plain = [name for name in names if resource['fields'][name] == name]
+    aliased = {name: F(resource['fields'][name]) for name in names if resource['fields'][name] != name}
+    return queryset.values(*plain, **aliased)
+
+
+def _page_size(params):
+    try:
+        limit = int(params.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ApiError('limit must be an integer')
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _models(resource, params):
+    """The models to read `resource` from: its archive too when the dates reach it."""
+    if 'archive' in resource and reaches_archive(date_param(params, 'from'), date_param(params, 'to')):
+        return [resource['model'], resource['archive']]
+    return [resource['model']]
+
+
+def _get_resource(name):
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise ApiError(f'Unknown resource: {name}', status=404)
+
+
+@gzip_page
+@require_GET
+@api_staff_required
+def resource_list(request, resource):
+    """
+    Cursor-paginated list. Query parameters:
+
+    fields  -- comma separated field names (sparse fieldset)
+    limit   -- page size, up to MAX_PAGE_SIZE
+    cursor  -- the `next_cursor` of the previous page
+    plus the same filters as the matching HTML list view (search, status, type, ...).
+    """
+    resource = _get_resource(resource)
+    names = _selected_fields(resource, request.GET)
+    limit = _page_size(request.GET)
+
+    cursor = request.GET.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+
+    rows = []
+    for model in _models(resource, request.GET):
+        queryset = resource['filter'](model.objects.for_user(request.user), request.GET)
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        rows += _project(queryset.order_by('pk'), resource, names)[:limit + 1]
+    rows.sort(key=lambda row: row['id'])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return JsonResponse({
+        'results': [{name: row[name] for name in names} for row in rows],
+        'next_cursor': encode_cursor(rows[-1]['id']) if has_more else None,
+    })
+
+
+@gzip_page
+@require_GET
+@api_staff_required
+def resource_detail(request, resource, pk):
+    resource = _get_resource(resource)
+    names = _selected_fields(resource, request.GET)
+
+    for model in _models(resource, {}):
+        row = _project(model.objects.for_user(request.user).filter(pk=pk), resource, names).first()
+        if row is not None:
+            break
+    if row is None:
+        raise ApiError('Not found', status=404)
+    return JsonResponse({name: row[name] for name in names})
+
+
+def _tenant_id(item):
+    try:
+        tenant_id = int(item.get('tenant'))
+    except (TypeError, ValueError, OverflowError):
+        return None
+    # Beyond a 64-bit primary key the lookup itself would fail
+    return tenant_id if 0 < tenant_id < 2 ** 63 else None
+
+
+def record_payment_batch(items, user):
+    """
+    Validate every item with PaymentForm rules and insert the valid ones, for tenants
+    `user` manages.
+
+    Tenants are resolved with a single query and all payments go in through one
+    bulk_create, so per-save signals do not fire; payment_batch() bumps the Payment
+    version once for the whole batch and records its audit entries instead.
+    Returns (payments to create, per-item results in input order).
+    """
+    tenants = Tenant.objects.for_user(user).in_bulk({tid for tid in map(_tenant_id, items) if tid is not None})
+
+    payments = []
+    results = []
+    for index, item in enumerate(items):
+        tenant = tenants.get(_tenant_id(item))
+        form = PaymentBatchItemForm(item, instance=Payment(tenant=tenant))
+        errors = {}
+        if tenant is None:
+            errors['tenant'] = ['Select a valid tenant.']
+        if not form.is_valid():
+            errors.update({field: list(messages) for field, messages in form.errors.items()})
+        if errors:
+            results.append({'index': index, 'ok': False, 'errors': errors})
+        else:
+            payments.append(form.instance)
+            results.append({'index': index, 'ok': True})
+    return payments, results
+
+
+@require_POST
+@api_staff_required
+def payment_batch(request):
+    """
+    Record many payments in one transaction.
+
+    Body: {"payments": [{...PaymentForm fields, "tenant": <id>}, ...], "all_or_nothing": false}
+    With all_or_nothing, nothing is written unless every item is valid.
+    """
+    try:
+        body = json.loads(request.body)
+    except ValueError:
+        raise ApiError('Request body must be JSON')
+    items = body.get('payments') if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ApiError('"payments" must be a list of objects')
+    if len(items) > MAX_BATCH_SIZE:
+        raise ApiError(f'At most {MAX_BATCH_SIZE} payments per batch')
+
+    payments, results = record_payment_batch(items, request.user)
+    failed = len(items) - len(payments)
+    if failed and body.get('all_or_nothing'):
+        payments = []
+        for result in results:
+            if result['ok']:
+                result['ok'] = False
+                result['errors'] = {'__all__': ['Not saved because other items in the batch are invalid.']}
+
+    if payments:
+        with transaction.atomic():
+            created = Payment.objects.bulk_create(payments)
+            # bulk_create sends no post_save, which the audit trail is otherwise recorded from
+            if settings.AUDIT_ENABLED:
+                for payment in created:
+                    audit.record_save(payment, created=True)
+        bump_model_version(Payment)
+        record_payments_created(p.payment_method for p in created)
+        created_ids = iter(p.pk for p in created)
+        for result in results:
+            if result['ok']:
+                result['id'] = next(created_ids)
+
+    return JsonResponse({
+        'created': len(payments),
+        'failed': len(items) - len(payments),
+        'results': results,
+    }, status=201 if payments else 400)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MyAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'my_app'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
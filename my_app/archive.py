@@ -0,0 +1,169 @@
+"""
+Archiving of old payments.
+
+Completed payments older than PAYMENT_ARCHIVE_AFTER_MONTHS (whole months) are moved from
+Payment to PaymentArchive in batches, keeping their ids, by `manage.py archive_payments`.
+Each archived year is summed into PaymentRollup (per tenant, type and method), so:
+
+- day-to-day pages and totals read the small live table plus the rollups, never the archive;
+- listings (HTML and API) and monthly breakdowns read the archive only when their dates
+  reach back past archive_boundary(), or are left open.
+
+Pending, failed and refunded payments are never archived, whatever their age.
+"""
+import heapq
+from collections import defaultdict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min, Sum
+from django.db.models.functions import ExtractYear
+from django.utils import timezone
+
+from .caching import bump_model_version, model_version
+from .models import Payment, PaymentArchive, PaymentRollup
+
+# Columns copied verbatim from Payment into PaymentArchive
+COPIED_FIELDS = [
+    'id', 'tenant', 'amount', 'payment_type', 'payment_method', 'payment_date', 'reference_number',
+    'description', 'status', 'checkout_request_id', 'period_start', 'period_end', 'created_at', 'updated_at',
+]
+
+
+def archive_cutoff(months=None, today=None):
+    """First day of the oldest month that stays live; earlier payments get archived."""
+    months = settings.PAYMENT_ARCHIVE_AFTER_MONTHS if months is None else months
+    today = today or timezone.localdate()
+    year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+    return date(year, month + 1, 1)
+
+
+def archive_boundary():
+    """Date of the newest archived payment, or None while the archive is empty."""
+    key = f'payment-archive:boundary:{model_version(PaymentArchive).timestamp()}'
+    boundary = cache.get(key)
+    if boundary is None:
+        boundary = PaymentArchive.objects.aggregate(latest=Max('payment_date'))['latest'] or ''
+        cache.set(key, boundary, None)
+    return boundary or None
+
+
+def reaches_archive(date_from, date_to=None):
+    """
+    Whether a listing of payments dated `date_from` to `date_to` (dates, None for
+    unbounded) needs the archive: when either bound is missing or on or before the boundary.
+    """
+    boundary = archive_boundary()
+    if boundary is None:
+        return False
+    return date_from is None or date_to is None or min(date_from, date_to) <= boundary
+
+
+def _quoted_columns(model):
+    return ', '.join(connection.ops.quote_name(model._meta.get_field(name).column) for name in COPIED_FIELDS)
+
+
+def _move(ids, archived_at):
+    """Copy the payments with these ids into the archive and delete them, in one transaction."""
+    placeholders = ', '.join(['%s'] * len(ids))
+    live = connection.ops.quote_name(Payment._meta.db_table)
+    archive = connection.ops.quote_name(PaymentArchive._meta.db_table)
+    archived_at_column = connection.ops.quote_name(PaymentArchive._meta.get_field('archived_at').column)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {archive} ({_quoted_columns(PaymentArchive)}, {archived_at_column}) '
+            f'SELECT {_quoted_columns(Payment)}, %s FROM {live} WHERE id IN ({placeholders})',
+            [connection.ops.adapt_datetimefield_value(archived_at), *ids],
+        )
+        cursor.execute(f'DELETE FROM {live} WHERE id IN ({placeholders})', ids)
+
+
+def rebuild_rollups(years=None):
+    """
+    Recompute PaymentRollup for the given years (every archived year by default) from
+    the archive. Returns the number of rollup rows written.
+    """
+    archived = PaymentArchive.objects.order_by()
+    if years is not None:
+        years = sorted(years)
+        if not years:
+            return 0
+        archived = archived.filter(payment_date__gte=date(years[0], 1, 1), payment_date__lt=date(years[-1] + 1, 1, 1))
+    rows = (
+        archived.annotate(year=ExtractYear('payment_date'))
+        .values('year', 'tenant_id', 'payment_type', 'payment_method')
+        .annotate(count=Count('id'), total=Sum('amount'))
+    )
+    if years is not None:
+        wanted = set(years)
+        rows = (row for row in rows if row['year'] in wanted)
+    rollups = [PaymentRollup(**row) for row in rows]
+
+    with transaction.atomic():
+        stale = PaymentRollup.objects.all()
+        if years is not None:
+            stale = stale.filter(year__in=years)
+        stale.delete()
+        PaymentRollup.objects.bulk_create(rollups, batch_size=1000)
+    bump_model_version(PaymentRollup)
+    return len(rollups)
+
+
+def archive_payments(cutoff=None, batch_size=None, log=None):
+    """
+    Move completed payments dated before `cutoff` (archive_cutoff() by default) into the
+    archive, `batch_size` at a time, then rebuild the rollups of the years they came from.
+    Returns (payments archived, rollup rows written).
+    """
+    cutoff = cutoff or archive_cutoff()
+    batch_size = batch_size or settings.PAYMENT_ARCHIVE_BATCH_SIZE
+    candidates = Payment.objects.filter(status='completed', payment_date__lt=cutoff).order_by('pk')
+    oldest = candidates.aggregate(oldest=Min('payment_date'))['oldest']
+    if oldest is None:
+        return 0, 0
+    archived_at = timezone.now()
+    moved = 0
+    last_id = 0
+    while True:
+        ids = list(candidates.filter(pk__gt=last_id).values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            break
+        _move(ids, archived_at)
+        moved += len(ids)
+        last_id = ids[-1]
+        if log and moved % (batch_size * 20) < len(ids):
+            log(f'  {moved} payments archived')
+
+    rollups = rebuild_rollups(range(oldest.year, (cutoff - timedelta(days=1)).year + 1)) if moved else 0
+    if moved:
+        bump_model_version(Payment)
+        bump_model_version(PaymentArchive)
+    return moved, rollups
+
+
+def archived_totals(property_ids=None, **filters):
+    """
+    Count and sum of archived payments matching `filters` (PaymentRollup lookups), of the
+    tenants of `property_ids` (all for None).
+    """
+    totals = PaymentRollup.objects.in_scope(property_ids).filter(**filters).aggregate(count=Sum('count'), total=Sum('total'))
+    return {'count': totals['count'] or 0, 'total': totals['total'] or Decimal('0')}
+
+
+def merge_totals(live, archived, key, value='total'):
+    """
+    Add two grouped aggregates (iterables of dicts) by `key`, largest `value` first,
+    e.g. revenue by payment type from Payment and from PaymentRollup.
+    """
+    totals = defaultdict(Decimal)
+    for row in [*live, *archived]:
+        totals[row[key]] += row[value] or 0
+    return sorted(({key: k, value: v} for k, v in totals.items()), key=lambda row: row[value], reverse=True)
+
+
+def merge_payments(live, archived):
+    """Interleave two querysets ordered by (-payment_date, -created_at), keeping that order."""
+    return list(heapq.merge(live, archived, key=lambda p: (p.payment_date, p.created_at), reverse=True))
@@ -0,0 +1,191 @@
+"""
+Audit trail of changes to properties, units, tenants and payments.
+
+The post_save/post_delete receivers in signals.py turn every change, including cascaded
+deletes, into an AuditLog entry holding the changed fields and the acting user. Recording
+only diffs the instance against its loaded values (LoadedValuesMixin) and, once the
+transaction commits, appends a tuple to an in-process buffer. A background thread writes
+the buffer with bulk_create every AUDIT_FLUSH_INTERVAL seconds, or as soon as
+AUDIT_BATCH_SIZE entries are waiting, so requests never wait for the inserts.
+
+The buffer is flushed at exit; a crashed process loses at most the entries of its last
+flush interval. Saves and deletes that bypass signals (bulk_create, queryset.update())
+are not recorded unless the caller passes its changes to record() or record_updates().
+
+The acting user is the request's user (AuditUserMiddleware) or the one given to
+acting_as() in management commands and background jobs.
+"""
+import atexit
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import AuditLog
+
+logger = logging.getLogger(__name__)
+
+# Bookkeeping fields that change on every save
+EXCLUDED_FIELDS = {'created_at', 'updated_at'}
+# Entries kept in memory while the database refuses them, beyond which the oldest are dropped
+MAX_BUFFERED = 100000
+
+_request = ContextVar('audit_request', default=None)
+_actor = ContextVar('audit_actor', default=None)
+
+
+class AuditUserMiddleware:
+    """Makes the request available to the audit trail; the user is only resolved on a change."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = _request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _request.reset(token)
+
+    async def __acall__(self, request):
+        # sync_to_async copies the context, so ORM calls made from the view still see the request
+        token = _request.set(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            _request.reset(token)
+
+
+@contextmanager
+def acting_as(user):
+    """Attribute changes made inside the block to `user` (a User or a user id)."""
+    token = _actor.set(getattr(user, 'pk', user))
+    try:
+        yield
+    finally:
+        _actor.reset(token)
+
+
+def current_user_id():
+    user_id = _actor.get()
+    if user_id is not None:
+        return user_id
+    request = _request.get()
+    user = getattr(request, 'user', None)
+    return user.pk if user is not None and user.is_authenticated else None
+
+
+class AuditWriter:
+    """Buffers audit entries and writes them in batches from a daemon thread."""
+
+    def __init__(self):
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, entry):
+        with self._lock:
+            self._buffer.append(entry)
+            waiting = len(self._buffer)
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            self._start()
+        if waiting >= settings.AUDIT_BATCH_SIZE:
+            self._wake.set()
+
+    def _start(self):
+        # Also after a fork (e.g. gunicorn --preload), where the parent's thread does not exist
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(settings.AUDIT_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+            connection.close_if_unusable_or_obsolete()
+
+    def flush(self):
+        """Write every buffered entry now. Returns the number written."""
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return 0
+        try:
+            AuditLog.objects.bulk_create([
+                AuditLog(created_at=created_at, user_id=user_id, action=action, model=model,
+                         object_id=object_id, changes=changes)
+                for created_at, user_id, action, model, object_id, changes in entries
+            ], batch_size=500)
+        except Exception:
+            logger.exception('Could not write %d audit entries; will retry', len(entries))
+            with self._lock:
+                self._buffer[:0] = entries
+                del self._buffer[:-MAX_BUFFERED]
+            return 0
+        return len(entries)
+
+
+writer = AuditWriter()
+atexit.register(writer.flush)
+
+
+def flush():
+    return writer.flush()
+
+
+def record(action, model, object_id, changes, using=None):
+    """
+    Queue an entry for `model` (a model class) once the current transaction commits.
+    `changes` is {field: (old, new)}.
+    """
+    entry = (timezone.now(), current_user_id(), action, model._meta.label_lower, object_id, changes)
+    transaction.on_commit(partial(writer.add, entry), using=using)
+
+
+def record_updates(model, before, after):
+    """
+    Record rows of `model` changed by a bulk update: `before` is {pk: {field: old value}},
+    `after` {pk: {field: new value}}.
+    """
+    if not settings.AUDIT_ENABLED:
+        return
+    for pk, old in before.items():
+        changes = {field: (old[field], new) for field, new in after[pk].items() if old[field] != new}
+        if changes:
+            record('update', model, pk, changes)
+
+
+def record_save(instance, created, update_fields=None, using=None):
+    changes = instance.changed_values(update_fields)
+    for name in EXCLUDED_FIELDS.intersection(changes):
+        del changes[name]
+    if changes or created:
+        record('create' if created else 'update', type(instance), instance.pk, changes, using)
+
+
+def record_delete(instance, using=None):
+    changes = {
+        field.attname: (instance.__dict__[field.attname], None)
+        for field in instance._tracked_fields() if field.attname not in EXCLUDED_FIELDS
+    }
+    record('delete', type(instance), instance.pk, changes, using)
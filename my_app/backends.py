@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from .caching import cache_is_shared
+from .metrics import record_cache
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    if user_id:
+        cache.delete(user_cache_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    """
+    ModelBackend that keeps the session user in the cache.
+
+    The user is loaded together with its tenant profile, so `request.user.tenant_profile`
+    does not cost another query. Entries are dropped by the signals in signals.py
+    whenever the user or its tenant profile changes. With a per-process cache those
+    drops would only reach one worker, so the user is read from the database instead.
+    """
+
+    def get_user(self, user_id):
+        user = self._cached_user(user_id) if cache_is_shared() else self._load_user(user_id)
+        return user if user is not None and self.user_can_authenticate(user) else None
+
+    def _load_user(self, user_id):
+        try:
+            return User.objects.select_related('tenant_profile').get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+
+    def _cached_user(self, user_id):
+        key = user_cache_key(user_id)
+        user = cache.get(key)
+        record_cache('user', user is not None)
+        if user is None:
+            user = self._load_user(user_id)
+            if user is not None:
+                cache.set(key, user, settings.USER_CACHE_TIMEOUT)
+        return user
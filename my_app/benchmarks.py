@@ -0,0 +1,219 @@
+"""
+Benchmark harness for the views in my_app/urls.py.
+
+Runs each scenario through the Django test client against the current database (usually a
+portfolio from `manage.py generate_portfolio`) and records latency percentiles, query counts
+and peak memory. Everything happens inside one transaction that is rolled back at the end,
+so fixture users and callback payments never persist.
+"""
+import json
+import math
+import platform
+import statistics
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from .api import MAX_PAGE_SIZE
+from .models import Property, Unit, Tenant, Payment
+from .synthetic import fake_stk_callback
+
+STAFF_USERNAME = 'benchmark-staff'
+TENANT_USERNAME = 'benchmark-tenant'
+
+
+@dataclass
+class Scenario:
+    name: str
+    url: str
+    client: str = 'staff'
+    method: str = 'get'
+    # Called with the iteration number; returns the POST body
+    body: object = None
+    content_type: str = 'application/json'
+
+
+@dataclass
+class Result:
+    name: str
+    status: int = 0
+    latencies_ms: list = field(default_factory=list)
+    queries: int = 0
+    peak_memory_kb: float = 0.0
+
+    def percentile(self, pct):
+        ordered = sorted(self.latencies_ms)
+        return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+    def as_dict(self):
+        return {
+            'status': self.status,
+            'iterations': len(self.latencies_ms),
+            'p50_ms': round(self.percentile(50), 2),
+            'p95_ms': round(self.percentile(95), 2),
+            'p99_ms': round(self.percentile(99), 2),
+            'mean_ms': round(statistics.fmean(self.latencies_ms), 2),
+            'queries': self.queries,
+            'peak_memory_kb': round(self.peak_memory_kb, 1),
+        }
+
+
+class QueryCounter:
+    """execute_wrapper that counts queries; unlike connection.queries it has no 9000 cap."""
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _fixtures():
+    """Staff and tenant users for the run; the tenant is the active one with the most payments."""
+    staff, _ = User.objects.get_or_create(
+        username=STAFF_USERNAME, defaults={'is_staff': True, 'is_superuser': True}
+    )
+    tenant = (Tenant.objects.filter(status='active', user__isnull=True)
+              .annotate(n=Count('payments')).order_by('-n').first())
+    if tenant is None:
+        raise ValueError('No active tenant without a login found. Run generate_portfolio first.')
+    tenant_user, _ = User.objects.get_or_create(username=TENANT_USERNAME)
+    tenant.user = tenant_user
+    tenant.save(update_fields=['user'])
+
+    clients = {'staff': Client(), 'tenant': Client(), 'anonymous': Client()}
+    clients['staff'].force_login(staff)
+    clients['tenant'].force_login(tenant_user)
+    return clients, tenant
+
+
+def default_scenarios(tenant):
+    property_id = Property.objects.values_list('pk', flat=True).first()
+    unit_id = Unit.objects.values_list('pk', flat=True).first()
+    payment_id = Payment.objects.filter(tenant=tenant).values_list('pk', flat=True).first()
+    rent = int(tenant.rent_amount or 1)
+
+    def callback_body(iteration):
+        checkout_request_id = f'ws_CO_bench_{time.time_ns()}_{iteration}'
+        return json.dumps(fake_stk_callback(tenant.phone, rent, checkout_request_id))
+
+    return [
+        Scenario('manager_dashboard', reverse('manager_dashboard')),
+        Scenario('property_list', reverse('property_list')),
+        Scenario('property_detail', reverse('property_detail', args=[property_id])),
+        Scenario('unit_list', reverse('unit_list')),
+        Scenario('unit_detail', reverse('unit_detail', args=[unit_id])),
+        Scenario('tenant_list', reverse('tenant_list')),
+        Scenario('tenant_detail', reverse('tenant_detail', args=[tenant.pk])),
+        Scenario('payment_list', reverse('payment_list')),
+        Scenario('payment_list_pending', reverse('payment_list') + '?status=pending'),
+        Scenario('payment_list_mpesa', reverse('payment_list') + '?method=mpesa&type=rent'),
+        Scenario('payment_list_search', reverse('payment_list') + f'?search={tenant.last_name}'),
+        Scenario('payment_list_tenant', reverse('payment_list') + f'?tenant={tenant.pk}'),
+        Scenario('payment_detail', reverse('payment_detail', args=[payment_id])),
+        Scenario('financial_report', reverse('financial_report')),
+        Scenario('occupancy_report', reverse('occupancy_report')),
+        Scenario('tenant_dashboard', reverse('tenant_dashboard'), client='tenant'),
+        Scenario('tenant_dashboard_detail', reverse('tenant_dashboard_detail', args=[tenant.pk])),
+        Scenario('mpesa_payment', reverse('mpesa_payment', args=[tenant.pk]), client='tenant'),
+        Scenario('mpesa_callback', reverse('mpesa_callback'), client='anonymous',
+                 method='post', body=callback_body),
+        Scenario('api_payments', reverse('api_resource_list', args=['payments']) + '?limit=500'),
+        Scenario('api_payments_export', reverse('api_resource_list', args=['payments'])
+                 + f'?limit={MAX_PAGE_SIZE}&fields=tenant_id,amount,payment_date,status'),
+        Scenario('api_tenants_export', reverse('api_resource_list', args=['tenants'])
+                 + f'?limit={MAX_PAGE_SIZE}&fields=rent_amount,deposit_paid,status'),
+    ]
+
+
+def _request(client, scenario, iteration):
+    if scenario.method == 'post':
+        body = scenario.body(iteration) if callable(scenario.body) else scenario.body
+        return client.post(scenario.url, body, content_type=scenario.content_type)
+    return client.get(scenario.url)
+
+
+def run_scenario(client, scenario, iterations, warmup):
+    result = Result(scenario.name)
+    for i in range(warmup):
+        _request(client, scenario, -i - 1)
+
+    for i in range(iterations):
+        counter = QueryCounter()
+        with connection.execute_wrapper(counter):
+            started = time.perf_counter()
+            response = _request(client, scenario, i)
+            result.latencies_ms.append((time.perf_counter() - started) * 1000)
+        result.status = response.status_code
+        result.queries = counter.count
+
+    # Memory is measured on a separate request so tracing does not skew the latencies
+    tracemalloc.start()
+    try:
+        _request(client, scenario, iterations)
+        result.peak_memory_kb = tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(iterations=10, warmup=2, only=None, stdout=None):
+    results = {}
+    try:
+        with transaction.atomic():
+            clients, tenant = _fixtures()
+            for scenario in default_scenarios(tenant):
+                if only and scenario.name not in only:
+                    continue
+                result = run_scenario(clients[scenario.client], scenario, iterations, warmup)
+                results[scenario.name] = result.as_dict()
+                if stdout:
+                    r = results[scenario.name]
+                    stdout.write(f"{scenario.name:<28} {r['status']:>4} p50 {r['p50_ms']:>9.1f}ms "
+                                 f"p95 {r['p95_ms']:>9.1f}ms p99 {r['p99_ms']:>9.1f}ms "
+                                 f"{r['queries']:>4} queries {r['peak_memory_kb']:>10.0f} KB")
+            raise _Rollback
+    except _Rollback:
+        pass
+
+    return {
+        'meta': {
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'iterations': iterations,
+            'rows': {model.__name__.lower(): model.objects.count()
+                     for model in (Property, Unit, Tenant, Payment)},
+        },
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold=0.2, metrics=('p50_ms', 'p95_ms')):
+    """
+    Regressions of `current` against `baseline`: a latency metric that grew by more than
+    `threshold` (0.2 = 20%), or any increase in the number of queries.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        for metric in metrics:
+            if before[metric] and result[metric] > before[metric] * (1 + threshold):
+                regressions.append(f'{name}: {metric} {before[metric]} -> {result[metric]} '
+                                   f'(+{(result[metric] / before[metric] - 1) * 100:.0f}%)')
+        if result['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {result['queries']}")
+    return regressions
@@ -0,0 +1,52 @@
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils import timezone
+
+from .metrics import record_cache
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+# Backends that keep their entries inside the worker process
+PROCESS_LOCAL_BACKENDS = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+
+
+def cache_is_shared():
+    """
+    Whether every worker sees the same default cache, and so the same model versions.
+
+    With a per-process cache a bump is only seen by the worker that made it, so anything
+    that tells a client its copy is still current (ETag, Last-Modified) must be left out.
+    """
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_BACKENDS
+
+
+def model_version_key(model):
+    return f'model-version:{model._meta.label_lower}'
+
+
+def model_version(model):
+    """
+    Timestamp of the last change to any row of `model`.
+
+    Served from the cache; on a miss it is rebuilt with a single max(updated_at) query.
+    """
+    key = model_version_key(model)
+    version = cache.get(key)
+    record_cache('model_version', version is not None)
+    if version is None:
+        version = model._base_manager.aggregate(latest=Max('updated_at'))['latest'] or EPOCH
+        cache.set(key, version, None)
+    return version
+
+
+def bump_model_version(model):
+    cache.set(model_version_key(model), timezone.now(), None)
+
+
+def data_version(*models):
+    return max(model_version(model) for model in models)
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+from .caching import cache_is_shared
+
+CACHED_SESSION_ENGINES = ('django.contrib.sessions.backends.cache', 'django.contrib.sessions.backends.cached_db')
+
+
+@register(Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    if cache_is_shared():
+        return []
+    return [Error(
+        'The default cache is local to each worker process.',
+        hint='Model versions are bumped in the cache, so other workers keep serving what they cached '
+             'before a change, and conditional GET stays off. Set CACHE_BACKEND to a shared cache '
+             '(Redis, Memcached or the database cache); until then session users are not cached.',
+        id='my_app.E001',
+    )] + _check_session_engine()
+
+
+def _check_session_engine():
+    if settings.SESSION_ENGINE not in CACHED_SESSION_ENGINES:
+        return []
+    return [Error(
+        'Sessions are kept in a cache that is local to each worker process.',
+        hint='A session ended in one worker (logout, password change) stays valid in the others. '
+             'Use a shared cache, or the db session engine.',
+        id='my_app.E002',
+    )]
@@ -0,0 +1,140 @@
+"""
+Deleting properties without stalling the app.
+
+Deleting a property from the app only soft-deletes it: soft_delete_properties() stamps
+deleted_at on the properties and their units with two UPDATEs, and their default
+managers (LiveManager) hide them from then on. `manage.py purge_properties` later
+removes them for good with purge_property(). It does not use Model.delete(), whose
+collector loads every unit, tenant and status change into memory and deletes them in
+one long transaction. Instead it runs raw DELETE ... WHERE id IN (...) statements over
+batches of ids, in one short transaction per batch, so other writers are only ever
+blocked for a moment.
+
+Only CASCADE, SET_NULL and DO_NOTHING relations are supported, which covers every
+model in the app; purge_property() refuses any other on_delete rather than skip it.
+The raw DELETEs send no post_delete signals, so the files of the property's photos are
+collected up front and deleted once the rows are gone.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import audit, photos
+from .backends import invalidate_cached_user
+from .caching import bump_model_version
+from .models import Property, Unit, Tenant, Photo
+
+
+@transaction.atomic
+def soft_delete_properties(properties):
+    """Soft-delete `properties` (a queryset) and their units. Returns the number deleted."""
+    ids = list(properties.filter(deleted_at__isnull=True).values_list('pk', flat=True))
+    if not ids:
+        return 0
+    now = timezone.now()
+    Property.all_objects.filter(pk__in=ids).update(deleted_at=now, updated_at=now)
+    Unit.all_objects.filter(property_id__in=ids, deleted_at__isnull=True).update(deleted_at=now, updated_at=now)
+    audit.record_updates(Property, {pk: {'deleted_at': None} for pk in ids}, {pk: {'deleted_at': now} for pk in ids})
+    bump_model_version(Property)
+    bump_model_version(Unit)
+    return len(ids)
+
+
+@transaction.atomic
+def restore_properties(properties):
+    """Undo the soft delete of `properties` (an all_objects queryset). Returns the number restored."""
+    deleted = {pk: {'deleted_at': deleted_at}
+               for pk, deleted_at in properties.filter(deleted_at__isnull=False).values_list('pk', 'deleted_at')}
+    if not deleted:
+        return 0
+    now = timezone.now()
+    Property.all_objects.filter(pk__in=list(deleted)).update(deleted_at=None, updated_at=now)
+    Unit.all_objects.filter(property_id__in=list(deleted)).update(deleted_at=None, updated_at=now)
+    audit.record_updates(Property, deleted, {pk: {'deleted_at': None} for pk in deleted})
+    bump_model_version(Property)
+    bump_model_version(Unit)
+    return len(deleted)
+
+
+def purgeable(days=None):
+    """Properties soft-deleted more than `days` (PROPERTY_PURGE_AFTER_DAYS) days ago."""
+    days = settings.PROPERTY_PURGE_AFTER_DAYS if days is None else days
+    return Property.all_objects.filter(deleted_at__lte=timezone.now() - timedelta(days=days))
+
+
+def _execute(cursor, sql, ids):
+    placeholders = ', '.join(['%s'] * len(ids))
+    cursor.execute(sql.format(ids=placeholders), ids)
+    return cursor.rowcount
+
+
+def _delete(cursor, model, ids, touched):
+    """
+    Delete the rows of `model` with these ids, after deleting the rows that cascade from
+    them and unlinking the SET_NULL ones. Returns the number of rows deleted.
+    """
+    quote = connection.ops.quote_name
+    deleted = 0
+    for relation in model._meta.related_objects:
+        if relation.many_to_many:
+            continue
+        related = relation.related_model
+        column = quote(relation.field.column)
+        if relation.on_delete is models.CASCADE and not related._meta.related_objects:
+            deleted += _execute(cursor, f'DELETE FROM {quote(related._meta.db_table)} WHERE {column} IN ({{ids}})', ids)
+            touched.add(related)
+        elif relation.on_delete is models.CASCADE:
+            child_ids = list(related._base_manager.filter(**{f'{relation.field.attname}__in': ids})
+                             .values_list('pk', flat=True))
+            if child_ids:
+                deleted += _delete(cursor, related, child_ids, touched)
+        elif relation.on_delete is models.SET_NULL:
+            if related is Tenant:
+                # Cached session users carry their tenant profile
+                tenants = Tenant.objects.filter(**{f'{relation.field.attname}__in': ids})
+                for user_id in tenants.values_list('user_id', flat=True):
+                    invalidate_cached_user(user_id)
+            if _execute(cursor, f'UPDATE {quote(related._meta.db_table)} SET {column} = NULL '
+                                f'WHERE {column} IN ({{ids}})', ids):
+                touched.add(related)
+        elif relation.on_delete is not models.DO_NOTHING:
+            raise ValueError(f'Cannot purge {model.__name__}: {related.__name__}.{relation.field.name} '
+                             f'is {relation.on_delete.__name__}')
+    deleted += _execute(
+        cursor, f'DELETE FROM {quote(model._meta.db_table)} WHERE {quote(model._meta.pk.column)} IN ({{ids}})', ids,
+    )
+    touched.add(model)
+    return deleted
+
+
+def purge_property(property_id, batch_size=None):
+    """
+    Delete a property and everything under it for good, `batch_size` rows of each
+    table that cascades from it at a time. Returns the number of rows deleted.
+    """
+    batch_size = batch_size or settings.PROPERTY_PURGE_BATCH_SIZE
+    photo_files = photos.files(Photo.objects.filter(Q(property_id=property_id) | Q(unit__property_id=property_id)))
+    touched = set()
+    deleted = 0
+    for relation in Property._meta.related_objects:
+        if relation.on_delete is not models.CASCADE or relation.many_to_many:
+            continue
+        rows = relation.related_model._base_manager.filter(**{relation.field.attname: property_id}).order_by('pk')
+        while True:
+            ids = list(rows.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            with transaction.atomic(), connection.cursor() as cursor:
+                deleted += _delete(cursor, relation.related_model, ids, touched)
+    with transaction.atomic(), connection.cursor() as cursor:
+        name = Property.all_objects.filter(pk=property_id).values_list('name', flat=True).first()
+        deleted += _delete(cursor, Property, [property_id], touched)
+        if settings.AUDIT_ENABLED:
+            audit.record('delete', Property, property_id, {'name': (name, None)})
+    for model in touched:
+        bump_model_version(model)
+    photos.discard(photo_files)
+    return deleted
@@ -0,0 +1,228 @@
+"""
+A local stand-in for Safaricom's Daraja API, for load tests and development.
+
+It answers the OAuth, STK push and STK query endpoints and, like Safaricom, later POSTs the
+result to the push's CallBackURL. Callback delay, failure rate, duplicate (retried) and
+lost callbacks are configurable, and every callback response is tallied so a load test can
+report errors and lock contention on the app side. A lost callback is never sent, but its
+result can still be looked up with an STK query once it is due.
+"""
+import heapq
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .synthetic import fake_stk_callback
+
+
+@dataclass
+class FakeDarajaStats:
+    pushes: int = 0
+    callbacks_sent: int = 0
+    duplicate_callbacks_sent: int = 0
+    duplicate_scheduled: int = 0
+    callbacks_lost: int = 0
+    queries: int = 0
+    callback_errors: int = 0
+    callback_lock_errors: int = 0
+    callback_latency_ms: list = field(default_factory=list)
+
+    def as_dict(self):
+        latencies = sorted(self.callback_latency_ms)
+        return {
+            'pushes': self.pushes,
+            'callbacks_sent': self.callbacks_sent,
+            'duplicate_callbacks_sent': self.duplicate_callbacks_sent,
+            'callbacks_lost': self.callbacks_lost,
+            'queries': self.queries,
+            'callback_errors': self.callback_errors,
+            'callback_lock_errors': self.callback_lock_errors,
+            'callback_p50_ms': round(latencies[len(latencies) // 2], 1) if latencies else None,
+            'callback_p95_ms': round(latencies[int(len(latencies) * 0.95)], 1) if latencies else None,
+        }
+
+
+class FakeDaraja:
+    def __init__(self, host='127.0.0.1', port=8089, callback_delay=2.0, failure_rate=0.05,
+                 duplicate_rate=0.02, callback_workers=16, seed=None, loss_rate=0.0):
+        self.callback_delay = callback_delay
+        self.failure_rate = failure_rate
+        self.duplicate_rate = duplicate_rate
+        self.loss_rate = loss_rate
+        self.rng = random.Random(seed)
+        self.stats = FakeDarajaStats()
+        self.transactions = {}
+        self._lock = threading.Lock()
+        self._due = []
+        self._wakeup = threading.Condition(self._lock)
+        self._running = False
+        self._executor = ThreadPoolExecutor(max_workers=callback_workers)
+        self._session = requests.Session()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/'
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._dispatch_callbacks, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self._running = True
+        threading.Thread(target=self._dispatch_callbacks, daemon=True).start()
+        self.server.serve_forever()
+
+    def drain(self, timeout):
+        """Wait up to `timeout` seconds for every scheduled callback to be delivered."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                expected = len(self.transactions) + self.stats.duplicate_scheduled
+                if self.stats.callbacks_sent + self.stats.callbacks_lost >= expected:
+                    return True
+            time.sleep(0.1)
+        return False
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._wakeup.notify()
+        self.server.shutdown()
+        self._executor.shutdown(wait=True)
+
+    def stk_push(self, payload):
+        checkout_request_id = f'ws_CO_{uuid.uuid4().hex[:20]}'
+        with self._lock:
+            self.stats.pushes += 1
+            succeeded = self.rng.random() >= self.failure_rate
+            due = time.monotonic() + self.rng.uniform(0.5, 1.5) * self.callback_delay
+            lost = self.rng.random() < self.loss_rate
+            self.transactions[checkout_request_id] = {
+                'phone': str(payload.get('PhoneNumber', '')),
+                'amount': payload.get('Amount'),
+                'callback_url': payload.get('CallBackURL'),
+                'result_code': 0 if succeeded else 1032,
+                'due': due,
+                'lost': lost,
+                'completed': False,
+            }
+            heapq.heappush(self._due, (due, checkout_request_id, False))
+            if not lost and self.rng.random() < self.duplicate_rate:
+                heapq.heappush(self._due, (due + self.callback_delay, checkout_request_id, True))
+                self.stats.duplicate_scheduled += 1
+            self._wakeup.notify()
+        return {
+            'MerchantRequestID': f'mr-{checkout_request_id}',
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def stk_query(self, payload):
+        """(HTTP status, body) of an STK push query, as Daraja answers it."""
+        checkout_request_id = payload.get('CheckoutRequestID')
+        request_id = uuid.uuid4().hex[:20]
+        with self._lock:
+            self.stats.queries += 1
+            transaction = self.transactions.get(checkout_request_id)
+            if transaction is None:
+                return 400, {'requestId': request_id, 'errorCode': '400.002.02',
+                             'errorMessage': 'Bad Request - Invalid CheckoutRequestID'}
+            if time.monotonic() < transaction['due']:
+                return 500, {'requestId': request_id, 'errorCode': '500.001.1001',
+                             'errorMessage': 'The transaction is being processed'}
+            result_code = transaction['result_code']
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': f'mr-{checkout_request_id}',
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': 'The service request is processed successfully.' if result_code == 0
+                          else 'Request cancelled by user',
+        }
+
+    def _dispatch_callbacks(self):
+        while True:
+            with self._lock:
+                while self._running and (not self._due or self._due[0][0] > time.monotonic()):
+                    timeout = self._due[0][0] - time.monotonic() if self._due else None
+                    self._wakeup.wait(timeout)
+                if not self._running:
+                    return
+                _, checkout_request_id, duplicate = heapq.heappop(self._due)
+            self._executor.submit(self._send_callback, checkout_request_id, duplicate)
+
+    def _send_callback(self, checkout_request_id, duplicate):
+        transaction = self.transactions[checkout_request_id]
+        if transaction['lost']:
+            with self._lock:
+                transaction['completed'] = True
+                self.stats.callbacks_lost += 1
+            return
+        body = fake_stk_callback(transaction['phone'], transaction['amount'], checkout_request_id,
+                                 result_code=transaction['result_code'])
+        started = time.perf_counter()
+        try:
+            r = self._session.post(transaction['callback_url'], json=body, timeout=30)
+            result = r.json() if r.ok else {'ResultCode': r.status_code, 'ResultDesc': r.text[:200]}
+        except (requests.RequestException, ValueError) as e:
+            result = {'ResultCode': -1, 'ResultDesc': str(e)}
+        elapsed = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            transaction['completed'] = True
+            self.stats.callbacks_sent += 1
+            self.stats.duplicate_callbacks_sent += duplicate
+            self.stats.callback_latency_ms.append(elapsed)
+            if result.get('ResultCode') != 0:
+                self.stats.callback_errors += 1
+                if 'locked' in str(result.get('ResultDesc', '')):
+                    self.stats.callback_lock_errors += 1
+
+    def _handler_class(self):
+        daraja = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.startswith('/oauth/v1/generate'):
+                    return self._reply(200, {'access_token': uuid.uuid4().hex, 'expires_in': '3599'})
+                self._reply(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self._reply(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request'})
+                if self.path.startswith('/mpesa/stkpush/v1/processrequest'):
+                    return self._reply(200, daraja.stk_push(payload))
+                if self.path.startswith('/mpesa/stkpushquery/v1/query'):
+                    return self._reply(*daraja.stk_query(payload))
+                self._reply(404, {'errorMessage': 'Not found'})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,67 @@
+"""
+Money stored as whole numbers of cents.
+
+MoneyField keeps amounts in a BIGINT column, so the database sums integers, exactly and
+without per-row decimal handling, while models, forms and templates still see Decimals
+with two places. Expressions that compute new amounts should say
+output_field=MoneyField() (see rent.new_rent()); plain aggregates such as Sum('amount')
+pick it up from the column.
+"""
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from django import forms
+from django.core import exceptions
+from django.db import models
+
+CENT = Decimal('0.01')
+# 16 whole digits, so the cents still fit in a BIGINT
+MAX_AMOUNT = Decimal('9999999999999999.99')
+
+
+def to_cents(value):
+    """Whole number of cents in `value` (a Decimal, int, float or numeric string), rounded half up."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        value = repr(value)
+    return int((Decimal(value) * 100).to_integral_value(ROUND_HALF_UP))
+
+
+def from_cents(cents):
+    if cents is None:
+        return None
+    if isinstance(cents, float):
+        cents = round(cents)
+    return Decimal(cents).scaleb(-2)
+
+
+class MoneyField(models.BigIntegerField):
+    """An amount of money: a Decimal with two places, stored as an integer number of cents."""
+    description = 'Amount of money, stored in cents'
+    default_error_messages = {
+        'invalid': '“%(value)s” value must be a decimal number.',
+    }
+
+    def from_db_value(self, value, expression, connection):
+        return from_cents(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Decimal) and value.as_tuple().exponent == -2:
+            return value
+        try:
+            return Decimal(repr(value) if isinstance(value, float) else value).quantize(CENT, ROUND_HALF_UP)
+        except (InvalidOperation, TypeError, ValueError):
+            raise exceptions.ValidationError(self.error_messages['invalid'], code='invalid', params={'value': value})
+
+    def get_prep_value(self, value):
+        # Skips IntegerField.get_prep_value(), which would truncate to whole units
+        value = models.Field.get_prep_value(self, value)
+        return None if value is None else to_cents(self.to_python(value))
+
+    def formfield(self, **kwargs):
+        return models.Field.formfield(self, **{
+            'form_class': forms.DecimalField,
+            'max_digits': 18,
+            'decimal_places': 2,
+            **kwargs,
+        })
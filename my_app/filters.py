@@ -0,0 +1,130 @@
+from django.core.exceptions import BadRequest
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+
+class FilterError(BadRequest):
+    """An unusable filter parameter; answered with 400 Bad Request."""
+
+
+def id_param(params, name):
+    """An id query parameter as an int; None when missing, FilterError when not an id."""
+    value = params.get(name, '')
+    if not value:
+        return None
+    try:
+        pk = int(value)
+    except (ValueError, OverflowError):
+        raise FilterError(f'{name} must be an id')
+    # Beyond a 64-bit primary key the filter itself would fail
+    if not 0 < pk < 2 ** 63:
+        raise FilterError(f'{name} must be an id')
+    return pk
+
+
+def filter_properties(properties, params):
+    search_query = params.get('search', '')
+    if search_query:
+        properties = properties.filter(
+            Q(name__icontains=search_query) |
+            Q(address__icontains=search_query) |
+            Q(city__icontains=search_query)
+        )
+
+    status_filter = params.get('status', '')
+    if status_filter:
+        properties = properties.filter(status=status_filter)
+
+    type_filter = params.get('type', '')
+    if type_filter:
+        properties = properties.filter(property_type=type_filter)
+
+    return properties
+
+
+def filter_units(units, params):
+    search_query = params.get('search', '')
+    if search_query:
+        units = units.filter(
+            Q(unit_number__icontains=search_query) |
+            Q(property__name__icontains=search_query)
+        )
+
+    property_filter = id_param(params, 'property')
+    if property_filter:
+        units = units.filter(property_id=property_filter)
+
+    status_filter = params.get('status', '')
+    if status_filter:
+        units = units.filter(status=status_filter)
+
+    type_filter = params.get('type', '')
+    if type_filter:
+        units = units.filter(unit_type=type_filter)
+
+    return units
+
+
+def filter_tenants(tenants, params):
+    search_query = params.get('search', '')
+    if search_query:
+        tenants = tenants.filter(
+            Q(first_name__icontains=search_query) |
+            Q(last_name__icontains=search_query) |
+            Q(email__icontains=search_query) |
+            Q(phone__icontains=search_query)
+        )
+
+    status_filter = params.get('status', '')
+    if status_filter:
+        tenants = tenants.filter(status=status_filter)
+
+    property_filter = id_param(params, 'property')
+    if property_filter:
+        tenants = tenants.filter(unit__property_id=property_filter)
+
+    return tenants
+
+
+def date_param(params, name):
+    """A YYYY-MM-DD query parameter as a date; None when missing or invalid."""
+    try:
+        return parse_date(params.get(name, ''))
+    except ValueError:
+        return None
+
+
+def filter_payments(payments, params):
+    search_query = params.get('search', '')
+    if search_query:
+        payments = payments.filter(
+            Q(tenant__first_name__icontains=search_query) |
+            Q(tenant__last_name__icontains=search_query) |
+            Q(reference_number__icontains=search_query)
+        )
+
+    tenant_filter = id_param(params, 'tenant')
+    if tenant_filter:
+        payments = payments.filter(tenant_id=tenant_filter)
+
+    type_filter = params.get('type', '')
+    if type_filter:
+        payments = payments.filter(payment_type=type_filter)
+
+    method_filter = params.get('method', '')
+    if method_filter:
+        payments = payments.filter(payment_method=method_filter)
+
+    status_filter = params.get('status', '')
+    if status_filter:
+        payments = payments.filter(status=status_filter)
+
+    date_from = date_param(params, 'from')
+    if date_from:
+        payments = payments.filter(payment_date__gte=date_from)
+
+    date_to = date_param(params, 'to')
+    if date_to:
+        payments = payments.filter(payment_date__lte=date_to)
+
+    return payments
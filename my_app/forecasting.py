@@ -0,0 +1,281 @@
+"""
+Rent collection statistics and forecasts, computed with NumPy over column arrays.
+
+Payment history is fetched as plain columns (no model instances, no per-row field
+converters) and every statistic is a vectorized reduction grouped by tenant or property,
+so a portfolio of 20k tenants with five years of rent payments takes about a second.
+A forecast covers the whole portfolio or a manager's properties only (`property_ids`),
+and is cached per set of properties together with the time it was computed.
+"""
+from datetime import date
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db import connection
+from django.db.models import BooleanField, CharField, ExpressionWrapper, FloatField, Q, Value
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+
+from .models import Property, Tenant, Payment, PaymentArchive, RentSchedule, scope_key
+
+# Rent is due on the 1st of its period; paying within this many days still counts as on time
+GRACE_DAYS = 5
+# Collection rates are measured over this many months of history
+COLLECTION_WINDOW_MONTHS = 12
+
+
+def _fetch(queryset, **columns):
+    """
+    Fetch `queryset` as a NumPy structured array, one field per keyword (name=dtype).
+
+    Dates ('U10') and floats ('f8') are cast to text and float in SQL, so the driver
+    hands back plain values without per-row conversion, and NumPy builds the typed
+    columns in C. Dates are then parsed in bulk by _dates(). Amounts are fetched as
+    the integer cents they are stored as ('i8'); see cents_to_units().
+    """
+    casts = {'U10': CharField(), 'f8': FloatField()}
+    selected = {f'_{name}': Cast(name, casts[dtype]) for name, dtype in columns.items() if dtype in casts}
+    names = [f'_{name}' if dtype in casts else name for name, dtype in columns.items()]
+    try:
+        sql, params = queryset.annotate(**selected).values_list(*names).query.sql_with_params()
+    except EmptyResultSet:
+        # e.g. the scope of a manager without properties
+        return np.array([], dtype=list(columns.items()))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    return np.array(rows, dtype=list(columns.items()))
+
+
+def cents_to_units(column):
+    return column / 100
+
+
+def _dates(column):
+    """
+    Parse a column of ISO dates ('YYYY-MM-DD', NULL as 'None') into datetime64[D].
+
+    Works on the digits' code points directly, which is several times faster than
+    NumPy's general string-to-datetime conversion.
+    """
+    column = np.ascontiguousarray(column, dtype='U10')
+    digits = column.view(np.uint32).reshape(-1, 10).astype(np.int64) - ord('0')
+    missing = digits[:, 4] != ord('-') - ord('0')
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 5] * 10 + digits[:, 6]
+    day = digits[:, 8] * 10 + digits[:, 9]
+    dates = ((year - 1970) * 12 + month - 1).astype('datetime64[M]').astype('datetime64[D]')
+    dates = dates + (day - 1).astype('timedelta64[D]')
+    return np.where(missing, np.datetime64('NaT'), dates)
+
+
+def _month_start(days):
+    return days.astype('datetime64[M]').astype('datetime64[D]')
+
+
+def _add_months(day, months):
+    year, month = divmod(day.year * 12 + day.month - 1 + months, 12)
+    return date(year, month + 1, 1)
+
+
+def payment_history(property_ids=None):
+    """
+    Completed rent payments, archived ones included, of the tenants of `property_ids` (all
+    for None), as arrays: tenant id, amount, payment date, due date.
+    """
+    rows = np.concatenate([
+        _fetch(
+            model.objects.in_scope(property_ids).filter(payment_type='rent', status='completed').order_by(),
+            tenant_id='i8', amount='i8', payment_date='U10', period_start='U10',
+        )
+        for model in (Payment, PaymentArchive)
+    ])
+    paid_on = _dates(rows['payment_date'])
+    due = _dates(rows['period_start'])
+    # Payments without a period are taken to be for the month they were paid in
+    due = np.where(np.isnat(due), _month_start(paid_on), due)
+    return rows['tenant_id'], cents_to_units(rows['amount']), paid_on, due
+
+
+def tenant_statistics(tenant_ids, paid_on, due):
+    """
+    Per tenant: number of rent payments, share paid within GRACE_DAYS, and average days late.
+    Returns (unique tenant ids, counts, on-time rates, average days late).
+    """
+    unique_ids, index = np.unique(tenant_ids, return_inverse=True)
+    days_late = np.maximum((paid_on - due).astype(np.int64), 0)
+    counts = np.bincount(index, minlength=len(unique_ids))
+    on_time = np.bincount(index, weights=days_late <= GRACE_DAYS, minlength=len(unique_ids))
+    late_days = np.bincount(index, weights=days_late, minlength=len(unique_ids))
+    safe_counts = np.maximum(counts, 1)
+    return unique_ids, counts, on_time / safe_counts, late_days / safe_counts
+
+
+def _months_between(start, end):
+    """Whole months from `start` to `end` inclusive (both month-start arrays)."""
+    return (end.astype('datetime64[M]') - start.astype('datetime64[M]')).astype(np.int64) + 1
+
+
+def rent_change_corrections(tenant_ids, unit_ids, own_rent, due_from, due_until, since, property_ids=None):
+    """
+    What rent x months overstates for each tenant between `due_from` and `due_until`
+    (month starts), given the rent changes scheduled after `since`: months before a
+    change were charged its previous amount. Tenants without a rent of their own follow
+    their unit's schedule. Only changes within `property_ids` are read, when given.
+    """
+    schedules = RentSchedule.objects.filter(effective_from__gt=since)
+    if property_ids is not None:
+        schedules = schedules.filter(Q(unit__property_id__in=property_ids) | Q(tenant__unit__property_id__in=property_ids))
+    changes = _fetch(
+        schedules.order_by().annotate(
+            for_tenant=Coalesce('tenant_id', Value(0)), for_unit=Coalesce('unit_id', Value(0)),
+        ),
+        for_tenant='i8', for_unit='i8', effective_from='U10', previous_amount='i8', rent_amount='i8',
+    )
+    corrections = np.zeros(len(tenant_ids))
+    if not len(changes) or not len(tenant_ids):
+        return corrections
+    # Rent is due on the 1st, so the last month charged the previous amount is the one
+    # before the first 1st on or after the effective date
+    effective = _dates(changes['effective_from'])
+    first_new = np.where(effective == _month_start(effective), effective,
+                         (effective.astype('datetime64[M]') + 1).astype('datetime64[D]'))
+    last_old = (first_new.astype('datetime64[M]') - 1).astype('datetime64[D]')
+    delta = cents_to_units(changes['rent_amount'] - changes['previous_amount'])
+
+    # Lease schedules, matched by tenant id
+    order = np.argsort(tenant_ids)
+    position = np.clip(np.searchsorted(tenant_ids[order], changes['for_tenant']), 0, len(order) - 1)
+    matched = (changes['for_tenant'] > 0) & (tenant_ids[order][position] == changes['for_tenant'])
+    tenant_index = [order[position[matched]]]
+    change_index = [np.flatnonzero(matched)]
+
+    # Unit schedules, matched to every tenant of the unit paying the unit's rent
+    followers = np.flatnonzero(~own_rent)
+    followers = followers[np.argsort(unit_ids[followers], kind='stable')]
+    follower_units = unit_ids[followers]
+    unit_changes = np.flatnonzero(changes['for_unit'] > 0)
+    start = np.searchsorted(follower_units, changes['for_unit'][unit_changes], 'left')
+    count = np.searchsorted(follower_units, changes['for_unit'][unit_changes], 'right') - start
+    offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    tenant_index.append(followers[np.repeat(start, count) + offsets])
+    change_index.append(np.repeat(unit_changes, count))
+
+    tenant_index = np.concatenate(tenant_index)
+    change_index = np.concatenate(change_index)
+    months_old = np.maximum(_months_between(
+        due_from[tenant_index], np.minimum(due_until[tenant_index], last_old[change_index]),
+    ), 0)
+    np.add.at(corrections, tenant_index, delta[change_index] * months_old)
+    return corrections
+
+
+def compute_forecast(months=3, today=None, property_ids=None):
+    today = today or timezone.localdate()
+    this_month = today.replace(day=1)
+    window_start = np.datetime64(_add_months(this_month, -COLLECTION_WINDOW_MONTHS), 'D')
+    last_due = np.datetime64(_add_months(this_month, -1), 'D')
+
+    pay_tenants, amounts, paid_on, due = payment_history(property_ids)
+    stat_ids, counts, on_time_rate, avg_days_late = tenant_statistics(pay_tenants, paid_on, due)
+
+    tenants = _fetch(
+        Tenant.objects.in_scope(property_ids).filter(status='active', unit__isnull=False).order_by().annotate(
+            rent=Coalesce('rent_amount', 'unit__rent_amount'),
+            own_rent=ExpressionWrapper(Q(rent_amount__isnull=False), output_field=BooleanField()),
+        ),
+        pk='i8', unit_id='i8', unit__property_id='i8', rent='i8', own_rent='?',
+        lease_start_date='U10', lease_end_date='U10',
+    )
+    tenant_ids = tenants['pk']
+    tenant_property_ids = tenants['unit__property_id']
+    rent = cents_to_units(tenants['rent'])
+    lease_start = _dates(tenants['lease_start_date'])
+    lease_end = _dates(tenants['lease_end_date'])
+
+    # Collection rate: rent paid for the last COLLECTION_WINDOW_MONTHS completed months,
+    # over the rent that fell due in that time
+    in_window = (due >= window_start) & (due <= last_due)
+    order = np.argsort(tenant_ids)
+    sorted_ids = tenant_ids[order]
+    paid_in_window = np.zeros(len(tenant_ids))
+    if len(tenant_ids) and len(pay_tenants):
+        position = np.clip(np.searchsorted(sorted_ids, pay_tenants), 0, len(sorted_ids) - 1)
+        known = in_window & (sorted_ids[position] == pay_tenants)
+        paid_in_window[order] = np.bincount(position[known], weights=amounts[known], minlength=len(tenant_ids))
+
+    due_from = np.maximum(np.where(np.isnat(lease_start), window_start, _month_start(lease_start)), window_start)
+    due_until = np.minimum(np.where(np.isnat(lease_end), last_due, _month_start(lease_end)), last_due)
+    months_due = np.maximum(_months_between(due_from, due_until), 0)
+    # At today's rent, less what the rent changes scheduled in the window add
+    rent_due = rent * months_due - rent_change_corrections(
+        tenant_ids, tenants['unit_id'], tenants['own_rent'], due_from, due_until, window_start.item(), property_ids,
+    )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        collection_rate = np.clip(paid_in_window / rent_due, 0, 1)
+    portfolio_rate = paid_in_window.sum() / rent_due.sum() if rent_due.sum() else 1.0
+    # New tenants have no history yet; assume they pay like the portfolio does
+    collection_rate = np.where(rent_due > 0, collection_rate, min(portfolio_rate, 1.0))
+
+    # Expected collections: rent x collection rate for every month the lease still runs
+    forecast_months = [_add_months(this_month, k + 1) for k in range(months)]
+    month_starts = np.array(forecast_months, dtype='datetime64[D]')
+    running = np.isnat(lease_end)[:, None] | (lease_end[:, None] >= month_starts[None, :])
+    scheduled = rent[:, None] * running
+    expected = scheduled * collection_rate[:, None]
+
+    unique_properties, property_index = np.unique(tenant_property_ids, return_inverse=True)
+    expected_by_property = np.zeros((len(unique_properties), months))
+    scheduled_by_property = np.zeros((len(unique_properties), months))
+    np.add.at(expected_by_property, property_index, expected)
+    np.add.at(scheduled_by_property, property_index, scheduled)
+    names = dict(Property.objects.filter(pk__in=unique_properties.tolist()).values_list('pk', 'name'))
+
+    properties = [
+        {
+            'property_id': int(pid),
+            'name': names.get(int(pid), ''),
+            'expected': [round(v, 2) for v in expected_by_property[i].tolist()],
+            'scheduled': [round(v, 2) for v in scheduled_by_property[i].tolist()],
+            'total_expected': round(float(expected_by_property[i].sum()), 2),
+        }
+        for i, pid in enumerate(unique_properties)
+    ]
+    properties.sort(key=lambda p: p['total_expected'], reverse=True)
+
+    total_payments = counts.sum()
+    return {
+        'computed_at': timezone.now(),
+        'months': [m.strftime('%Y-%m') for m in forecast_months],
+        'portfolio': {
+            'tenants': len(tenant_ids),
+            'on_time_rate': round(float((on_time_rate * counts).sum() / total_payments * 100), 1) if total_payments else None,
+            'avg_days_late': round(float((avg_days_late * counts).sum() / total_payments), 1) if total_payments else None,
+            'collection_rate': round(float(min(portfolio_rate, 1.0)) * 100, 1),
+            'expected': [round(v, 2) for v in expected.sum(axis=0).tolist()],
+            'scheduled': [round(v, 2) for v in scheduled.sum(axis=0).tolist()],
+        },
+        'properties': properties,
+        # tenant id -> (on-time rate %, average days late, payments)
+        'tenants': dict(zip(
+            stat_ids.tolist(),
+            zip(np.round(on_time_rate * 100, 1).tolist(), np.round(avg_days_late, 1).tolist(), counts.tolist()),
+        )),
+    }
+
+
+def forecast_cache_key(months, property_ids=None):
+    key = f'forecast:collections:{months}'
+    return key if property_ids is None else f'{key}:{scope_key(property_ids)}'
+
+
+def get_forecast(months=3, refresh=False, property_ids=None):
+    """The cached forecast, recomputed when missing, older than FORECAST_CACHE_TIMEOUT or on refresh."""
+    key = forecast_cache_key(months, property_ids)
+    forecast = None if refresh else cache.get(key)
+    if forecast is None:
+        forecast = compute_forecast(months, property_ids=property_ids)
+        cache.set(key, forecast, settings.FORECAST_CACHE_TIMEOUT)
+    return forecast
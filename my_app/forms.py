@@ -1,9 +1,25 @@
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Property, Unit, Tenant, Payment
+from .models import Property, Unit, Tenant, Payment, RentAdjustment, managed_property_ids
 
 
-class PropertyForm(forms.ModelForm):
+class ScopedChoicesMixin:
+    """
+    Limits the choices of `scoped_fields` to the properties the `user` passed in manages
+    and what is under them (see ScopedQuerySet). Without a user every choice is offered.
+    """
+    scoped_fields = ()
+    
+    def __init__(self, *args, user=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user = user
+        if user is not None:
+            for name in self.scoped_fields:
+                self.fields[name].queryset = self.fields[name].queryset.for_user(user)
+
+
+class PropertyForm(ScopedChoicesMixin, forms.ModelForm):
     class Meta:
         model = Property
         fields = ['name', 'property_type', 'address', 'city', 'county', 
@@ -21,9 +37,16 @@ class PropertyForm(forms.ModelForm):
         self.fields['address'].widget.attrs['rows'] = 2
         self.fields['description'].widget.attrs['rows'] = 3
         self.fields['total_units'].widget.attrs['min'] = 0
+        if self.user is not None and managed_property_ids(self.user) is not None:
+            # Managers manage their properties themselves; only superusers hand them to someone else
+            self.fields['manager'].queryset = User.objects.filter(pk=self.user.pk)
+            self.fields['manager'].required = True
+            self.fields['manager'].empty_label = None
 
 
-class UnitForm(forms.ModelForm):
+class UnitForm(ScopedChoicesMixin, forms.ModelForm):
+    scoped_fields = ['property']
+    
     class Meta:
         model = Unit
         fields = ['property', 'unit_number', 'unit_type', 'floor', 'bedrooms', 
@@ -40,7 +63,9 @@ class UnitForm(forms.ModelForm):
         self.fields['bathrooms'].widget.attrs['min'] = 0
 
 
-class TenantForm(forms.ModelForm):
+class TenantForm(ScopedChoicesMixin, forms.ModelForm):
+    scoped_fields = ['unit']
+    
     class Meta:
         model = Tenant
         fields = ['user', 'first_name', 'last_name', 'email', 'phone', 'id_number',
@@ -62,7 +87,9 @@ class TenantForm(forms.ModelForm):
         self.fields['notes'].widget.attrs['rows'] = 3
 
 
-class PaymentForm(forms.ModelForm):
+class PaymentForm(ScopedChoicesMixin, forms.ModelForm):
+    scoped_fields = ['tenant']
+    
     class Meta:
         model = Payment
         fields = ['tenant', 'amount', 'payment_type', 'payment_method', 
@@ -80,3 +107,120 @@ class PaymentForm(forms.ModelForm):
             cls = 'form-select' if isinstance(f.widget, forms.Select) else 'form-control'
             f.widget.attrs['class'] = cls
         self.fields['description'].widget.attrs['rows'] = 2
+
+
+class PaymentBatchItemForm(PaymentForm):
+    """PaymentForm for one item of a batch; the caller resolves and sets the tenant."""
+    scoped_fields = []
+    
+    class Meta(PaymentForm.Meta):
+        fields = [f for f in PaymentForm.Meta.fields if f != 'tenant']
+
+
+class BulkActionForm(forms.Form):
+    """Selected rows of a list view plus the action to run on them."""
+    ids = forms.CharField()
+    
+    def clean_ids(self):
+        try:
+            ids = [int(pk) for pk in self.cleaned_data['ids'].split(',') if pk.strip()]
+        except ValueError:
+            raise forms.ValidationError('Invalid selection.')
+        if not ids:
+            raise forms.ValidationError('Select at least one row.')
+        return ids
+
+
+class TenantBulkActionForm(ScopedChoicesMixin, BulkActionForm):
+    scoped_fields = ['property']
+    
+    ACTIONS = [
+        ('move_out', 'Move out'),
+        ('renew', 'Renew leases'),
+        ('assign', 'Assign to vacant units'),
+    ]
+    
+    action = forms.ChoiceField(choices=ACTIONS)
+    date = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    rent_amount = forms.DecimalField(required=False, max_digits=10, decimal_places=2, min_value=0)
+    property = forms.ModelChoiceField(queryset=Property.objects.all(), required=False)
+    
+    def clean(self):
+        cleaned = super().clean()
+        if cleaned.get('action') == 'renew' and not cleaned.get('date'):
+            self.add_error('date', 'Choose the new lease end date.')
+        if cleaned.get('action') == 'assign' and not cleaned.get('property'):
+            self.add_error('property', 'Choose the property to assign units in.')
+        return cleaned
+
+
+class UnitBulkActionForm(BulkActionForm):
+    status = forms.ChoiceField(choices=Unit.STATUS_CHOICES)
+
+
+class RentAdjustmentForm(ScopedChoicesMixin, forms.ModelForm):
+    scoped_fields = ['property']
+    
+    class Meta:
+        model = RentAdjustment
+        fields = ['kind', 'amount', 'applies_to', 'effective_from', 'property', 'unit_type', 'lease_started_before']
+        widgets = {
+            'effective_from': forms.DateInput(attrs={'type': 'date'}),
+            'lease_started_before': forms.DateInput(attrs={'type': 'date'}),
+        }
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-select' if isinstance(field.widget, forms.Select) else 'form-control'
+        self.fields['property'].empty_label = 'All properties'
+        if self.user is not None and managed_property_ids(self.user) is not None:
+            # "All properties" would reach other managers' units
+            self.fields['property'].required = True
+            self.fields['property'].empty_label = None
+        self.fields['unit_type'].choices = [('', 'All unit types')] + Unit.UNIT_TYPES
+    
+    def clean(self):
+        cleaned = super().clean()
+        amount = cleaned.get('amount')
+        if amount is not None:
+            if amount == 0:
+                self.add_error('amount', 'Enter a non-zero change.')
+            elif cleaned.get('kind') == 'percent' and amount <= -100:
+                self.add_error('amount', 'A decrease must be less than 100%.')
+        return cleaned
+
+
+class MultipleImageInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleImageField(forms.ImageField):
+    """An ImageField taking several files; cleans to a list of them."""
+    
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('widget', MultipleImageInput(attrs={'accept': 'image/*'}))
+        super().__init__(*args, **kwargs)
+    
+    def clean(self, data, initial=None):
+        if isinstance(data, (list, tuple)):
+            return [super(MultipleImageField, self).clean(item, initial) for item in data]
+        return [super().clean(data, initial)]
+
+
+class PhotoUploadForm(forms.Form):
+    images = MultipleImageField()
+    caption = forms.CharField(max_length=200, required=False)
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for field in self.fields.values():
+            field.widget.attrs['class'] = 'form-control'
+    
+    def clean_images(self):
+        images = self.cleaned_data['images']
+        limit = settings.PHOTO_MAX_UPLOAD_MB * 1024 * 1024
+        too_big = [image.name for image in images if image.size > limit]
+        if too_big:
+            raise forms.ValidationError(f"{', '.join(too_big)}: photos can be at most {settings.PHOTO_MAX_UPLOAD_MB} MB.")
+        return images
@@ -0,0 +1,83 @@
+"""
+The scheduled jobs; see scheduler.py for how they are run. Times are in TIME_ZONE.
+
+The management commands behind these (archive_payments, snapshot_occupancy,
+purge_properties) still work for one-off runs.
+"""
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .archive import archive_cutoff, archive_payments, rebuild_rollups
+from .deletion import purge_property, purgeable
+from .forecasting import get_forecast
+from .mpesa import poll_stk_pushes
+from .occupancy import backfill_snapshots
+from .photos import process_pending
+from .rent import apply_due_adjustments
+from .scheduler import scheduled
+
+
+@scheduled('analyze_tables', '15 4 * * *')
+def analyze_tables(run):
+    # Keeps SQLite's row estimates current, without which it passes over partial indexes such
+    # as the vacancy search ones; PostgreSQL's autovacuum already does this
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        # Samples each index instead of reading it whole
+        cursor.execute('PRAGMA analysis_limit = 1000')
+        cursor.execute('ANALYZE')
+    return 'analyzed'
+
+
+@scheduled('apply_rent_adjustments', '5 0 * * *')
+def apply_rent_adjustments(run):
+    # Under the slot's date, like the snapshots, when a worker only gets to it later
+    return f'{apply_due_adjustments(timezone.localdate(run.slot))} adjustment(s) applied'
+
+
+@scheduled('archive_payments', '30 1 * * *', lease_seconds=300)
+def archive_old_payments(run):
+    moved, _ = archive_payments(archive_cutoff())
+    return f'{moved} payment(s) archived'
+
+
+@scheduled('poll_stk_pushes', '* * * * *')
+def poll_pending_stk_pushes(run):
+    outcomes = poll_stk_pushes()
+    return ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items())) or None
+
+
+@scheduled('process_photos', '* * * * *')
+def process_pending_photos(run):
+    outcomes = process_pending(check=run.check)
+    return ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items())) or None
+
+
+@scheduled('purge_properties', '0 2 * * *', shards=4)
+def purge_deleted_properties(run):
+    purged = 0
+    for pk in run.properties(purgeable()).order_by('pk').values_list('pk', flat=True):
+        run.check()
+        purge_property(pk)
+        purged += 1
+    return f'{purged} propert{"y" if purged == 1 else "ies"} purged'
+
+
+@scheduled('rebuild_rollups', '30 3 * * 0', lease_seconds=300)
+def rebuild_payment_rollups(run):
+    return f'{rebuild_rollups()} rollup row(s)'
+
+
+@scheduled('snapshot_occupancy', '55 23 * * *')
+def snapshot_occupancy(run):
+    # Under the slot's date, also when a worker only gets to it after midnight; days no
+    # worker got to at all are filled in from the unit status history
+    return f'{backfill_snapshots(timezone.localdate(run.slot))} snapshot row(s)'
+
+
+@scheduled('warm_forecast', '5 * * * *')
+def warm_forecast(run):
+    # Only worth it with a cache shared between the nodes (CACHE_BACKEND)
+    get_forecast(settings.FORECAST_MONTHS, refresh=True)
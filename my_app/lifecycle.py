@@ -0,0 +1,149 @@
+"""
+Bulk tenant and unit lifecycle actions: move-out, lease renewal, unit status and
+assignment to vacant units.
+
+Each action runs in one transaction as a handful of set-based statements, whatever the
+number of rows: the affected rows' old values are read with one values() query (for
+the audit trail and the occupancy history), the change is a single queryset.update(),
+and Unit.is_occupied, UnitStatusChange, the model versions and cached users are kept
+in step the way the per-object save() path would.
+"""
+from django.db import transaction
+from django.db.models import Case, Exists, OuterRef, Value, When
+from django.utils import timezone
+
+from . import audit
+from .backends import invalidate_cached_user
+from .caching import bump_model_version
+from .models import Unit, Tenant, UnitStatusChange, RentSchedule
+
+# Statuses a unit with an active tenant may have
+LIVED_IN_STATUSES = ('occupied', 'maintenance')
+
+
+def _snapshot(queryset, *fields):
+    """{pk: {field: value}} for the rows of `queryset`, locked until the transaction ends."""
+    return {row.pop('pk'): row for row in queryset.select_for_update().values('pk', *fields)}
+
+
+def _active_tenant(unit_ref='pk'):
+    return Exists(Tenant.objects.filter(unit_id=OuterRef(unit_ref), status='active'))
+
+
+def _set_unit_status(units, status):
+    """Set the status of `units` (a queryset), recording the history. Returns the count changed."""
+    before = _snapshot(units.exclude(status=status), 'status', 'is_occupied')
+    if not before:
+        return 0
+    occupied = status == 'occupied'
+    Unit.objects.filter(pk__in=list(before)).update(status=status, is_occupied=occupied, updated_at=timezone.now())
+    UnitStatusChange.objects.bulk_create([
+        UnitStatusChange(unit_id=pk, old_status=old['status'], new_status=status) for pk, old in before.items()
+    ])
+    audit.record_updates(Unit, before, {pk: {'status': status, 'is_occupied': occupied} for pk in before})
+    bump_model_version(Unit)
+    return len(before)
+
+
+def _free_units(unit_ids):
+    """Mark the occupied units among `unit_ids` that no active tenant lives in any more available."""
+    units = Unit.objects.filter(pk__in=unit_ids, status='occupied').exclude(_active_tenant())
+    return _set_unit_status(units, 'available')
+
+
+def _tenants_changed(before):
+    # Cached session users carry their tenant profile
+    for row in before.values():
+        invalidate_cached_user(row.get('user_id'))
+    bump_model_version(Tenant)
+
+
+@transaction.atomic
+def move_out(tenants, move_out_date=None):
+    """
+    Move active and pending tenants out: inactive, lease ending `move_out_date` (today by
+    default). They keep their unit for the record; units left empty become available.
+    Returns (tenants moved out, units freed).
+    """
+    move_out_date = move_out_date or timezone.localdate()
+    before = _snapshot(tenants.filter(status__in=['active', 'pending']), 'status', 'lease_end_date', 'unit_id', 'user_id')
+    if not before:
+        return 0, 0
+    Tenant.objects.filter(pk__in=list(before)).update(
+        status='inactive', lease_end_date=move_out_date, updated_at=timezone.now()
+    )
+    audit.record_updates(Tenant, before, {pk: {'status': 'inactive', 'lease_end_date': move_out_date} for pk in before})
+    _tenants_changed(before)
+    freed = _free_units({row['unit_id'] for row in before.values() if row['unit_id']})
+    return len(before), freed
+
+
+@transaction.atomic
+def renew_leases(tenants, end_date, rent_amount=None):
+    """
+    Extend the leases of `tenants` to `end_date`, optionally at a new rent scheduled from
+    today. Tenants whose lease starts on or after `end_date` are left alone. Returns the
+    number renewed.
+    """
+    tenants = tenants.exclude(status='inactive').filter(lease_start_date__lt=end_date)
+    values = {'lease_end_date': end_date}
+    if rent_amount is not None:
+        values['rent_amount'] = rent_amount
+    before = _snapshot(tenants, 'user_id', *values)
+    if not before:
+        return 0
+    Tenant.objects.filter(pk__in=list(before)).update(**values, updated_at=timezone.now())
+    if rent_amount is not None:
+        RentSchedule.objects.bulk_create([
+            RentSchedule(tenant_id=pk, effective_from=timezone.localdate(),
+                         previous_amount=row['rent_amount'], rent_amount=rent_amount)
+            for pk, row in before.items() if row['rent_amount'] is not None and row['rent_amount'] != rent_amount
+        ])
+    audit.record_updates(Tenant, before, {pk: values for pk in before})
+    _tenants_changed(before)
+    return len(before)
+
+
+@transaction.atomic
+def set_unit_status(units, status):
+    """
+    Set the status of `units`. Units with an active tenant can only be occupied or under
+    maintenance. Returns (units changed, units skipped because of their tenant).
+    """
+    if status not in LIVED_IN_STATUSES:
+        lived_in = units.filter(_active_tenant())
+        skipped = lived_in.count()
+        units = units.exclude(pk__in=lived_in.values('pk'))
+    else:
+        skipped = 0
+    return _set_unit_status(units, status), skipped
+
+
+@transaction.atomic
+def assign_to_vacant_units(tenants, property_obj):
+    """
+    Give each of `tenants` (by name) one of the available, empty units of `property_obj`
+    (by unit number) and make them active. Units they leave become available.
+    Returns (tenants assigned, tenants left over for lack of units).
+    """
+    before = _snapshot(tenants.exclude(status='inactive').order_by('last_name', 'first_name'),
+                       'unit_id', 'status', 'user_id')
+    vacant = list(
+        Unit.objects.filter(property=property_obj, status='available')
+        .exclude(_active_tenant()).order_by('unit_number').values_list('pk', flat=True)[:len(before)]
+    )
+    pairs = dict(zip(before, vacant))
+    if not pairs:
+        return 0, len(before)
+    Tenant.objects.filter(pk__in=list(pairs)).update(
+        unit_id=Case(*[When(pk=tenant_id, then=Value(unit_id)) for tenant_id, unit_id in pairs.items()]),
+        last_property_id=property_obj.pk,
+        status='active',
+        updated_at=timezone.now(),
+    )
+    assigned = {pk: before[pk] for pk in pairs}
+    audit.record_updates(Tenant, assigned, {pk: {'unit_id': unit_id, 'status': 'active'} for pk, unit_id in pairs.items()})
+    _tenants_changed(assigned)
+    _set_unit_status(Unit.objects.filter(pk__in=vacant), 'occupied')
+    _free_units({row['unit_id'] for row in assigned.values() if row['unit_id']})
+    return len(pairs), len(before) - len(pairs)
@@ -0,0 +1,314 @@
+"""
+Month-start payment storm: a load scenario run against a live server.
+
+Each virtual user is a tenant who logs in, opens the tenant dashboard and the M-Pesa page,
+starts an STK push and long-polls its status while the Daraja side (usually FakeDaraja)
+fires the callbacks back at the server. The run reports throughput, error rate, SQLite/
+row lock contention and payments that were recorded more than once.
+
+Virtual users talk HTTP only; the database is read directly just to prepare the tenant
+logins beforehand and to count duplicate payments afterwards, so the server under test
+must use the same database.
+"""
+import math
+import random
+import re
+import statistics
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from urllib.parse import urljoin
+
+import requests
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
+from django.urls import reverse
+from django.utils import timezone
+
+from .backends import invalidate_cached_user
+from .caching import bump_model_version
+from .models import Tenant, Payment
+
+USERNAME_PREFIX = 'loadtest-tenant-'
+DEFAULT_PASSWORD = 'loadtest-password'
+LOCK_PATTERN = re.compile(r'database is locked|deadlock|lock wait timeout|could not obtain lock', re.I)
+
+
+@dataclass
+class LoadTestSpec:
+    base_url: str = 'http://127.0.0.1:8000/'
+    users: int = 50
+    spawn_rate: float = 10.0
+    iterations: int = 1
+    think_time: float = 1.0
+    status_wait: float = 20.0
+    password: str = DEFAULT_PASSWORD
+    timeout: float = 60.0
+    seed: int = None
+
+
+@dataclass
+class LoadTestStats:
+    latencies_ms: dict = field(default_factory=lambda: defaultdict(list))
+    requests: dict = field(default_factory=lambda: defaultdict(int))
+    errors: dict = field(default_factory=lambda: defaultdict(int))
+    lock_errors: int = 0
+    payments_completed: int = 0
+    payments_failed: int = 0
+    payments_timed_out: int = 0
+    error_samples: list = field(default_factory=list)
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def record(self, step, elapsed_ms, error=None):
+        with self._lock:
+            self.requests[step] += 1
+            self.latencies_ms[step].append(elapsed_ms)
+        if error:
+            self.fail(step, error)
+
+    def fail(self, step, error):
+        """Count an error for a request that has already been recorded (e.g. a 200 with success=false)."""
+        with self._lock:
+            self.errors[step] += 1
+            if LOCK_PATTERN.search(error):
+                self.lock_errors += 1
+            if len(self.error_samples) < 20:
+                self.error_samples.append(f'{step}: {error[:200]}')
+
+    def outcome(self, status):
+        with self._lock:
+            if status == 'completed':
+                self.payments_completed += 1
+            elif status == 'pending':
+                self.payments_timed_out += 1
+            else:
+                self.payments_failed += 1
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def prepare_users(count, password=DEFAULT_PASSWORD):
+    """
+    Give `count` active tenants a login (loadtest-tenant-<tenant id>), reusing ones made by
+    earlier runs. All accounts share one password hash so preparing thousands stays fast.
+    """
+    existing = list(Tenant.objects.filter(user__username__startswith=USERNAME_PREFIX)
+                    .order_by('pk').values_list('pk', flat=True)[:count])
+    missing = count - len(existing)
+    if missing > 0:
+        tenants = list(Tenant.objects.filter(status='active', user__isnull=True)
+                       .exclude(phone='').order_by('pk')[:missing])
+        password_hash = make_password(password)
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'{USERNAME_PREFIX}{tenant.pk}', first_name=tenant.first_name,
+                     last_name=tenant.last_name, password=password_hash)
+                for tenant in tenants
+            ])
+            for tenant, user in zip(tenants, users):
+                tenant.user = user
+            Tenant.objects.bulk_update(tenants, ['user'])
+        bump_model_version(Tenant)
+        existing += [tenant.pk for tenant in tenants]
+    return existing
+
+
+def cleanup_users():
+    """Delete the load-test logins; the tenants themselves are kept."""
+    user_ids = list(User.objects.filter(username__startswith=USERNAME_PREFIX).values_list('pk', flat=True))
+    Tenant.objects.filter(user_id__in=user_ids).update(user=None)
+    deleted, _ = User.objects.filter(pk__in=user_ids).delete()
+    for user_id in user_ids:
+        invalidate_cached_user(user_id)
+    bump_model_version(Tenant)
+    return deleted
+
+
+def duplicate_payments(since):
+    """
+    Payments created since `since` that share a checkout request or an M-Pesa receipt
+    with another payment, i.e. the same money recorded twice.
+    """
+    recent = Payment.objects.filter(created_at__gte=since)
+    by_checkout = (recent.exclude(checkout_request_id='').values('checkout_request_id')
+                   .annotate(n=Count('pk')).filter(n__gt=1))
+    by_receipt = (recent.filter(payment_method='mpesa').exclude(reference_number='')
+                  .values('reference_number').annotate(n=Count('pk')).filter(n__gt=1))
+    return {
+        'payments_created': recent.count(),
+        'duplicate_checkout_requests': by_checkout.count(),
+        'duplicate_receipts': by_receipt.count(),
+        'extra_payments': sum(row['n'] - 1 for row in by_checkout),
+    }
+
+
+class VirtualTenant:
+    def __init__(self, spec, stats, tenant, rng):
+        self.spec = spec
+        self.stats = stats
+        self.tenant_id = tenant.pk
+        self.phone = tenant.phone
+        self.amount = max(1, int(tenant.rent_amount or 1))
+        self.rng = rng
+        self.session = requests.Session()
+
+    def _request(self, step, method, path, **kwargs):
+        kwargs.setdefault('timeout', self.spec.timeout)
+        started = time.perf_counter()
+        error = None
+        response = None
+        try:
+            response = self.session.request(method, urljoin(self.spec.base_url, path), **kwargs)
+            if response.status_code >= 400:
+                error = f'HTTP {response.status_code}: {response.text}'
+        except requests.RequestException as e:
+            error = str(e)
+        self.stats.record(step, (time.perf_counter() - started) * 1000, error)
+        return response if error is None else None
+
+    def _think(self):
+        if self.spec.think_time:
+            time.sleep(self.rng.uniform(0.5, 1.5) * self.spec.think_time)
+
+    def login(self):
+        self._request('login_page', 'GET', reverse('login_page'))
+        response = self._request('login', 'POST', reverse('login_page'), data={
+            'username': f'{USERNAME_PREFIX}{self.tenant_id}',
+            'password': self.spec.password,
+            'csrfmiddlewaretoken': self.session.cookies.get('csrftoken', ''),
+        }, headers={'Referer': urljoin(self.spec.base_url, reverse('login_page'))})
+        return response is not None and 'sessionid' in self.session.cookies
+
+    def pay_rent(self):
+        payment_page = reverse('mpesa_payment', args=[self.tenant_id])
+        self._request('tenant_dashboard', 'GET', reverse('tenant_dashboard'))
+        self._think()
+        if self._request('mpesa_payment', 'GET', payment_page) is None:
+            return
+        self._think()
+
+        response = self._request('mpesa_stk_push', 'POST', reverse('mpesa_stk_push'), json={
+            'phone_number': self.phone,
+            'amount': self.amount,
+            'tenant_id': self.tenant_id,
+        }, headers={
+            'X-CSRFToken': self.session.cookies.get('csrftoken', ''),
+            'Referer': urljoin(self.spec.base_url, payment_page),
+        })
+        body = response.json() if response is not None else {}
+        checkout_request_id = body.get('checkout_request_id')
+        if not body.get('success') or not checkout_request_id:
+            if response is not None:
+                self.stats.fail('mpesa_stk_push', body.get('error') or 'STK push rejected')
+            return
+
+        deadline = time.monotonic() + self.spec.status_wait
+        status = 'pending'
+        while status == 'pending' and time.monotonic() < deadline:
+            wait = max(1, min(25, deadline - time.monotonic()))
+            response = self._request('mpesa_payment_status', 'GET',
+                                     reverse('mpesa_payment_status', args=[checkout_request_id]),
+                                     params={'wait': wait},
+                                     timeout=wait + self.spec.timeout)
+            if response is None:
+                return
+            status = response.json().get('status')
+        self.stats.outcome(status)
+
+    def run(self):
+        try:
+            if not self.login():
+                return
+            for _ in range(self.spec.iterations):
+                self.pay_rent()
+                self._think()
+        except Exception as e:
+            self.stats.fail('virtual_user', repr(e))
+
+
+def run_load_test(spec, daraja=None, stdout=None):
+    """
+    Run the scenario. With `daraja` (a started FakeDaraja) the report also covers the
+    callback side, after waiting up to spec.status_wait for callbacks still in flight.
+    """
+    tenant_ids = prepare_users(spec.users, spec.password)
+    if len(tenant_ids) < spec.users:
+        raise ValueError(f'Only {len(tenant_ids)} active tenants with a phone number are available; '
+                         'run generate_portfolio with more properties.')
+    tenants = Tenant.objects.in_bulk(tenant_ids)
+    rng = random.Random(spec.seed)
+    stats = LoadTestStats()
+    since = timezone.now()
+
+    users = [VirtualTenant(spec, stats, tenants[tenant_id], random.Random(rng.random()))
+             for tenant_id in tenant_ids]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=spec.users) as executor:
+        for user in users:
+            executor.submit(user.run)
+            if spec.spawn_rate:
+                time.sleep(1 / spec.spawn_rate)
+    elapsed = time.perf_counter() - started
+
+    callbacks = None
+    if daraja is not None:
+        daraja.drain(spec.status_wait)
+        callbacks = daraja.stats.as_dict()
+    return report(stats, elapsed, duplicate_payments(since), callbacks, stdout)
+
+
+def report(stats, elapsed, duplicates, callbacks=None, stdout=None):
+    total = sum(stats.requests.values())
+    errors = sum(stats.errors.values())
+    steps = {}
+    for step, latencies in sorted(stats.latencies_ms.items()):
+        steps[step] = {
+            'requests': stats.requests[step],
+            'errors': stats.errors[step],
+            'p50_ms': round(_percentile(latencies, 50), 1),
+            'p95_ms': round(_percentile(latencies, 95), 1),
+            'p99_ms': round(_percentile(latencies, 99), 1),
+            'mean_ms': round(statistics.fmean(latencies), 1),
+        }
+    result = {
+        'elapsed_s': round(elapsed, 2),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+        'errors': errors,
+        'error_rate': round(errors / total, 4) if total else 0,
+        'lock_errors': stats.lock_errors + (callbacks['callback_lock_errors'] if callbacks else 0),
+        'payments': {
+            'completed': stats.payments_completed,
+            'failed': stats.payments_failed,
+            'timed_out': stats.payments_timed_out,
+            **duplicates,
+        },
+        'steps': steps,
+        'callbacks': callbacks,
+        'error_samples': stats.error_samples,
+    }
+
+    if stdout:
+        for step, r in steps.items():
+            stdout.write(f"{step:<26} {r['requests']:>6} req {r['errors']:>5} err "
+                         f"p50 {r['p50_ms']:>8.1f}ms p95 {r['p95_ms']:>8.1f}ms p99 {r['p99_ms']:>8.1f}ms")
+        stdout.write(f"{total} requests in {result['elapsed_s']}s ({result['throughput_rps']} req/s), "
+                     f"error rate {result['error_rate']:.2%}, {result['lock_errors']} lock errors")
+        if callbacks:
+            stdout.write(f"callbacks: {callbacks['callbacks_sent']} sent "
+                         f"({callbacks['duplicate_callbacks_sent']} retries), "
+                         f"{callbacks['callback_errors']} rejected, p95 {callbacks['callback_p95_ms']}ms")
+        payments = result['payments']
+        stdout.write(f"payments: {payments['completed']} completed, {payments['failed']} failed, "
+                     f"{payments['timed_out']} timed out, {payments['extra_payments']} duplicates")
+    return result
@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from my_app.archive import archive_cutoff, archive_payments, rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Move completed payments older than PAYMENT_ARCHIVE_AFTER_MONTHS to the archive. Run it nightly.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.PAYMENT_ARCHIVE_AFTER_MONTHS,
+                            help='Keep this many whole months of payments live')
+        parser.add_argument('--batch-size', type=int, default=settings.PAYMENT_ARCHIVE_BATCH_SIZE)
+        parser.add_argument('--rebuild-rollups', action='store_true',
+                            help='Recompute the monthly rollups of the whole archive afterwards')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        cutoff = archive_cutoff(options['months'])
+        self.stdout.write(f'Archiving completed payments dated before {cutoff}')
+        moved, rollups = archive_payments(cutoff, options['batch_size'], log=self.stdout.write)
+        if options['rebuild_rollups']:
+            rollups = rebuild_rollups()
+        self.stdout.write(self.style.SUCCESS(
+            f'Archived {moved} payment(s), wrote {rollups} rollup row(s) in {time.perf_counter() - started:.1f}s'
+        ))
@@ -0,0 +1,58 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment
+
+from my_app.benchmarks import compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the views against the current database and compare with a baseline. '
+            'Populate the database with generate_portfolio first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=10)
+        parser.add_argument('--warmup', type=int, default=2)
+        parser.add_argument('--only', default='',
+                            help='Comma separated scenario names to run (default: all)')
+        parser.add_argument('--output', default='bench_output.json',
+                            help='Where to write the results as JSON')
+        parser.add_argument('--baseline', help='Results file to compare against')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='Allowed latency growth over the baseline (0.2 = 20%%)')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Also write the results to --baseline')
+
+    def handle(self, *args, **options):
+        # Lets the test client talk to 'testserver' regardless of ALLOWED_HOSTS
+        setup_test_environment()
+
+        only = {name.strip() for name in options['only'].split(',') if name.strip()}
+        results = run_benchmarks(
+            iterations=options['iterations'], warmup=options['warmup'],
+            only=only, stdout=self.stdout,
+        )
+
+        Path(options['output']).write_text(json.dumps(results, indent=2))
+        self.stdout.write(f"Results written to {options['output']}")
+
+        baseline_path = options['baseline']
+        if not baseline_path:
+            return
+        baseline_path = Path(baseline_path)
+
+        if options['save_baseline']:
+            baseline_path.write_text(json.dumps(results, indent=2))
+            self.stdout.write(f'Baseline saved to {baseline_path}')
+            return
+
+        if not baseline_path.exists():
+            raise CommandError(f'Baseline {baseline_path} does not exist (use --save-baseline)')
+
+        regressions = compare(results, json.loads(baseline_path.read_text()), options['threshold'])
+        if regressions:
+            for line in regressions:
+                self.stderr.write(line)
+            raise CommandError(f'{len(regressions)} regression(s) over the baseline')
+        self.stdout.write(self.style.SUCCESS('No regressions over the baseline'))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from my_app.fake_daraja import FakeDaraja
+
+
+class Command(BaseCommand):
+    help = ('Run a fake Daraja API for load tests. Start the app with '
+            'MPESA_API_BASE_URL=http://<host>:<port>/ so STK pushes go here.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--callback-delay', type=float, default=2.0,
+                            help='Average seconds between an STK push and its callback')
+        parser.add_argument('--failure-rate', type=float, default=0.05,
+                            help='Share of pushes the customer cancels (ResultCode 1032)')
+        parser.add_argument('--duplicate-rate', type=float, default=0.02,
+                            help='Share of callbacks that are sent a second time')
+        parser.add_argument('--loss-rate', type=float, default=0.0,
+                            help='Share of callbacks that are never sent (the STK query still answers)')
+        parser.add_argument('--seed', type=int)
+
+    def handle(self, *args, **options):
+        daraja = FakeDaraja(
+            host=options['host'], port=options['port'], callback_delay=options['callback_delay'],
+            failure_rate=options['failure_rate'], duplicate_rate=options['duplicate_rate'],
+            seed=options['seed'], loss_rate=options['loss_rate'],
+        )
+        self.stdout.write(f'Fake Daraja listening on {daraja.url} (Ctrl+C to stop)')
+        try:
+            daraja.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daraja.stop()
+            for name, value in daraja.stats.as_dict().items():
+                self.stdout.write(f'{name}: {value}')
@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from my_app.forecasting import get_forecast
+
+
+class Command(BaseCommand):
+    help = 'Compute the rent collections forecast shown on the financial report and cache it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.FORECAST_MONTHS)
+        parser.add_argument('--refresh', action='store_true', help='Recompute even if a cached forecast exists')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        forecast = get_forecast(options['months'], refresh=options['refresh'])
+        portfolio = forecast['portfolio']
+        self.stdout.write(f"Forecast computed at {forecast['computed_at']:%Y-%m-%d %H:%M} "
+                          f"({time.perf_counter() - started:.2f}s)")
+        self.stdout.write(f"{portfolio['tenants']} active tenants, collection rate {portfolio['collection_rate']}%, "
+                          f"on time {portfolio['on_time_rate']}%, {portfolio['avg_days_late']} days late on average")
+        for month, scheduled, expected in zip(forecast['months'], portfolio['scheduled'], portfolio['expected']):
+            self.stdout.write(f'{month}: expected KES {expected:,.0f} of {scheduled:,.0f} scheduled')
@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from my_app.synthetic import PortfolioSpec, clear_portfolio, generate_portfolio, parse_method_mix
+
+
+class Command(BaseCommand):
+    help = 'Generate a seeded synthetic portfolio (properties, units, tenants, payments) for load testing'
+
+    def add_arguments(self, parser):
+        defaults = PortfolioSpec()
+        parser.add_argument('--properties', type=int, default=defaults.properties)
+        parser.add_argument('--units-per-property', type=int, default=defaults.units_per_property)
+        parser.add_argument('--years', type=int, default=defaults.years,
+                            help='Years of monthly payment history')
+        parser.add_argument('--occupancy', type=float, default=defaults.occupancy,
+                            help='Share of units that are currently occupied (0-1)')
+        parser.add_argument('--managers', type=int, default=defaults.managers,
+                            help='Staff users to create and assign properties to round-robin')
+        parser.add_argument('--method-mix', default='mpesa=0.7,bank_transfer=0.2,cash=0.1',
+                            help='Payment method weights, e.g. mpesa=0.7,bank_transfer=0.2,cash=0.1')
+        parser.add_argument('--seed', type=int, default=defaults.seed)
+        parser.add_argument('--batch-size', type=int, default=defaults.batch_size)
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete all existing properties, units, tenants and payments first')
+
+    def handle(self, *args, **options):
+        try:
+            method_mix = parse_method_mix(options['method_mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        
+        spec = PortfolioSpec(
+            properties=options['properties'],
+            units_per_property=options['units_per_property'],
+            years=options['years'],
+            occupancy=options['occupancy'],
+            managers=options['managers'],
+            method_mix=method_mix,
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+        )
+        
+        if options['clear']:
+            self.stdout.write('Clearing existing portfolio...')
+            clear_portfolio()
+        
+        started = time.perf_counter()
+        self.stdout.write('Generating portfolio...')
+        counts = generate_portfolio(spec, stdout=self.stdout)
+        elapsed = time.perf_counter() - started
+        
+        summary = ', '.join(f'{count} {name}' for name, count in counts.items())
+        self.stdout.write(self.style.SUCCESS(f'Created {summary} in {elapsed:.1f}s'))
@@ -0,0 +1,74 @@
+import json
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from my_app.fake_daraja import FakeDaraja
+from my_app.loadtest import DEFAULT_PASSWORD, LoadTestSpec, cleanup_users, run_load_test
+
+
+class Command(BaseCommand):
+    help = ('Replay a month-start payment storm (login, tenant dashboard, STK push, status '
+            'long-poll, callbacks) against a running server that uses this database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default='http://127.0.0.1:8000/')
+        parser.add_argument('--users', type=int, default=50, help='Concurrent tenants')
+        parser.add_argument('--spawn-rate', type=float, default=10.0, help='Tenants started per second')
+        parser.add_argument('--iterations', type=int, default=1, help='Payments per tenant')
+        parser.add_argument('--think-time', type=float, default=1.0,
+                            help='Average seconds between a tenant\'s requests')
+        parser.add_argument('--status-wait', type=float, default=20.0,
+                            help='Seconds to wait for a payment callback')
+        parser.add_argument('--password', default=DEFAULT_PASSWORD)
+        parser.add_argument('--seed', type=int)
+        parser.add_argument('--fake-daraja', metavar='HOST:PORT',
+                            help='Also run a fake Daraja API here; the server must be started with '
+                                 'MPESA_API_BASE_URL pointing at it')
+        parser.add_argument('--callback-delay', type=float, default=2.0)
+        parser.add_argument('--failure-rate', type=float, default=0.05)
+        parser.add_argument('--duplicate-rate', type=float, default=0.02)
+        parser.add_argument('--output', help='Write the report as JSON to this file')
+        parser.add_argument('--max-error-rate', type=float,
+                            help='Fail if the error rate is higher (0.01 = 1%%)')
+        parser.add_argument('--cleanup', action='store_true',
+                            help='Delete the loadtest-tenant-* logins and exit')
+
+    def handle(self, *args, **options):
+        if options['cleanup']:
+            self.stdout.write(f'Deleted {cleanup_users()} load test login(s)')
+            return
+
+        spec = LoadTestSpec(
+            base_url=options['base_url'], users=options['users'], spawn_rate=options['spawn_rate'],
+            iterations=options['iterations'], think_time=options['think_time'],
+            status_wait=options['status_wait'], password=options['password'], seed=options['seed'],
+        )
+
+        daraja = None
+        if options['fake_daraja']:
+            host, _, port = options['fake_daraja'].rpartition(':')
+            daraja = FakeDaraja(
+                host=host or '127.0.0.1', port=int(port), callback_delay=options['callback_delay'],
+                failure_rate=options['failure_rate'], duplicate_rate=options['duplicate_rate'],
+                seed=options['seed'],
+            ).start()
+            self.stdout.write(f'Fake Daraja listening on {daraja.url}')
+
+        try:
+            result = run_load_test(spec, daraja=daraja, stdout=self.stdout)
+        except ValueError as e:
+            raise CommandError(e)
+        finally:
+            if daraja is not None:
+                daraja.stop()
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(result, indent=2))
+            self.stdout.write(f"Report written to {options['output']}")
+
+        if result['payments']['extra_payments']:
+            self.stderr.write(f"{result['payments']['extra_payments']} payment(s) recorded twice")
+        max_error_rate = options['max_error_rate']
+        if max_error_rate is not None and result['error_rate'] > max_error_rate:
+            raise CommandError(f"Error rate {result['error_rate']:.2%} is over {max_error_rate:.2%}")
@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_daraja.mpesa.exceptions import MpesaConnectionError
+
+from my_app.mpesa import poll_stk_pushes
+
+
+class Command(BaseCommand):
+    help = ('Look up STK pushes whose callback never came with the STK query API and record their '
+            'outcome. The poll_stk_pushes job (run_scheduler) does this every minute.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=settings.MPESA_STK_QUERY_AFTER_SECONDS,
+                            help='Only pushes sent, or last queried, at least this many seconds ago')
+        parser.add_argument('--concurrency', type=int, default=settings.MPESA_STK_QUERY_CONCURRENCY)
+
+    def handle(self, *args, **options):
+        try:
+            outcomes = poll_stk_pushes(older_than=options['older_than'], concurrency=options['concurrency'])
+        except MpesaConnectionError as e:
+            raise CommandError(f'Could not reach Daraja: {e}')
+        summary = ', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))
+        self.stdout.write(self.style.SUCCESS(f'Polled {sum(outcomes.values())} STK push(es){f": {summary}" if summary else ""}'))
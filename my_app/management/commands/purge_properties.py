@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from my_app.deletion import purge_property, purgeable
+from my_app.models import Property
+
+
+class Command(BaseCommand):
+    help = ('Permanently remove properties deleted more than PROPERTY_PURGE_AFTER_DAYS days ago, '
+            'with their units and history. Run it nightly.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.PROPERTY_PURGE_AFTER_DAYS,
+                            help='Purge properties deleted at least this many days ago')
+        parser.add_argument('--id', type=int, action='append', dest='ids',
+                            help='Purge this deleted property now, whenever it was deleted (repeatable)')
+        parser.add_argument('--batch-size', type=int, default=settings.PROPERTY_PURGE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['ids']:
+            properties = Property.all_objects.filter(pk__in=options['ids'])
+            live = list(properties.filter(deleted_at__isnull=True).values_list('pk', flat=True))
+            if live:
+                raise CommandError(f'Not deleted, refusing to purge: {", ".join(map(str, live))}')
+        else:
+            properties = purgeable(options['days'])
+
+        for pk, name in properties.order_by('deleted_at').values_list('pk', 'name'):
+            started = time.perf_counter()
+            rows = purge_property(pk, options['batch_size'])
+            self.stdout.write(f'  {name} (#{pk}): {rows} row(s) in {time.perf_counter() - started:.1f}s')
+        self.stdout.write(self.style.SUCCESS('Done'))
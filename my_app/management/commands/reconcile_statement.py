@@ -0,0 +1,80 @@
+import sys
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from my_app.reconciliation import (
+    CREATED, DUPLICATE, INVALID, MATCHED, MATCHED_FUZZY, MISSING, SKIPPED, STATEMENT_FORMATS, UNMATCHED,
+    Reconciler, StatementError, write_report,
+)
+
+OUTCOMES = [MATCHED, MATCHED_FUZZY, CREATED, MISSING, UNMATCHED, DUPLICATE, SKIPPED, INVALID]
+
+
+class _DryRun(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Reconcile an M-Pesa or bank statement CSV against recorded payments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('statement', help='Path to the statement CSV ("-" for stdin)')
+        parser.add_argument('--format', choices=sorted(STATEMENT_FORMATS), default='mpesa')
+        parser.add_argument('--date-window', type=int, default=3,
+                            help='Days either side of the statement date a payment may be recorded on')
+        parser.add_argument('--amount-tolerance', type=Decimal, default=Decimal('0'),
+                            help='Largest difference in KES between statement and recorded amount')
+        parser.add_argument('--create-missing', action='store_true',
+                            help='Record payments for credits from known tenants that match nothing')
+        parser.add_argument('--dry-run', action='store_true', help='With --create-missing, roll back at the end')
+        parser.add_argument('--report', help='Write a CSV with the outcome of every line to this path')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--user', help='Username the created payments are recorded under in the audit trail')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"Unknown user: {options['user']}")
+        reconciler = Reconciler(
+            statement_format=options['format'],
+            date_window=options['date_window'],
+            amount_tolerance=options['amount_tolerance'],
+            create_missing=options['create_missing'],
+            chunk_size=options['chunk_size'],
+            user=user,
+        )
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                self._run(reconciler, options)
+                if options['dry_run']:
+                    raise _DryRun
+        except _DryRun:
+            self.stdout.write(self.style.WARNING('Dry run: created payments were rolled back'))
+        except (StatementError, OSError) as e:
+            raise CommandError(str(e))
+
+        summary = reconciler.summary
+        total = sum(summary.counts.values())
+        self.stdout.write(f'{total} statement lines in {time.perf_counter() - started:.2f}s')
+        for outcome in OUTCOMES:
+            if summary.counts[outcome]:
+                self.stdout.write(f'{outcome:<14} {summary.counts[outcome]:>8}  KES {summary.amounts[outcome]:>14,.2f}')
+
+    def _run(self, reconciler, options):
+        statement = sys.stdin if options['statement'] == '-' else open(options['statement'], newline='', encoding='utf-8-sig')
+        with statement:
+            results = reconciler.reconcile(statement)
+            if options['report']:
+                with open(options['report'], 'w', newline='') as out:
+                    write_report(results, out)
+            else:
+                for _ in results:
+                    pass
@@ -0,0 +1,47 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from my_app.models import JobLease
+from my_app.scheduler import registered_jobs, run_worker
+
+
+class Command(BaseCommand):
+    help = ('Run the scheduled jobs (my_app/jobs.py) as they fall due. Start one or more workers on '
+            'every node; each job shard runs once across all of them.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job', action='append', dest='jobs',
+                            help='Only run this job (repeatable)')
+        parser.add_argument('--worker', help='Name of this worker in the leases (default host:pid)')
+        parser.add_argument('--poll', type=float, help='Seconds between checks for due jobs')
+        parser.add_argument('--once', action='store_true', help='Run what is due now, then exit')
+        parser.add_argument('--list', action='store_true', help='Show the jobs and their leases, then exit')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            return self.list_jobs()
+
+        stop = threading.Event()
+        # Finish the shard being run, then exit; its lease would otherwise have to expire first
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        try:
+            total = run_worker(options['jobs'], options['worker'], options['once'], options['poll'], stop,
+                               log=self.stdout.write)
+        except ValueError as exc:
+            raise CommandError(exc)
+        self.stdout.write(self.style.SUCCESS(f'Ran {total} job shard(s)'))
+
+    def list_jobs(self):
+        leases = {}
+        for lease in JobLease.objects.all():
+            leases.setdefault(lease.job, []).append(lease)
+        for name, job in registered_jobs().items():
+            self.stdout.write(f'{name}  {job.schedule}  ({job.shards} shard(s))')
+            for lease in leases.get(name, []):
+                slot = f'{timezone.localtime(lease.slot):%Y-%m-%d %H:%M}' if lease.slot else 'never'
+                owner = f' by {lease.owner} until {timezone.localtime(lease.expires_at):%H:%M:%S}' if lease.owner else ''
+                self.stdout.write(f'  [{lease.shard}] {slot} {lease.status}{owner} attempts={lease.attempts}')
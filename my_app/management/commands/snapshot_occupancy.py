@@ -0,0 +1,23 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from my_app.occupancy import take_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Record the daily occupancy snapshot used by the occupancy report trends. Run once a day.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Date to record the counts of, from the unit status history '
+                                           '(YYYY-MM-DD, default today)')
+
+    def handle(self, *args, **options):
+        day = None
+        if options['date']:
+            try:
+                day = date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError('--date must be YYYY-MM-DD')
+        rows = take_snapshot(day)
+        self.stdout.write(self.style.SUCCESS(f'Recorded {rows} occupancy snapshot row(s)'))
@@ -0,0 +1,193 @@
+"""
+Prometheus metrics for the hot paths, served at /metrics.
+
+With several worker processes (gunicorn), start them with PROMETHEUS_MULTIPROC_DIR set to
+an empty, writable directory: every worker then writes its samples to memory-mapped files
+there and /metrics sums them across workers. Without it, metrics cover the current process.
+"""
+import ipaddress
+import os
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess,
+)
+
+# Daraja timestamps (TransactionDate, Timestamp) are East Africa Time
+DARAJA_TIMEZONE = ZoneInfo('Africa/Nairobi')
+
+REQUEST_LATENCY = Histogram(
+    'ams_http_request_duration_seconds', 'Time spent handling a request, by URL name.',
+    ['view', 'method', 'status'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+REQUEST_QUERIES = Histogram(
+    'ams_http_request_db_queries', 'Database queries run while handling a request, by URL name.',
+    ['view'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+CACHE_REQUESTS = Counter(
+    'ams_cache_requests_total', 'Cache lookups by cache and result (hit or miss).',
+    ['cache', 'result'],
+)
+STK_PUSH_LATENCY = Histogram(
+    'ams_mpesa_stk_push_duration_seconds', 'Round trip of an STK push request to Daraja.',
+    ['outcome'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60),
+)
+STK_PUSHES = Counter(
+    'ams_mpesa_stk_push_total', 'STK push requests by outcome and Daraja error code.',
+    ['outcome', 'error_code'],
+)
+STK_QUERIES = Counter(
+    'ams_mpesa_stk_query_total', 'STK queries for pushes whose callback did not come, by outcome.',
+    ['outcome'],
+)
+STK_PUSHES_DEDUPLICATED = Counter(
+    'ams_mpesa_stk_push_deduplicated_total',
+    'STK push requests answered with a push already in flight for the same tenant and amount.',
+)
+RATE_LIMITS = Counter(
+    'ams_rate_limit_total', 'Rate limiter decisions by limiter and result (allowed, limited or contended).',
+    ['limiter', 'result'],
+)
+CALLBACKS = Counter(
+    'ams_mpesa_callbacks_total', 'STK callbacks received, by ResultCode.',
+    ['result_code'],
+)
+CALLBACK_LAG = Histogram(
+    'ams_mpesa_callback_lag_seconds', 'Time from the M-Pesa transaction to its callback being recorded.',
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800, 3600),
+)
+PAYMENTS_CREATED = Counter(
+    'ams_payments_created_total', 'Payments created, by payment method.',
+    ['method'],
+)
+PHOTO_PROCESSING = Histogram(
+    'ams_photo_processing_duration_seconds', 'Time to make the renditions of an uploaded photo, by result.',
+    ['result'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+)
+
+
+def record_cache(name, hit):
+    CACHE_REQUESTS.labels(cache=name, result='hit' if hit else 'miss').inc()
+
+
+def record_stk_push(started, outcome, error_code=''):
+    STK_PUSH_LATENCY.labels(outcome=outcome).observe(time.perf_counter() - started)
+    STK_PUSHES.labels(outcome=outcome, error_code=error_code or '').inc()
+
+
+def record_stk_query(outcome):
+    STK_QUERIES.labels(outcome=outcome).inc()
+
+
+def record_stk_push_deduplicated():
+    STK_PUSHES_DEDUPLICATED.inc()
+
+
+def record_rate_limit(limiter, result):
+    RATE_LIMITS.labels(limiter=limiter, result=result).inc()
+
+
+def record_callback(result):
+    """Count an STK callback and, for completed ones, how long after the transaction it arrived."""
+    CALLBACKS.labels(result_code=str(result.get('ResultCode'))).inc()
+    transaction_date = result.get('TransactionDate')
+    if not transaction_date:
+        return
+    try:
+        paid_at = datetime.strptime(str(transaction_date), '%Y%m%d%H%M%S').replace(tzinfo=DARAJA_TIMEZONE)
+    except ValueError:
+        return
+    CALLBACK_LAG.observe(max((timezone.now() - paid_at).total_seconds(), 0))
+
+
+def record_photo_processed(started, result):
+    PHOTO_PROCESSING.labels(result=result).observe(time.perf_counter() - started)
+
+
+def record_payments_created(methods):
+    for method in methods:
+        PAYMENTS_CREATED.labels(method=method).inc()
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """Observes latency and query count of every request, labelled with the URL name."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = _QueryCounter()
+        started = time.perf_counter()
+        with connections['default'].execute_wrapper(counter):
+            response = self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started, counter.count)
+        return response
+
+    async def __acall__(self, request):
+        # The ORM calls of an async view run in a worker thread, where this thread's connection
+        # wrapper does not see them, so only the latency is observed
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        self.observe(request, response, time.perf_counter() - started)
+        return response
+
+    def observe(self, request, response, elapsed, queries=None):
+        match = request.resolver_match
+        view = (match.view_name if match else None) or 'unmatched'
+        REQUEST_LATENCY.labels(view=view, method=request.method, status=response.status_code).observe(elapsed)
+        if queries is not None:
+            REQUEST_QUERIES.labels(view=view).observe(queries)
+
+
+def _allowed(request):
+    token = settings.METRICS_TOKEN
+    if token and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}'):
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS)
+
+
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint, for requests with `Authorization: Bearer <METRICS_TOKEN>` and
+    from METRICS_ALLOWED_NETWORKS. Both are unset by default, which keeps it closed.
+    """
+    if not _allowed(request):
+        return HttpResponseForbidden('Forbidden')
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
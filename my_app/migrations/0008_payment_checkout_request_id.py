@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-19 07:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0007_tenant_user_alter_payment_payment_method_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='period_end',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='period_start',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='tenant',
+            name='id_number',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0008_payment_checkout_request_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('unit_type', models.CharField(max_length=20)),
+                ('total_units', models.PositiveIntegerField(default=0)),
+                ('occupied_units', models.PositiveIntegerField(default=0)),
+                ('available_units', models.PositiveIntegerField(default=0)),
+                ('maintenance_units', models.PositiveIntegerField(default=0)),
+                ('reserved_units', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('property', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='occupancy_snapshots', to='my_app.property')),
+            ],
+            options={
+                'ordering': ['-date', 'property', 'unit_type'],
+                'constraints': [models.UniqueConstraint(fields=('date', 'property', 'unit_type'), name='unique_occupancy_snapshot')],
+            },
+        ),
+        migrations.CreateModel(
+            name='UnitStatusChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('old_status', models.CharField(blank=True, max_length=20)),
+                ('new_status', models.CharField(max_length=20)),
+                ('changed_at', models.DateTimeField(auto_now_add=True)),
+                ('unit', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_changes', to='my_app.unit')),
+            ],
+            options={
+                'ordering': ['-changed_at'],
+                'indexes': [models.Index(fields=['unit', 'changed_at'], name='my_app_unit_unit_id_6bcdec_idx')],
+            },
+        ),
+    ]
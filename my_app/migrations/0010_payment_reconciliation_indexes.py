@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0009_occupancy_history'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='reference_number',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['tenant', 'payment_date'], name='my_app_paym_tenant__d5609f_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0010_payment_reconciliation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaymentArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('payment_type', models.CharField(choices=[('rent', 'Rent'), ('deposit', 'Deposit')], default='rent', max_length=20)),
+                ('payment_method', models.CharField(choices=[('cash', 'Cash'), ('mpesa', 'M-Pesa'), ('bank_transfer', 'Bank Transfer')], default='mpesa', max_length=20)),
+                ('payment_date', models.DateField()),
+                ('reference_number', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('description', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('failed', 'Failed'), ('refunded', 'Refunded')], default='completed', max_length=20)),
+                ('checkout_request_id', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('period_start', models.DateField(blank=True, null=True)),
+                ('period_end', models.DateField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('tenant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_payments', to='my_app.tenant')),
+            ],
+            options={
+                'ordering': ['-payment_date', '-created_at'],
+                'abstract': False,
+                'indexes': [models.Index(fields=['tenant', 'payment_date'], name='my_app_paym_tenant__b72f94_idx'), models.Index(fields=['payment_date'], name='my_app_paym_payment_3887f5_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PaymentRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField()),
+                ('payment_type', models.CharField(choices=[('rent', 'Rent'), ('deposit', 'Deposit')], max_length=20)),
+                ('payment_method', models.CharField(choices=[('cash', 'Cash'), ('mpesa', 'M-Pesa'), ('bank_transfer', 'Bank Transfer')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('tenant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payment_rollups', to='my_app.tenant')),
+            ],
+            options={
+                'ordering': ['-year'],
+                'constraints': [models.UniqueConstraint(fields=('year', 'tenant', 'payment_type', 'payment_method'), name='unique_payment_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0012_audit_log'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RentAdjustment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('percent', 'Percentage'), ('fixed', 'Fixed amount')], default='percent', max_length=10)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('applies_to', models.CharField(choices=[('all', 'Leases and unit rents'), ('leases', 'Leases only'), ('units', 'Unit rents only')], default='all', max_length=10)),
+                ('effective_from', models.DateField()),
+                ('unit_type', models.CharField(blank=True, choices=[('studio', 'Studio'), ('1br', '1 Bedroom'), ('2br', '2 Bedroom'), ('3br', '3 Bedroom'), ('4br', '4 Bedroom'), ('penthouse', 'Penthouse'), ('commercial', 'Commercial Space')], max_length=20)),
+                ('lease_started_before', models.DateField(blank=True, null=True)),
+                ('units_changed', models.PositiveIntegerField(default=0)),
+                ('leases_changed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rent_adjustments', to=settings.AUTH_USER_MODEL)),
+                ('property', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rent_adjustments', to='my_app.property')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RentSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('effective_from', models.DateField()),
+                ('previous_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('rent_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('adjustment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='schedules', to='my_app.rentadjustment')),
+                ('tenant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rent_schedules', to='my_app.tenant')),
+                ('unit', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rent_schedules', to='my_app.unit')),
+            ],
+            options={
+                'ordering': ['-effective_from', '-created_at'],
+                'indexes': [models.Index(fields=['tenant', 'effective_from'], name='my_app_rent_tenant__270cb3_idx'), models.Index(fields=['unit', 'effective_from'], name='my_app_rent_unit_id_99ff47_idx'), models.Index(fields=['effective_from'], name='my_app_rent_effecti_95d257_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('tenant__isnull', True), ('unit__isnull', False)), models.Q(('tenant__isnull', False), ('unit__isnull', True)), _connector='OR'), name='rent_schedule_unit_or_tenant')],
+            },
+        ),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F, FloatField
+from django.db.models.functions import Cast, Round
+
+import my_app.fields
+
+# (model, field, null, default) of every amount moved from DecimalField to MoneyField
+MONEY_FIELDS = [
+    ('unit', 'rent_amount', False, None),
+    ('unit', 'deposit_amount', True, None),
+    ('tenant', 'rent_amount', True, None),
+    ('tenant', 'deposit_paid', True, None),
+    ('payment', 'amount', False, None),
+    ('paymentarchive', 'amount', False, None),
+    ('paymentrollup', 'total', False, 0),
+    ('rentschedule', 'previous_amount', False, None),
+    ('rentschedule', 'rent_amount', False, None),
+]
+
+
+def _options(null, default):
+    options = {'null': null, 'blank': null}
+    if default is not None:
+        options['default'] = default
+    return options
+
+
+def widened():
+    # Room for the amounts times 100 while they are still decimals
+    return [
+        migrations.AlterField(model, name, models.DecimalField(max_digits=20, decimal_places=2, **_options(null, default)))
+        for model, name, null, default in MONEY_FIELDS
+    ]
+
+
+def to_cents(apps, schema_editor):
+    for model, name, null, default in MONEY_FIELDS:
+        # ROUND also snaps SQLite's binary floating point decimals to whole cents
+        apps.get_model('my_app', model)._base_manager.update(**{name: Round(F(name) * 100)})
+
+
+def from_cents(apps, schema_editor):
+    for model, name, null, default in MONEY_FIELDS:
+        # The cents are integers, which SQLite would divide as integers, dropping the cents
+        apps.get_model('my_app', model)._base_manager.update(**{
+            name: ExpressionWrapper(Round(Cast(F(name), FloatField()) / 100, 2), output_field=models.DecimalField()),
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0014_soft_delete_properties'),
+    ]
+
+    operations = [
+        *widened(),
+        migrations.RunPython(to_cents, from_cents),
+        *[
+            migrations.AlterField(model, name, my_app.fields.MoneyField(**_options(null, default)))
+            for model, name, null, default in MONEY_FIELDS
+        ],
+    ]
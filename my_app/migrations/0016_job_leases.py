@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0015_money_in_cents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobLease',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job', models.CharField(max_length=100)),
+                ('shard', models.PositiveIntegerField(default=0)),
+                ('slot', models.DateTimeField(blank=True, null=True)),
+                ('range_start', models.BigIntegerField(blank=True, null=True)),
+                ('range_end', models.BigIntegerField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='done', max_length=10)),
+                ('owner', models.CharField(blank=True, max_length=200)),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True)),
+            ],
+            options={
+                'ordering': ['job', 'shard'],
+                'constraints': [models.UniqueConstraint(fields=('job', 'shard'), name='unique_job_lease')],
+            },
+        ),
+    ]
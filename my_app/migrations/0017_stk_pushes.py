@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-19 08:58
+
+import django.db.models.deletion
+import my_app.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0016_job_leases'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StkPush',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkout_request_id', models.CharField(max_length=100, unique=True)),
+                ('merchant_request_id', models.CharField(blank=True, max_length=100)),
+                ('phone_number', models.CharField(max_length=20)),
+                ('amount', my_app.fields.MoneyField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('failed', 'Failed'), ('expired', 'Expired')], default='pending', max_length=10)),
+                ('result_code', models.IntegerField(blank=True, null=True)),
+                ('result_desc', models.CharField(blank=True, max_length=255)),
+                ('source', models.CharField(blank=True, choices=[('callback', 'Callback'), ('query', 'STK query')], max_length=10)),
+                ('queries', models.PositiveSmallIntegerField(default=0)),
+                ('last_queried_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('answered_at', models.DateTimeField(blank=True, null=True)),
+                ('tenant', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stk_pushes', to='my_app.tenant')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(condition=models.Q(('status', 'pending')), fields=['created_at'], name='stk_push_pending_idx')],
+            },
+        ),
+    ]
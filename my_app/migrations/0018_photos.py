@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-19 09:05
+
+import django.db.models.deletion
+import my_app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0017_stk_pushes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Photo',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image', models.ImageField(height_field='height', upload_to=my_app.models.photo_upload_to, width_field='width')),
+                ('width', models.PositiveIntegerField(blank=True, null=True)),
+                ('height', models.PositiveIntegerField(blank=True, null=True)),
+                ('caption', models.CharField(blank=True, max_length=200)),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('ready', 'Ready'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('digest', models.CharField(blank=True, max_length=64)),
+                ('renditions', models.JSONField(blank=True, default=dict)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('processing_started_at', models.DateTimeField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('property', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='photos', to='my_app.property')),
+                ('unit', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='photos', to='my_app.unit')),
+            ],
+            options={
+                'ordering': ['position', 'pk'],
+                'indexes': [models.Index(condition=models.Q(('status', 'ready')), fields=['property', 'position'], name='photo_property_ready_idx'), models.Index(condition=models.Q(('status', 'ready')), fields=['unit', 'position'], name='photo_unit_ready_idx'), models.Index(condition=models.Q(('status__in', ['pending', 'processing'])), fields=['created_at'], name='photo_unprocessed_idx'), models.Index(fields=['digest'], name='my_app_phot_digest_bc63bf_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('property__isnull', False), ('unit__isnull', True)), models.Q(('property__isnull', True), ('unit__isnull', False)), _connector='OR'), name='photo_property_or_unit')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-19 09:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def analyze(apps, schema_editor):
+    # Without statistics SQLite prefers unit_live_status_idx and sorts every vacancy
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('ANALYZE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0018_photos'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='property',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'active')), fields=['city', 'property_type'], name='property_listed_city_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unit',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'available')), fields=['rent_amount', 'id'], name='unit_vacancy_rent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unit',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'available')), fields=['bedrooms', 'rent_amount', 'id'], name='unit_vacancy_bedrooms_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unit',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'available')), fields=['unit_type', 'rent_amount', 'id'], name='unit_vacancy_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unit',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True), ('status', 'available')), fields=['property', 'rent_amount', 'id'], name='unit_vacancy_property_idx'),
+        ),
+        migrations.RunPython(analyze, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.8 on 2026-10-19 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def analyze(apps, schema_editor):
+    # So SQLite weighs the new indexes against the ones it already has statistics for
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('ANALYZE')
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0019_vacancy_search_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='occupancysnapshot',
+            index=models.Index(fields=['property', 'date'], name='occupancy_property_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['tenant', 'status', 'payment_date'], name='payment_tenant_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tenant',
+            index=models.Index(fields=['unit', 'status'], name='tenant_unit_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='unit',
+            index=models.Index(condition=models.Q(('deleted_at__isnull', True)), fields=['property', 'status'], name='unit_live_property_status_idx'),
+        ),
+        migrations.RunPython(analyze, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-19 09:38
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_applied(apps, schema_editor):
+    # Adjustments could only be saved by applying them until now
+    apps.get_model('my_app', 'RentAdjustment').objects.update(applied_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0020_scoping_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rentadjustment',
+            name='applied_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(mark_applied, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='rentadjustment',
+            index=models.Index(condition=models.Q(('applied_at__isnull', True)), fields=['effective_from'], name='rent_adjustment_due_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-19 14:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_last_property(apps, schema_editor):
+    Tenant = apps.get_model('my_app', 'Tenant')
+    Unit = apps.get_model('my_app', 'Unit')
+    Tenant.objects.filter(unit__isnull=False).update(
+        last_property_id=Subquery(Unit.objects.filter(pk=OuterRef('unit_id')).values('property_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_app', '0021_scheduled_rent_adjustments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tenant',
+            name='last_property',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='former_tenants', to='my_app.property'),
+        ),
+        migrations.RunPython(backfill_last_property, migrations.RunPython.noop),
+    ]
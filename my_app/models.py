@@ -1,8 +1,173 @@
-from django.db import models
+import hashlib
+import os
+import uuid
+
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .caching import model_version
+from .fields import MoneyField
+from .metrics import record_cache
+
+
+class LoadedValuesMixin:
+    """
+    Remembers field values as they were loaded from (or last saved to) the database, so
+    saves can tell what changed: status history, user cache invalidation, the audit trail.
+    """
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            field.attname: instance.__dict__[field.attname]
+            for field in cls._meta.concrete_fields if field.attname in instance.__dict__
+        }
+        return instance
+    
+    def loaded_value(self, attname, default=None):
+        return self.__dict__.get('_loaded_values', {}).get(attname, default)
+    
+    def changed_values(self, update_fields=None):
+        """{attname: (old, new)} for fields that differ from the loaded values; old is None on new rows."""
+        loaded = self.__dict__.get('_loaded_values', {})
+        changes = {}
+        for field in self._tracked_fields(update_fields):
+            new = self.__dict__[field.attname]
+            old = loaded.get(field.attname)
+            if old != new:
+                changes[field.attname] = (old, new)
+        return changes
+    
+    def _tracked_fields(self, names=None):
+        fields = self._meta.concrete_fields
+        if names is not None:
+            names = set(names)
+            fields = [field for field in fields if field.name in names or field.attname in names]
+        return [field for field in fields if field.attname in self.__dict__]
+    
+    def _remember_loaded_values(self, names=None):
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        for field in self._tracked_fields(names):
+            loaded[field.attname] = self.__dict__[field.attname]
+    
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._remember_loaded_values(kwargs.get('update_fields'))
+    
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self._remember_loaded_values(fields)
+
+
+def schedule_rent_change(instance, previous, update_fields=None):
+    """Record a unit's or lease's rent change made by save() as a RentSchedule from today on."""
+    if update_fields is not None and 'rent_amount' not in update_fields:
+        return
+    if previous is not None and instance.rent_amount is not None and previous != instance.rent_amount:
+        RentSchedule.objects.create(**{
+            instance._meta.model_name: instance,
+            'effective_from': timezone.localdate(),
+            'previous_amount': previous,
+            'rent_amount': instance.rent_amount,
+        })
+
+
+def managed_property_ids(user):
+    """
+    Ids of the properties `user` manages, or None for a superuser, who sees them all.
+
+    Cached per user until a property changes, and kept on the user object for the rest
+    of the request, so scoping every query of a page costs at most one lookup.
+    """
+    if user.is_superuser:
+        return None
+    if not user.is_authenticated:
+        return []
+    ids = getattr(user, '_managed_property_ids', None)
+    if ids is None:
+        key = f'managed-properties:{user.pk}:{model_version(Property).timestamp()}'
+        ids = cache.get(key)
+        record_cache('managed_properties', ids is not None)
+        if ids is None:
+            ids = list(Property.all_objects.filter(manager_id=user.pk).order_by('pk').values_list('pk', flat=True))
+            cache.set(key, ids, settings.SCOPE_CACHE_TIMEOUT)
+        user._managed_property_ids = ids
+    return ids
+
+
+def scope_key(property_ids):
+    """Short cache key part for a scope; managers of the same properties share it."""
+    if property_ids is None:
+        return 'all'
+    return hashlib.md5(','.join(map(str, sorted(property_ids))).encode()).hexdigest()
+
+
+class ScopedQuerySet(models.QuerySet):
+    """
+    Rows that belong to properties, through `scope_lookup` (the property id, as seen from
+    this model). for_user() keeps those of the properties a user manages.
+    """
+    scope_lookup = 'property_id'
+    
+    def for_user(self, user):
+        return self.in_scope(managed_property_ids(user))
+    
+    def in_scope(self, property_ids):
+        """The rows of these properties, or all of them for None (see managed_property_ids())."""
+        if property_ids is None:
+            return self
+        return self.filter(self.scope_filter(property_ids))
+    
+    def scope_filter(self, property_ids):
+        return models.Q(**{f'{self.scope_lookup}__in': property_ids})
+
+
+class PropertyQuerySet(ScopedQuerySet):
+    scope_lookup = 'pk'
+
+
+class TenantQuerySet(ScopedQuerySet):
+    
+    def scope_filter(self, property_ids, applicants=True):
+        # A tenant whose unit was removed stays with the property of its last unit;
+        # applicants who were never housed are seen by every manager, to house them
+        units = Unit.all_objects.filter(property_id__in=property_ids).values('pk')
+        housed = models.Q(unit_id__in=units) | models.Q(unit__isnull=True, last_property_id__in=property_ids)
+        if not applicants:
+            return housed
+        return housed | models.Q(unit__isnull=True, last_property__isnull=True, status='pending')
+
+
+class PaymentQuerySet(ScopedQuerySet):
+    """Payments, archived payments and their rollups: scoped through their tenant."""
+    
+    def scope_filter(self, property_ids):
+        # Never through applicants, so no manager's totals take in a tenant of no property
+        tenants = Tenant.objects.filter(Tenant.objects.scope_filter(property_ids, applicants=False))
+        return models.Q(tenant_id__in=tenants.values('pk'))
+
+
+class PhotoQuerySet(ScopedQuerySet):
+    
+    def scope_filter(self, property_ids):
+        return models.Q(property_id__in=property_ids) | models.Q(unit__property_id__in=property_ids)
+
+
+class LiveManager(models.Manager):
+    """Default manager of soft-deleted models: hides rows with deleted_at set."""
+    
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
 
 
-class Property(models.Model):
+class Property(LoadedValuesMixin, models.Model):
     PROPERTY_TYPES = [
         ('apartment', 'Apartment Building'),
         ('house', 'House'),
@@ -27,10 +192,21 @@ class Property(models.Model):
     manager = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='managed_properties')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Set by deletion.soft_delete_properties(); the row is purged later
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = LiveManager.from_queryset(PropertyQuerySet)()
+    all_objects = PropertyQuerySet.as_manager()
     
     class Meta:
         verbose_name_plural = "Properties"
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at'], condition=models.Q(deleted_at__isnull=True), name='property_live_idx'),
+            models.Index(fields=['deleted_at'], condition=models.Q(deleted_at__isnull=False), name='property_deleted_idx'),
+            models.Index(fields=['city', 'property_type'], condition=models.Q(deleted_at__isnull=True, status='active'),
+                         name='property_listed_city_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -50,7 +226,11 @@ class Property(models.Model):
         return round(self.occupied_units / self.total_units * 100, 1)
 
 
-class Unit(models.Model):
+# Units on offer
+VACANT = models.Q(status='available', deleted_at__isnull=True)
+
+
+class Unit(LoadedValuesMixin, models.Model):
     UNIT_TYPES = [
         ('studio', 'Studio'),
         ('1br', '1 Bedroom'),
@@ -75,27 +255,55 @@ class Unit(models.Model):
     bedrooms = models.PositiveIntegerField(default=1)
     bathrooms = models.PositiveIntegerField(default=1)
    
-    rent_amount = models.DecimalField(max_digits=10, decimal_places=2)
-    deposit_amount = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    rent_amount = MoneyField()
+    deposit_amount = MoneyField(blank=True, null=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='available')
     is_occupied = models.BooleanField(default=False)
     description = models.TextField(blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Set together with its property's
+    deleted_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = LiveManager.from_queryset(ScopedQuerySet)()
+    all_objects = ScopedQuerySet.as_manager()
     
     class Meta:
         ordering = ['property', 'unit_number']
         unique_together = ['property', 'unit_number']
+        indexes = [
+            models.Index(fields=['property', 'unit_number'], condition=models.Q(deleted_at__isnull=True), name='unit_live_idx'),
+            models.Index(fields=['status'], condition=models.Q(deleted_at__isnull=True), name='unit_live_status_idx'),
+            # Per-manager counts by status (ScopedQuerySet)
+            models.Index(fields=['property', 'status'], condition=models.Q(deleted_at__isnull=True), name='unit_live_property_status_idx'),
+            # Vacancy search (my_app/vacancies.py): rent ranges and keyset order, alone or after an equality filter
+            models.Index(fields=['rent_amount', 'id'], condition=VACANT, name='unit_vacancy_rent_idx'),
+            models.Index(fields=['bedrooms', 'rent_amount', 'id'], condition=VACANT, name='unit_vacancy_bedrooms_idx'),
+            models.Index(fields=['unit_type', 'rent_amount', 'id'], condition=VACANT, name='unit_vacancy_type_idx'),
+            models.Index(fields=['property', 'rent_amount', 'id'], condition=VACANT, name='unit_vacancy_property_idx'),
+        ]
     
     def __str__(self):
         return f"{self.property.name} - Unit {self.unit_number}"
     
     def save(self, *args, **kwargs):
         self.is_occupied = self.status == 'occupied'
-        super().save(*args, **kwargs)
+        # Compared after saving to record status changes for the occupancy history
+        previous_status = self.loaded_value('status')
+        previous_rent = self.loaded_value('rent_amount')
+        update_fields = kwargs.get('update_fields')
+        tracked = update_fields is None or 'status' in update_fields
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            if tracked and previous_status != self.status:
+                UnitStatusChange.objects.create(
+                    unit=self, old_status=previous_status or '', new_status=self.status
+                )
+            schedule_rent_change(self, previous_rent, update_fields)
 
 
-class Tenant(models.Model):
+
+class Tenant(LoadedValuesMixin, models.Model):
     STATUS_CHOICES = [
         ('active', 'Active'),
         ('inactive', 'Inactive'),
@@ -111,11 +319,14 @@ class Tenant(models.Model):
     id_number = models.CharField(max_length=50, blank=True)
     
     unit = models.ForeignKey(Unit, on_delete=models.SET_NULL, null=True, blank=True, related_name='tenants')
+    # The property of the tenant's latest unit, kept when the unit is removed, for scoping
+    last_property = models.ForeignKey(Property, on_delete=models.SET_NULL, null=True, blank=True,
+                                      editable=False, related_name='former_tenants')
     
     lease_start_date = models.DateField(null=True, blank=True)
     lease_end_date = models.DateField(null=True, blank=True)
-    rent_amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
-    deposit_paid = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    rent_amount = MoneyField(null=True, blank=True)
+    deposit_paid = MoneyField(null=True, blank=True)
     
     emergency_contact_name = models.CharField(max_length=200, blank=True)
     emergency_contact_phone = models.CharField(max_length=20, blank=True)
@@ -126,12 +337,27 @@ class Tenant(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    objects = TenantQuerySet.as_manager()
+    
     class Meta:
         ordering = ['last_name', 'first_name']
+        indexes = [models.Index(fields=['unit', 'status'], name='tenant_unit_status_idx')]
     
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
     
+    def save(self, *args, **kwargs):
+        previous_rent = self.loaded_value('rent_amount')
+        update_fields = kwargs.get('update_fields')
+        if self.unit_id and (update_fields is None or {'unit', 'unit_id'} & set(update_fields)):
+            self.last_property_id = (self.unit.property_id if Tenant.unit.is_cached(self) else
+                                     Unit.all_objects.filter(pk=self.unit_id).values_list('property_id', flat=True).first())
+            if update_fields is not None:
+                kwargs['update_fields'] = [*update_fields, 'last_property']
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+            schedule_rent_change(self, previous_rent, kwargs.get('update_fields'))
+    
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -143,7 +369,8 @@ class Tenant(models.Model):
         return None
 
 
-class Payment(models.Model):
+class BasePayment(models.Model):
+    """Fields shared by live payments and archived ones."""
     PAYMENT_METHODS = [
         ('cash', 'Cash'),
         ('mpesa', 'M-Pesa'),
@@ -162,14 +389,14 @@ class Payment(models.Model):
         ('refunded', 'Refunded'),
     ]
     
-    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='payments')
-    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    amount = MoneyField()
     payment_type = models.CharField(max_length=20, choices=PAYMENT_TYPES, default='rent')
     payment_method = models.CharField(max_length=20, choices=PAYMENT_METHODS, default='mpesa')
     payment_date = models.DateField()
-    reference_number = models.CharField(max_length=100, blank=True)
+    reference_number = models.CharField(max_length=100, blank=True, db_index=True)
     description = models.TextField(blank=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='completed')
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
     
     period_start = models.DateField(null=True, blank=True)
     period_end = models.DateField(null=True, blank=True)
@@ -177,7 +404,12 @@ class Payment(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    is_archived = False
+    
+    objects = PaymentQuerySet.as_manager()
+    
     class Meta:
+        abstract = True
         ordering = ['-payment_date', '-created_at']
     
     def __str__(self):
@@ -189,3 +421,351 @@ class Payment(models.Model):
             return self.tenant.unit.property.name
         except:
             return None
+
+
+class Payment(LoadedValuesMixin, BasePayment):
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='payments')
+    
+    class Meta(BasePayment.Meta):
+        indexes = [
+            models.Index(fields=['tenant', 'payment_date']),
+            models.Index(fields=['tenant', 'status', 'payment_date'], name='payment_tenant_status_idx'),
+        ]
+
+
+class PaymentArchive(BasePayment):
+    """
+    Completed payments older than PAYMENT_ARCHIVE_AFTER_MONTHS, moved here by
+    `manage.py archive_payments` with their original id. See my_app/archive.py.
+    """
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='archived_payments')
+    archived_at = models.DateTimeField(auto_now_add=True)
+    
+    is_archived = True
+    
+    class Meta(BasePayment.Meta):
+        indexes = [
+            models.Index(fields=['tenant', 'payment_date']),
+            models.Index(fields=['payment_date']),
+        ]
+
+
+class StkPush(models.Model):
+    """
+    An STK push Daraja accepted, kept until its outcome is known so a lost callback can be
+    made up for with an STK query (see mpesa.poll_stk_pushes()).
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+        ('expired', 'Expired'),
+    ]
+    SOURCES = [
+        ('callback', 'Callback'),
+        ('query', 'STK query'),
+    ]
+    
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    tenant = models.ForeignKey(Tenant, on_delete=models.SET_NULL, null=True, blank=True, related_name='stk_pushes')
+    phone_number = models.CharField(max_length=20)
+    amount = MoneyField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    result_code = models.IntegerField(null=True, blank=True)
+    result_desc = models.CharField(max_length=255, blank=True)
+    # Where the outcome came from
+    source = models.CharField(max_length=10, choices=SOURCES, blank=True)
+    queries = models.PositiveSmallIntegerField(default=0)
+    last_queried_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    answered_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], condition=models.Q(status='pending'), name='stk_push_pending_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.checkout_request_id} {self.status}"
+
+
+class PaymentRollup(models.Model):
+    """Yearly totals of archived payments, so totals over all time never read the archive."""
+    year = models.PositiveSmallIntegerField()
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, related_name='payment_rollups')
+    payment_type = models.CharField(max_length=20, choices=BasePayment.PAYMENT_TYPES)
+    payment_method = models.CharField(max_length=20, choices=BasePayment.PAYMENT_METHODS)
+    count = models.PositiveIntegerField(default=0)
+    total = MoneyField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = PaymentQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['-year']
+        constraints = [
+            models.UniqueConstraint(fields=['year', 'tenant', 'payment_type', 'payment_method'], name='unique_payment_rollup'),
+        ]
+    
+    def __str__(self):
+        return f"{self.year} - {self.tenant_id} - {self.payment_type} - {self.total}"
+
+
+class UnitStatusChange(models.Model):
+    """
+    One row per change of Unit.status, written by Unit.save() and lifecycle.py; the
+    occupancy snapshots of past days are rebuilt from it (occupancy.units_at()).
+    """
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, related_name='status_changes')
+    old_status = models.CharField(max_length=20, blank=True)
+    new_status = models.CharField(max_length=20)
+    changed_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-changed_at']
+        indexes = [models.Index(fields=['unit', 'changed_at'])]
+    
+    def __str__(self):
+        return f"{self.unit_id}: {self.old_status or '-'} -> {self.new_status}"
+
+
+class OccupancySnapshot(models.Model):
+    """Daily unit counts per property and unit type, filled by `manage.py snapshot_occupancy`."""
+    date = models.DateField()
+    property = models.ForeignKey(Property, on_delete=models.CASCADE, related_name='occupancy_snapshots')
+    unit_type = models.CharField(max_length=20)
+    total_units = models.PositiveIntegerField(default=0)
+    occupied_units = models.PositiveIntegerField(default=0)
+    available_units = models.PositiveIntegerField(default=0)
+    maintenance_units = models.PositiveIntegerField(default=0)
+    reserved_units = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    objects = ScopedQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['-date', 'property', 'unit_type']
+        indexes = [models.Index(fields=['property', 'date'], name='occupancy_property_date_idx')]
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'property', 'unit_type'], name='unique_occupancy_snapshot'),
+        ]
+    
+    def __str__(self):
+        return f"{self.date} {self.property_id} {self.unit_type}: {self.occupied_units}/{self.total_units}"
+
+
+class RentAdjustment(models.Model):
+    """A rent change applied to many units and leases at once by my_app/rent.py."""
+    KINDS = [
+        ('percent', 'Percentage'),
+        ('fixed', 'Fixed amount'),
+    ]
+    
+    TARGETS = [
+        ('all', 'Leases and unit rents'),
+        ('leases', 'Leases only'),
+        ('units', 'Unit rents only'),
+    ]
+    
+    kind = models.CharField(max_length=10, choices=KINDS, default='percent')
+    # Percent or KES; negative for a decrease
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    applies_to = models.CharField(max_length=10, choices=TARGETS, default='all')
+    effective_from = models.DateField()
+    property = models.ForeignKey(Property, on_delete=models.SET_NULL, null=True, blank=True, related_name='rent_adjustments')
+    unit_type = models.CharField(max_length=20, choices=Unit.UNIT_TYPES, blank=True)
+    lease_started_before = models.DateField(null=True, blank=True)
+    units_changed = models.PositiveIntegerField(default=0)
+    leases_changed = models.PositiveIntegerField(default=0)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='rent_adjustments')
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When the rents changed; adjustments dated in the future wait for their effective date
+    applied_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = ScopedQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['effective_from'], condition=models.Q(applied_at__isnull=True),
+                         name='rent_adjustment_due_idx'),
+        ]
+    
+    def __str__(self):
+        change = f"{self.amount:+}%" if self.kind == 'percent' else f"KES {self.amount:+}"
+        return f"{change} from {self.effective_from}"
+
+
+class RentSchedule(models.Model):
+    """
+    Rent of a unit or a lease from `effective_from` on. Charges for earlier periods use
+    `previous_amount`, so rent changes never rewrite history.
+    """
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, null=True, blank=True, related_name='rent_schedules')
+    tenant = models.ForeignKey(Tenant, on_delete=models.CASCADE, null=True, blank=True, related_name='rent_schedules')
+    adjustment = models.ForeignKey(RentAdjustment, on_delete=models.SET_NULL, null=True, blank=True, related_name='schedules')
+    effective_from = models.DateField()
+    previous_amount = MoneyField()
+    rent_amount = MoneyField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-effective_from', '-created_at']
+        indexes = [
+            models.Index(fields=['tenant', 'effective_from']),
+            models.Index(fields=['unit', 'effective_from']),
+            models.Index(fields=['effective_from']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(unit__isnull=False, tenant__isnull=True) | models.Q(unit__isnull=True, tenant__isnull=False),
+                name='rent_schedule_unit_or_tenant',
+            ),
+        ]
+    
+    def __str__(self):
+        target = f"unit {self.unit_id}" if self.unit_id else f"tenant {self.tenant_id}"
+        return f"{target}: {self.previous_amount} -> {self.rent_amount} from {self.effective_from}"
+
+
+class AuditLog(models.Model):
+    """One change to a property, unit, tenant or payment; written in batches by my_app/audit.py."""
+    ACTIONS = [
+        ('create', 'Created'),
+        ('update', 'Updated'),
+        ('delete', 'Deleted'),
+    ]
+    
+    created_at = models.DateTimeField(db_index=True)
+    # No database constraint: entries are written after the fact and the user may be gone by then
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                             related_name='audit_entries', db_constraint=False)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    model = models.CharField(max_length=50)
+    object_id = models.PositiveBigIntegerField()
+    # {field: [old, new]}
+    changes = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [models.Index(fields=['model', 'object_id', 'created_at'])]
+    
+    def __str__(self):
+        return f"{self.created_at:%Y-%m-%d %H:%M} {self.action} {self.model} {self.object_id}"
+
+
+class JobLease(models.Model):
+    """
+    One shard of a scheduled job (my_app/scheduler.py): which run it is on and which
+    worker holds it until when.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    job = models.CharField(max_length=100)
+    shard = models.PositiveIntegerField(default=0)
+    # Scheduled time of the run this shard is on
+    slot = models.DateTimeField(null=True, blank=True)
+    # Property ids this shard covers in that run, range_start <= id < range_end (None: unbounded)
+    range_start = models.BigIntegerField(null=True, blank=True)
+    range_end = models.BigIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='done')
+    owner = models.CharField(max_length=200, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    
+    class Meta:
+        ordering = ['job', 'shard']
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'shard'], name='unique_job_lease'),
+        ]
+    
+    def __str__(self):
+        return f"{self.job}[{self.shard}] {self.status}"
+
+
+def photo_upload_to(instance, filename):
+    # The upload's own name is not kept: it may clash and says nothing useful
+    return f"photos/originals/{uuid.uuid4().hex}{os.path.splitext(filename)[1].lower()}"
+
+
+class Photo(models.Model):
+    """
+    A photo of a property or a unit. The uploaded original is never served; my_app/photos.py
+    turns it into resized renditions in the background.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('ready', 'Ready'),
+        ('failed', 'Failed'),
+    ]
+    
+    property = models.ForeignKey(Property, on_delete=models.CASCADE, null=True, blank=True, related_name='photos')
+    unit = models.ForeignKey(Unit, on_delete=models.CASCADE, null=True, blank=True, related_name='photos')
+    image = models.ImageField(upload_to=photo_upload_to, width_field='width', height_field='height')
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    caption = models.CharField(max_length=200, blank=True)
+    position = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # SHA-256 of the original, shared by every copy of the same upload
+    digest = models.CharField(max_length=64, blank=True)
+    # {format: [[width, height, storage name], ...]} by ascending width
+    renditions = models.JSONField(default=dict, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processing_started_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = PhotoQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['position', 'pk']
+        indexes = [
+            models.Index(fields=['property', 'position'], condition=models.Q(status='ready'), name='photo_property_ready_idx'),
+            models.Index(fields=['unit', 'position'], condition=models.Q(status='ready'), name='photo_unit_ready_idx'),
+            models.Index(fields=['created_at'], condition=models.Q(status__in=['pending', 'processing']), name='photo_unprocessed_idx'),
+            models.Index(fields=['digest']),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(property__isnull=False, unit__isnull=True) | models.Q(property__isnull=True, unit__isnull=False),
+                name='photo_property_or_unit',
+            ),
+        ]
+    
+    def __str__(self):
+        target = f"unit {self.unit_id}" if self.unit_id else f"property {self.property_id}"
+        return f"{target} photo {self.pk} ({self.status})"
+    
+    def _sources(self, kind):
+        return [(width, height, default_storage.url(name)) for width, height, name in self.renditions.get(kind, [])]
+    
+    def _srcset(self, kind):
+        return ', '.join(f"{url} {width}w" for width, _, url in self._sources(kind))
+    
+    @cached_property
+    def webp_srcset(self):
+        return self._srcset('webp')
+    
+    @cached_property
+    def jpeg_srcset(self):
+        return self._srcset('jpeg')
+    
+    @cached_property
+    def fallback(self):
+        """(width, height, url) of the JPEG for browsers that ignore srcset: the middle size."""
+        sources = self._sources('jpeg')
+        return sources[len(sources) // 2] if sources else None
@@ -0,0 +1,481 @@
+import asyncio
+import base64
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django_daraja.mpesa.exceptions import MpesaConnectionError
+from django_daraja.mpesa.utils import api_base_url, format_phone_number, mpesa_config, mpesa_response
+
+from . import metrics
+from .models import Tenant, Payment, StkPush
+from .throttling import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+STATUS_CACHE_TIMEOUT = 60 * 60
+# Marks an STK push that is being sent, until Daraja answers with its CheckoutRequestID
+PUSH_SENDING = 'sending'
+# How long a repeated request waits for the push it repeats to be answered
+PUSH_SENDING_WAIT = 15
+NO_TENANT_FOUND = 'Payment received but no matching tenant was found'
+
+# checkout_request_id -> set of (event loop, asyncio.Event) for requests long-polling on it
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+class DarajaClient:
+    """
+    The parts of the Daraja API this app uses.
+
+    Unlike django_daraja's MpesaClient, the base URL can be pointed at another server
+    (MPESA_API_BASE_URL, e.g. the fake_daraja command), and the OAuth token is kept in
+    the cache instead of the AccessToken table.
+    """
+
+    def __init__(self, base_url=None, timeout=30):
+        self.base_url = (base_url or settings.MPESA_API_BASE_URL or api_base_url()).rstrip('/') + '/'
+        self.timeout = timeout
+
+    def access_token(self):
+        key = f'mpesa:token:{self.base_url}'
+        token = cache.get(key)
+        metrics.record_cache('daraja_token', token is not None)
+        if token is None:
+            try:
+                r = requests.get(
+                    self.base_url + 'oauth/v1/generate?grant_type=client_credentials',
+                    auth=(mpesa_config('MPESA_CONSUMER_KEY'), mpesa_config('MPESA_CONSUMER_SECRET')),
+                    timeout=self.timeout,
+                )
+                r.raise_for_status()
+                data = r.json()
+            except (requests.RequestException, ValueError) as e:
+                raise MpesaConnectionError(f'Could not get an access token: {e}')
+            token = data['access_token']
+            cache.set(key, token, max(int(data.get('expires_in', 3599)) - 60, 60))
+        return token
+
+    def _shortcode_and_password(self):
+        if mpesa_config('MPESA_ENVIRONMENT') == 'sandbox':
+            shortcode = mpesa_config('MPESA_EXPRESS_SHORTCODE')
+        else:
+            shortcode = mpesa_config('MPESA_SHORTCODE')
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            (shortcode + mpesa_config('MPESA_PASSKEY') + timestamp).encode('ascii')
+        ).decode('utf-8')
+        return shortcode, password, timestamp
+
+    def _post(self, path, data):
+        headers = {'Authorization': 'Bearer ' + self.access_token()}
+        try:
+            r = requests.post(self.base_url + path, json=data, headers=headers, timeout=self.timeout)
+            return mpesa_response(r)
+        except requests.exceptions.ConnectionError:
+            raise MpesaConnectionError('Connection failed')
+        except Exception as ex:
+            raise MpesaConnectionError(str(ex))
+
+    def stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        phone_number = format_phone_number(phone_number)
+        shortcode, password, timestamp = self._shortcode_and_password()
+        started = time.perf_counter()
+        try:
+            response = self._post('mpesa/stkpush/v1/processrequest', {
+                'BusinessShortCode': shortcode,
+                'Password': password,
+                'Timestamp': timestamp,
+                'TransactionType': 'CustomerPayBillOnline',
+                'Amount': amount,
+                'PartyA': phone_number,
+                'PartyB': shortcode,
+                'PhoneNumber': phone_number,
+                'CallBackURL': callback_url,
+                'AccountReference': account_reference,
+                'TransactionDesc': transaction_desc,
+            })
+        except MpesaConnectionError:
+            metrics.record_stk_push(started, 'connection_error')
+            raise
+        if response.response_code == '0':
+            metrics.record_stk_push(started, 'accepted')
+        else:
+            metrics.record_stk_push(started, 'rejected', response.error_code or response.response_code)
+        return response
+
+    def stk_query(self, checkout_request_id):
+        """Ask Daraja for the outcome of an STK push, e.g. when its callback never came."""
+        shortcode, password, timestamp = self._shortcode_and_password()
+        return self._post('mpesa/stkpushquery/v1/query', {
+            'BusinessShortCode': shortcode,
+            'Password': password,
+            'Timestamp': timestamp,
+            'CheckoutRequestID': checkout_request_id,
+        })
+
+
+class StkPushThrottled(Exception):
+    """An STK push was refused to stay within the rate limits; retry in `retry_after` seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'STK push refused, retry in {retry_after:.0f}s')
+        self.retry_after = retry_after
+
+
+def _inflight_key(tenant_id, amount):
+    return f'mpesa:stk:inflight:{tenant_id}:{amount}'
+
+
+def _inflight_by_checkout_key(checkout_request_id):
+    return f'mpesa:stk:inflight-for:{checkout_request_id}'
+
+
+def _await_push(key):
+    deadline = time.monotonic() + PUSH_SENDING_WAIT
+    while (value := cache.get(key)) == PUSH_SENDING and time.monotonic() < deadline:
+        time.sleep(0.25)
+    return value
+
+
+def send_stk_push(tenant_id, phone_number, amount, account_reference, transaction_desc, callback_url,
+                  client=None):
+    """
+    Send an STK push for the tenant, unless one for the same amount is still in flight.
+
+    Returns (checkout_request_id, response), with response None when the request is
+    answered with the push already in flight: pressing Pay again within
+    MPESA_STK_DEDUP_SECONDS, or before the callback, does not send another prompt. Raises
+    StkPushThrottled when the tenant or the whole app is over its STK push limit, and
+    MpesaConnectionError when Daraja cannot be reached.
+    """
+    key = _inflight_key(tenant_id, amount)
+    timeout = settings.MPESA_STK_DEDUP_SECONDS
+    # A push that failed in the meantime frees the key again, so try more than once
+    for _ in range(3):
+        if cache.add(key, PUSH_SENDING, timeout):
+            break
+        checkout_request_id = _await_push(key)
+        if checkout_request_id == PUSH_SENDING:
+            raise StkPushThrottled(PUSH_SENDING_WAIT)
+        if checkout_request_id:
+            metrics.record_stk_push_deduplicated()
+            return checkout_request_id, None
+    else:
+        raise StkPushThrottled(1)
+
+    try:
+        limits = [
+            (TokenBucket('stk_push_tenant', *settings.MPESA_STK_TENANT_LIMIT), tenant_id),
+            (TokenBucket('stk_push', *settings.MPESA_STK_GLOBAL_LIMIT), ''),
+        ]
+        for bucket, bucket_key in limits:
+            wait = bucket.take(bucket_key)
+            if wait:
+                raise StkPushThrottled(wait)
+        response = (client or DarajaClient()).stk_push(
+            phone_number=phone_number,
+            amount=amount,
+            account_reference=account_reference,
+            transaction_desc=transaction_desc,
+            callback_url=callback_url,
+        )
+    except BaseException:
+        cache.delete(key)
+        raise
+
+    checkout_request_id = getattr(response, 'checkout_request_id', None)
+    if getattr(response, 'response_code', None) == '0' and checkout_request_id:
+        cache.set(key, checkout_request_id, timeout)
+        cache.set(_inflight_by_checkout_key(checkout_request_id), key, timeout)
+        try:
+            StkPush.objects.create(
+                checkout_request_id=checkout_request_id, merchant_request_id=response.merchant_request_id or '',
+                tenant_id=tenant_id, phone_number=phone_number, amount=amount,
+            )
+        except DatabaseError:
+            # The push went out; its callback can still record it, only the poller cannot
+            logger.exception('Could not save STK push %s', checkout_request_id)
+    else:
+        cache.delete(key)
+    return checkout_request_id, response
+
+
+def _push_answered(checkout_request_id):
+    # The tenant may pay the same amount again once the prompt was answered
+    by_checkout_key = _inflight_by_checkout_key(checkout_request_id)
+    key = cache.get(by_checkout_key)
+    if key and cache.get(key) == checkout_request_id:
+        cache.delete(key)
+    cache.delete(by_checkout_key)
+
+
+def status_cache_key(checkout_request_id):
+    return f'mpesa:status:{checkout_request_id}'
+
+
+def parse_stk_callback(data):
+    """Flatten a Daraja STK callback body into a dict keyed by the callback field names."""
+    callback = data.get('Body', {}).get('stkCallback', {})
+    result = {
+        'ResultCode': callback.get('ResultCode'),
+        'ResultDesc': callback.get('ResultDesc'),
+        'MerchantRequestID': callback.get('MerchantRequestID'),
+        'CheckoutRequestID': callback.get('CheckoutRequestID'),
+    }
+    for item in callback.get('CallbackMetadata', {}).get('Item', []):
+        result[item.get('Name')] = item.get('Value')
+    return result
+
+
+def record_stk_callback(data):
+    """Record the outcome of an STK push from its callback; see record_stk_result()."""
+    result = parse_stk_callback(data)
+    metrics.record_callback(result)
+    return record_stk_result(result, 'callback')
+
+
+def record_stk_result(result, source):
+    """
+    Record the outcome of an STK push and wake anyone waiting on it. `result` is shaped
+    like parse_stk_callback()'s and `source` says where it came from ('callback' or
+    'query', see poll_stk_pushes()).
+
+    A successful outcome creates the Payment once. The StkPush is claimed with a
+    conditional UPDATE in the same transaction, so Safaricom retrying a callback, or a
+    late callback racing the poller, cannot record the payment twice.
+    """
+    checkout_request_id = result['CheckoutRequestID']
+    succeeded = result['ResultCode'] == 0
+    push = None
+    if checkout_request_id:
+        push = StkPush.objects.select_related('tenant').filter(checkout_request_id=checkout_request_id).first()
+    tenant_user_id = push.tenant.user_id if push is not None and push.tenant_id else None
+    status = _failed_status(checkout_request_id, result['ResultDesc'], tenant_user_id)
+
+    with transaction.atomic():
+        # An expired push may still be answered by a late callback
+        claimed = push is not None and StkPush.objects.filter(pk=push.pk, status__in=['pending', 'expired']).update(
+            status='completed' if succeeded else 'failed', result_code=result['ResultCode'],
+            result_desc=(result['ResultDesc'] or '')[:255], source=source, answered_at=timezone.now(),
+        ) == 1
+        if succeeded:
+            status = _record_payment(result, push, claimed, status)
+
+    if checkout_request_id:
+        cache.set(status_cache_key(checkout_request_id), status, STATUS_CACHE_TIMEOUT)
+        _push_answered(checkout_request_id)
+        notify_payment_status(checkout_request_id)
+    return status
+
+
+def _record_payment(result, push, claimed, status):
+    checkout_request_id = result['CheckoutRequestID']
+    amount = result.get('Amount') or (push.amount if push else None)
+    if push is not None and push.tenant_id:
+        tenant = push.tenant
+    else:
+        tenant = Tenant.objects.filter(phone__endswith=str(result.get('PhoneNumber'))[-9:]).first()
+
+    if tenant and amount:
+        payment = Payment.objects.filter(checkout_request_id=checkout_request_id).first()
+        # Pushes that are saved are only ever recorded by whoever claimed them
+        if payment is None and (claimed or push is None):
+            payment = Payment.objects.create(
+                tenant=tenant,
+                amount=amount,
+                payment_type='rent',
+                payment_method='mpesa',
+                payment_date=timezone.now().date(),
+                reference_number=result.get('MpesaReceiptNumber') or '',
+                description=f'M-Pesa payment - {checkout_request_id}',
+                status='completed',
+                checkout_request_id=checkout_request_id,
+            )
+        if payment is not None:
+            return _payment_status(checkout_request_id, payment.pk, payment.amount,
+                                   payment.reference_number, tenant.user_id)
+    status['result_desc'] = NO_TENANT_FOUND
+    return status
+
+
+def _payment_status(checkout_request_id, payment_id, amount, receipt, tenant_user_id):
+    return {
+        'checkout_request_id': checkout_request_id,
+        'status': 'completed',
+        'result_desc': 'Payment received',
+        'payment_id': payment_id,
+        'amount': f'{Decimal(amount):.2f}',
+        'receipt': receipt,
+        'tenant_user_id': tenant_user_id,
+    }
+
+
+def _failed_status(checkout_request_id, result_desc, tenant_user_id):
+    return {
+        'checkout_request_id': checkout_request_id,
+        'status': 'failed',
+        'result_desc': result_desc,
+        'tenant_user_id': tenant_user_id,
+    }
+
+
+def _pending_status(checkout_request_id, tenant_user_id):
+    return {'checkout_request_id': checkout_request_id, 'status': 'pending', 'tenant_user_id': tenant_user_id}
+
+
+async def aget_payment_status(checkout_request_id):
+    status = await cache.aget(status_cache_key(checkout_request_id))
+    metrics.record_cache('payment_status', status is not None)
+    if status is None:
+        payment = await Payment.objects.filter(checkout_request_id=checkout_request_id).values(
+            'pk', 'amount', 'reference_number', 'tenant__user_id'
+        ).afirst()
+        if payment is not None:
+            return _payment_status(checkout_request_id, payment['pk'], payment['amount'],
+                                   payment['reference_number'], payment['tenant__user_id'])
+        # Not in this process's cache, e.g. the callback was handled by another worker
+        push = await StkPush.objects.filter(checkout_request_id=checkout_request_id).values(
+            'status', 'result_desc', 'tenant__user_id'
+        ).afirst()
+        if push is None:
+            return _pending_status(checkout_request_id, None)
+        if push['status'] == 'failed':
+            return _failed_status(checkout_request_id, push['result_desc'], push['tenant__user_id'])
+        if push['status'] == 'completed':
+            return _failed_status(checkout_request_id, NO_TENANT_FOUND, push['tenant__user_id'])
+        # An expired push may still be answered by a late callback
+        status = _pending_status(checkout_request_id, push['tenant__user_id'])
+    return status
+
+
+def notify_payment_status(checkout_request_id):
+    with _waiters_lock:
+        waiters = list(_waiters.get(checkout_request_id, ()))
+    for loop, event in waiters:
+        loop.call_soon_threadsafe(event.set)
+
+
+def _add_waiter(checkout_request_id):
+    waiter = (asyncio.get_running_loop(), asyncio.Event())
+    with _waiters_lock:
+        _waiters.setdefault(checkout_request_id, set()).add(waiter)
+    return waiter
+
+
+def _remove_waiter(checkout_request_id, waiter):
+    with _waiters_lock:
+        waiters = _waiters.get(checkout_request_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del _waiters[checkout_request_id]
+
+
+async def await_payment_status(checkout_request_id, timeout=0):
+    """
+    Return the payment status, waiting up to `timeout` seconds for it to leave 'pending'.
+
+    Callbacks handled by this process wake the waiter immediately. Callbacks handled by
+    another worker are picked up on the next re-check every MPESA_STATUS_RECHECK_SECONDS,
+    from the shared cache or, with a per-process one, from the Payment and StkPush rows.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        # Register before checking so a callback landing in between is not missed
+        waiter = _add_waiter(checkout_request_id)
+        try:
+            status = await aget_payment_status(checkout_request_id)
+            remaining = deadline - loop.time()
+            if status['status'] != 'pending' or remaining <= 0:
+                return status
+            try:
+                await asyncio.wait_for(
+                    waiter[1].wait(), min(remaining, settings.MPESA_STATUS_RECHECK_SECONDS)
+                )
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            _remove_waiter(checkout_request_id, waiter)
+
+
+async def _query_pushes(client, pushes, concurrency):
+    # requests is blocking, so the queries run on threads, at most `concurrency` at a time
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def query(push):
+        async with semaphore:
+            try:
+                response = await loop.run_in_executor(executor, client.stk_query, push.checkout_request_id)
+            except MpesaConnectionError as e:
+                logger.warning('STK query for %s failed: %s', push.checkout_request_id, e)
+                return push, None
+            return push, response.json()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='stk-query') as executor:
+        return await asyncio.gather(*(query(push) for push in pushes))
+
+
+def poll_stk_pushes(client=None, older_than=None, concurrency=None, limit=500):
+    """
+    Look up the STK pushes that are still pending `older_than`
+    (MPESA_STK_QUERY_AFTER_SECONDS) seconds after they were sent, or last looked up, with
+    concurrent STK queries, and record the answers through record_stk_result() as if their
+    callbacks had come. A push Daraja still has no answer for after
+    MPESA_STK_QUERY_MAX_ATTEMPTS queries is marked expired.
+
+    Returns the number of pushes by outcome, e.g. {'completed': 3, 'failed': 1, 'pending': 2}.
+    """
+    if older_than is None:
+        older_than = settings.MPESA_STK_QUERY_AFTER_SECONDS
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=older_than)
+    pushes = list(StkPush.objects.filter(
+        Q(last_queried_at__isnull=True) | Q(last_queried_at__lte=cutoff),
+        status='pending', created_at__lte=cutoff,
+    ).order_by('created_at')[:limit])
+    outcomes = Counter()
+    if not pushes:
+        return outcomes
+
+    client = client or DarajaClient()
+    # Fetch the token once rather than in every thread
+    client.access_token()
+    unanswered = []
+    for push, answer in asyncio.run(_query_pushes(client, pushes, concurrency or settings.MPESA_STK_QUERY_CONCURRENCY)):
+        # Daraja answers '500.001.1001' (still being processed) until the customer responds
+        if not answer or answer.get('ResultCode') in (None, ''):
+            metrics.record_stk_query('unanswered')
+            unanswered.append(push.pk)
+            continue
+        metrics.record_stk_query('answered')
+        status = record_stk_result({
+            'ResultCode': int(answer['ResultCode']),
+            'ResultDesc': answer.get('ResultDesc'),
+            'MerchantRequestID': answer.get('MerchantRequestID'),
+            'CheckoutRequestID': push.checkout_request_id,
+            'Amount': push.amount,
+            'PhoneNumber': push.phone_number,
+        }, 'query')
+        outcomes[status['status']] += 1
+
+    if unanswered:
+        StkPush.objects.filter(pk__in=unanswered).update(queries=F('queries') + 1, last_queried_at=now)
+        expired = StkPush.objects.filter(
+            pk__in=unanswered, status='pending', queries__gte=settings.MPESA_STK_QUERY_MAX_ATTEMPTS,
+        ).update(status='expired', answered_at=now, result_desc='No answer from Daraja')
+        outcomes.update({'expired': expired, 'pending': len(unanswered) - expired})
+    return +outcomes
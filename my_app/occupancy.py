@@ -0,0 +1,121 @@
+"""
+Occupancy history: daily snapshots per property and unit type, and the trends read from them.
+
+Reports never scan Unit for history; they only aggregate the (small) snapshot table. A
+snapshot holds the statuses units had at the end of its day, rebuilt from UnitStatusChange,
+so days the job missed can be filled in afterwards (backfill_snapshots()).
+"""
+from datetime import date, datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Max, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncMonth, TruncYear
+from django.utils import timezone
+
+from .caching import bump_model_version
+from .models import Unit, UnitStatusChange, OccupancySnapshot
+
+TREND_MONTHS = 24
+# Most days backfill_snapshots() fills in after an outage
+MAX_BACKFILL_DAYS = 90
+
+
+def units_at(moment):
+    """
+    Units as they were at `moment`, annotated with their `status_then`: the old status of
+    their first later change, or their status now. Units created later are left out.
+    """
+    later = UnitStatusChange.objects.filter(unit_id=OuterRef('pk'), changed_at__gte=moment).order_by('changed_at', 'pk')
+    return (Unit.all_objects.filter(Q(deleted_at__isnull=True) | Q(deleted_at__gte=moment))
+            .annotate(status_then=Coalesce(Subquery(later.values('old_status')[:1]), F('status')))
+            .exclude(status_then=''))
+
+
+def take_snapshot(day=None):
+    """
+    Record the unit counts at the end of today (or `day`). The counts come from one grouped
+    query over Unit and its status history; an existing snapshot for the same day is
+    replaced, so the job can be re-run. Returns the number of rows written.
+    """
+    day = day or timezone.localdate()
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time()))
+    counts = (units_at(end).order_by().values('property_id', 'unit_type').annotate(
+        total=Count('pk'),
+        occupied=Count('pk', filter=Q(status_then='occupied')),
+        available=Count('pk', filter=Q(status_then='available')),
+        maintenance=Count('pk', filter=Q(status_then='maintenance')),
+        reserved=Count('pk', filter=Q(status_then='reserved')),
+    ))
+    snapshots = [
+        OccupancySnapshot(
+            date=day, property_id=row['property_id'], unit_type=row['unit_type'],
+            total_units=row['total'], occupied_units=row['occupied'], available_units=row['available'],
+            maintenance_units=row['maintenance'], reserved_units=row['reserved'],
+        )
+        for row in counts
+    ]
+    with transaction.atomic():
+        OccupancySnapshot.objects.filter(date=day).delete()
+        OccupancySnapshot.objects.bulk_create(snapshots)
+    bump_model_version(OccupancySnapshot)
+    return len(snapshots)
+
+
+def backfill_snapshots(today=None, max_days=MAX_BACKFILL_DAYS):
+    """
+    Take the snapshot of today and of every day since the latest one, at most `max_days`
+    back. Returns the number of rows written.
+    """
+    today = today or timezone.localdate()
+    latest = OccupancySnapshot.objects.filter(date__lt=today).aggregate(latest=Max('date'))['latest']
+    first = max(latest + timedelta(days=1), today - timedelta(days=max_days)) if latest else today
+    return sum(take_snapshot(first + timedelta(days=n)) for n in range((today - first).days + 1))
+
+
+def _rate(occupied, total):
+    return round(occupied / total * 100, 1) if total else 0
+
+
+def occupancy_trends(months=TREND_MONTHS, today=None, property_ids=None):
+    """
+    Average occupancy per month (overall and per unit type) over the last `months` months,
+    and per year over all snapshots, of `property_ids` or the whole portfolio. Averages
+    weigh every snapshot day equally.
+    """
+    snapshots = OccupancySnapshot.objects.in_scope(property_ids)
+    today = today or timezone.localdate()
+    year, month = divmod(today.year * 12 + today.month - months, 12)
+    first_month = date(year, month + 1, 1)
+
+    monthly = (snapshots.filter(date__gte=first_month)
+               .annotate(month=TruncMonth('date'))
+               .values('month', 'unit_type')
+               .annotate(occupied=Sum('occupied_units'), total=Sum('total_units'))
+               .order_by('month', 'unit_type'))
+
+    labels = []
+    overall = {}
+    by_type = {}
+    for row in monthly:
+        label = row['month'].strftime('%Y-%m')
+        if label not in overall:
+            labels.append(label)
+            overall[label] = [0, 0]
+        overall[label][0] += row['occupied']
+        overall[label][1] += row['total']
+        by_type.setdefault(row['unit_type'], {})[label] = _rate(row['occupied'], row['total'])
+
+    yearly = (snapshots.annotate(year=TruncYear('date'))
+              .values('year')
+              .annotate(occupied=Sum('occupied_units'), total=Sum('total_units'))
+              .order_by('year'))
+
+    return {
+        'months': labels,
+        'monthly': [_rate(*overall[label]) for label in labels],
+        'monthly_by_type': {
+            unit_type: [rates.get(label) for label in labels] for unit_type, rates in sorted(by_type.items())
+        },
+        'years': [row['year'].year for row in yearly],
+        'yearly': [_rate(row['occupied'], row['total']) for row in yearly],
+    }
@@ -0,0 +1,215 @@
+"""
+Resizing uploaded photos in the background.
+
+An upload only stores the original and a pending Photo. Once the upload's transaction
+commits, enqueue() hands the photo to a small thread pool in the same process, which
+makes WebP and JPEG renditions PHOTO_WIDTHS wide (never wider than the original) and
+marks the photo ready. Pages only show ready photos, through their renditions, so neither
+the upload nor a page view waits for Pillow, and no page sends a full-size original.
+
+Photos are claimed with a conditional UPDATE, so each is processed once however many
+workers see it. The process_photos job (jobs.py) picks up what the threads never got to:
+photos uploaded by a process that exited, and claims whose worker died, after
+PHOTO_PROCESSING_TIMEOUT seconds. A photo that fails PHOTO_MAX_ATTEMPTS times is marked
+failed.
+
+Renditions are named after a hash of their content, so they can be cached for good (see
+views.photo_rendition), and identical uploads share them.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import metrics
+from .models import Photo
+
+logger = logging.getLogger(__name__)
+
+RENDITION_DIR = 'photos/r'
+# format: (Pillow format, file extension, save options)
+FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# Names of renditions under RENDITION_DIR; nothing else there is served
+RENDITION_NAME = re.compile(r'[0-9a-f]{2}/[0-9a-f]{20}-\d+\.(?:webp|jpg)')
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _stale(now):
+    return now - timedelta(seconds=settings.PHOTO_PROCESSING_TIMEOUT)
+
+
+def _claimable(now):
+    return Q(status='pending') | Q(status='processing', processing_started_at__lt=_stale(now))
+
+
+def claim(photo_id):
+    """Take a photo for processing. Returns False if another worker has it or it is done."""
+    now = timezone.now()
+    claimed = Photo.objects.filter(_claimable(now), pk=photo_id, attempts__lt=settings.PHOTO_MAX_ATTEMPTS)
+    return bool(claimed.update(status='processing', processing_started_at=now, attempts=F('attempts') + 1))
+
+
+def _encode(image, kind):
+    pil_format, _, options = FORMATS[kind]
+    if kind == 'jpeg' and image.mode == 'RGBA':
+        # JPEG has no transparency: flatten onto white
+        flattened = Image.new('RGB', image.size, 'white')
+        flattened.paste(image, mask=image.getchannel('A'))
+        image = flattened
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def _store(data, width, extension):
+    content_hash = hashlib.sha256(data).hexdigest()[:20]
+    name = f'{RENDITION_DIR}/{content_hash[:2]}/{content_hash}-{width}.{extension}'
+    if not default_storage.exists(name):
+        saved = default_storage.save(name, ContentFile(data))
+        if saved != name:
+            # Another worker stored the same bytes first and the storage picked a new name
+            default_storage.delete(saved)
+    return name
+
+
+def render(photo):
+    """Make and store the renditions of `photo`. Returns (digest of the original, renditions)."""
+    with default_storage.open(photo.image.name, 'rb') as original:
+        data = original.read()
+    widths = sorted(set(settings.PHOTO_WIDTHS), reverse=True)
+    renditions = {kind: [] for kind in FORMATS}
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEGs are only decoded at the smallest scale still wider than the widest rendition
+        image.draft('RGB', (widths[0], widths[0]))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if transparent else 'RGB')
+        # Widest first, each one scaled down from the last
+        for width in sorted({min(width, image.width) for width in widths}, reverse=True):
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            for kind, (_, extension, _) in FORMATS.items():
+                renditions[kind].insert(0, [width, height, _store(_encode(image, kind), width, extension)])
+    return hashlib.sha256(data).hexdigest(), renditions
+
+
+def process(photo_id):
+    """Make the renditions of a photo unless another worker has it. Returns its new status, or None."""
+    if not claim(photo_id):
+        return None
+    started = time.perf_counter()
+    photo = Photo.objects.filter(pk=photo_id).first()
+    if photo is None:
+        return None
+    processing = Photo.objects.filter(pk=photo_id, status='processing')
+    try:
+        digest, renditions = render(photo)
+    except Exception as exc:
+        logger.exception('Could not make the renditions of photo %s', photo_id)
+        status = 'failed' if photo.attempts >= settings.PHOTO_MAX_ATTEMPTS else 'pending'
+        processing.update(status=status, error=f'{type(exc).__name__}: {exc}')
+        metrics.record_photo_processed(started, 'failed')
+        return status
+    if not processing.update(status='ready', digest=digest, renditions=renditions, error='',
+                             processed_at=timezone.now()):
+        # Deleted while it was being processed
+        discard([(photo.image.name, digest, renditions)])
+        return None
+    metrics.record_photo_processed(started, 'ready')
+    return 'ready'
+
+
+def process_pending(limit=100, check=None):
+    """
+    Process up to `limit` photos that no worker has: pending ones and stale claims, oldest
+    first. `check` is called before each one. Returns {status: count}.
+    """
+    now = timezone.now()
+    Photo.objects.filter(status='processing', processing_started_at__lt=_stale(now),
+                         attempts__gte=settings.PHOTO_MAX_ATTEMPTS).update(
+        status='failed', error=f'Gave up after {settings.PHOTO_MAX_ATTEMPTS} attempts',
+    )
+    outcomes = Counter()
+    for photo_id in Photo.objects.filter(_claimable(now)).order_by('created_at').values_list('pk', flat=True)[:limit]:
+        if check:
+            check()
+        outcomes[process(photo_id) or 'skipped'] += 1
+    return +outcomes
+
+
+def _executor_for_process():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Also after a fork (e.g. gunicorn --preload), where the parent's threads do not exist
+        if _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(settings.PHOTO_WORKERS, thread_name_prefix='photos')
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _process_in_background(photo_id):
+    try:
+        process(photo_id)
+    except Exception:
+        # Left to the process_photos job
+        logger.exception('Background processing of photo %s failed', photo_id)
+    finally:
+        connection.close_if_unusable_or_obsolete()
+
+
+def enqueue(photo_ids):
+    """Process these photos in the background once the current transaction commits."""
+    if not settings.PHOTO_WORKERS:
+        return
+    photo_ids = list(photo_ids)
+
+    def submit():
+        executor = _executor_for_process()
+        for photo_id in photo_ids:
+            executor.submit(_process_in_background, photo_id)
+
+    transaction.on_commit(submit)
+
+
+def files(photos):
+    """The files of `photos` (a queryset), for discard() once they are deleted."""
+    return list(photos.values_list('image', 'digest', 'renditions'))
+
+
+def discard(photo_files):
+    """
+    Delete the files of deleted photos, given as (original, digest, renditions) tuples.
+    Renditions are kept while another photo of the same original still uses them.
+    """
+    digests = {digest for _, digest, _ in photo_files if digest}
+    in_use = set(Photo.objects.filter(digest__in=digests).values_list('digest', flat=True)) if digests else set()
+    for original, digest, renditions in photo_files:
+        names = [original] if original else []
+        if digest not in in_use:
+            names += [name for sources in renditions.values() for _, _, name in sources]
+        for name in names:
+            try:
+                default_storage.delete(name)
+            except OSError:
+                logger.warning('Could not delete photo file %s', name, exc_info=True)
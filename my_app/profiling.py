@@ -0,0 +1,276 @@
+"""
+On-demand profiling of a single request, for staff.
+
+Add ?_profile=1 (or the header `X-Profile: 1`) to any URL while logged in as staff. The
+view runs under cProfile plus a stack sampler, every SQL query is traced with its timing and
+EXPLAIN plan, and the results are written to PROFILE_DIR:
+
+    <id>.pstats   -- cProfile stats (python -m pstats, snakeviz)
+    <id>.folded   -- collapsed stacks (flamegraph.pl, speedscope)
+    <id>.json     -- request info and the SQL trace
+
+The response carries X-Profile-Id and X-Profile-Url headers pointing at the download view,
+which serves a profile only to the user it was taken for, and to superusers.
+`?_profile=sample` skips cProfile and only samples, which distorts timings much less.
+Other requests only pay for a substring check on the query string and headers.
+"""
+import cProfile
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.urls import reverse
+from django.utils import timezone
+
+PROFILE_FILES = {
+    'pstats': 'application/octet-stream',
+    'folded': 'text/plain',
+    'json': 'application/json',
+}
+PROFILE_ID_RE = re.compile(r'^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$')
+MAX_EXPLAINED_QUERIES = 50
+
+
+def profile_dir():
+    return settings.PROFILE_DIR
+
+
+def profile_path(profile_id, kind):
+    if not PROFILE_ID_RE.match(profile_id) or kind not in PROFILE_FILES:
+        raise FileNotFoundError(profile_id)
+    return os.path.join(profile_dir(), f'{profile_id}.{kind}')
+
+
+def profile_owner(profile_id):
+    """Id of the user whose request was profiled (None if unknown); FileNotFoundError without a profile."""
+    with open(profile_path(profile_id, 'json')) as f:
+        return json.load(f).get('user_id')
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of one thread every `interval` seconds into collapsed-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code.co_filename != __file__:
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class SQLTrace:
+    """execute_wrapper that records every query with its duration."""
+
+    def __init__(self, alias):
+        self.alias = alias
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'alias': self.alias,
+                'sql': sql,
+                'params': None if many else _jsonable(params),
+                'many': many,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 3),
+            })
+
+
+def _jsonable(params):
+    if params is None:
+        return None
+    return [p if isinstance(p, (int, float, str, bool, type(None))) else str(p) for p in params]
+
+
+def explain(queries):
+    """Attach EXPLAIN output to the slowest distinct SELECTs of a trace."""
+    seen = set()
+    candidates = []
+    for query in sorted(queries, key=lambda q: q['duration_ms'], reverse=True):
+        key = (query['alias'], query['sql'])
+        if query['many'] or key in seen or not query['sql'].lstrip().upper().startswith('SELECT'):
+            continue
+        seen.add(key)
+        candidates.append(query)
+
+    for query in candidates[:MAX_EXPLAINED_QUERIES]:
+        connection = connections[query['alias']]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(f"{connection.ops.explain_query_prefix()} {query['sql']}", query['params'])
+                query['explain'] = [' '.join(str(col) for col in row) for row in cursor.fetchall()]
+        except Exception as e:
+            query['explain'] = [f'EXPLAIN failed: {e}']
+
+
+def _summary(queries):
+    by_sql = Counter(q['sql'] for q in queries)
+    return {
+        'count': len(queries),
+        'total_ms': round(sum(q['duration_ms'] for q in queries), 3),
+        'duplicates': {sql: n for sql, n in by_sql.most_common(10) if n > 1},
+    }
+
+
+def _prune(directory, keep):
+    """Keep the newest `keep` profiles."""
+    ids = sorted({name.split('.')[0] for name in os.listdir(directory) if PROFILE_ID_RE.match(name.split('.')[0])})
+    for profile_id in ids[:-keep] if keep else []:
+        for kind in PROFILE_FILES:
+            try:
+                os.remove(os.path.join(directory, f'{profile_id}.{kind}'))
+            except FileNotFoundError:
+                pass
+
+
+class Profile:
+    """The profilers and SQL traces around one request; `finish` writes out the results."""
+
+    def __init__(self, request, cprofile=True):
+        self.request = request
+        self.profile_id = f"{timezone.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self.traces = [SQLTrace(alias) for alias in connections]
+        self.profiler = cProfile.Profile() if cprofile else None
+        self.sampler = StackSampler(threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL)
+        self._stack = ExitStack()
+
+    def __enter__(self):
+        stack = self._stack.__enter__()
+        for trace in self.traces:
+            stack.enter_context(connections[trace.alias].execute_wrapper(trace))
+        self.sampler.start()
+        stack.callback(self.sampler.stop)
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+                stack.callback(self.profiler.disable)
+            except ValueError:
+                # Another request is already under cProfile; fall back to sampling only
+                self.profiler = None
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = (time.perf_counter() - self.started) * 1000
+        return self._stack.__exit__(*exc_info)
+
+    def finish(self, response):
+        request, profile_id, profiler, sampler = self.request, self.profile_id, self.profiler, self.sampler
+        queries = [query for trace in self.traces for query in trace.queries]
+        explain(queries)
+
+        directory = profile_dir()
+        os.makedirs(directory, exist_ok=True)
+        kinds = ['folded', 'json']
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(directory, f'{profile_id}.pstats'))
+            kinds.insert(0, 'pstats')
+        with open(os.path.join(directory, f'{profile_id}.folded'), 'w') as f:
+            f.write(sampler.folded())
+        with open(os.path.join(directory, f'{profile_id}.json'), 'w') as f:
+            json.dump({
+                'id': profile_id,
+                'created_at': timezone.now().isoformat(),
+                'method': request.method,
+                'path': request.get_full_path(),
+                'view': getattr(request.resolver_match, 'view_name', None),
+                'user': request.user.get_username(),
+                'user_id': request.user.pk,
+                'status': response.status_code,
+                'mode': 'cprofile' if profiler is not None else 'sample',
+                'elapsed_ms': round(self.elapsed, 3),
+                'samples': sum(sampler.stacks.values()),
+                'sql': _summary(queries),
+                'queries': queries,
+            }, f, indent=2)
+        _prune(directory, settings.PROFILE_KEEP)
+
+        response['X-Profile-Id'] = profile_id
+        response['X-Profile-Url'] = ', '.join(
+            request.build_absolute_uri(reverse('profile_download', args=[profile_id, kind])) for kind in kinds
+        )
+        return response
+
+
+def _is_staff(user):
+    return user is not None and (user.is_staff or user.is_superuser)
+
+
+class ProfilerMiddleware:
+    """Profiles requests from staff that ask for it; see the module docstring."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not (settings.PROFILE_ENABLED and self._requested(request)):
+            return self.get_response(request)
+        if not _is_staff(getattr(request, 'user', None)):
+            return self.get_response(request)
+        return self.profile(request)
+
+    async def __acall__(self, request):
+        if not (settings.PROFILE_ENABLED and self._requested(request)):
+            return await self.get_response(request)
+        auser = getattr(request, 'auser', None)
+        if not _is_staff(await auser() if auser else None):
+            return await self.get_response(request)
+        return await self.aprofile(request)
+
+    def _requested(self, request):
+        if 'HTTP_X_PROFILE' in request.META:
+            return True
+        return '_profile' in request.META.get('QUERY_STRING', '') and '_profile' in request.GET
+
+    def _mode(self, request):
+        return request.GET.get('_profile') or request.META.get('HTTP_X_PROFILE') or '1'
+
+    def profile(self, request):
+        with Profile(request, cprofile=self._mode(request) != 'sample') as profile:
+            response = self.get_response(request)
+        return profile.finish(response)
+
+    async def aprofile(self, request):
+        # cProfile on the event loop would also count every other request it serves, so async
+        # views are only sampled. Their ORM calls run in a worker thread, outside the SQL trace.
+        with Profile(request, cprofile=False) as profile:
+            response = await self.get_response(request)
+        return await sync_to_async(profile.finish)(response)
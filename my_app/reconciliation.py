@@ -0,0 +1,365 @@
+"""
+Reconcile M-Pesa and bank statement CSVs against recorded payments.
+
+The statement is read as a stream and handled in chunks of `chunk_size` lines, so memory
+stays bounded however long the file is. For every chunk the candidate payments are
+loaded with two indexed queries (by receipt number, and by date window) into hash
+indexes, and each credit line is matched:
+
+1. by receipt number (Payment.reference_number), exactly;
+2. otherwise by tenant (phone number, or a RENT-<tenant id> account reference) plus an
+   amount within `amount_tolerance` and a date within `date_window` days.
+
+Lines that match nothing but belong to a known tenant are missing payments; with
+`create_missing` they are bulk-created, and recorded in the audit trail as the work of
+`user`. Lines whose receipt appeared earlier in the same
+statement, or that match several payments with the same receipt, are flagged duplicate.
+"""
+import csv
+import re
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import partial
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from . import audit
+from .archive import reaches_archive
+from .caching import bump_model_version
+from .metrics import record_payments_created
+from .models import Tenant, Payment, PaymentArchive
+
+# Canonical field -> candidate CSV headers, per statement format
+STATEMENT_FORMATS = {
+    'mpesa': {
+        'method': 'mpesa',
+        'columns': {
+            'receipt': ['Receipt No.', 'Receipt No', 'Receipt', 'TransID'],
+            'date': ['Completion Time', 'Transaction Time', 'Date', 'TransTime'],
+            'amount': ['Paid In', 'Amount', 'TransAmount'],
+            'phone': ['Other Party Info', 'MSISDN', 'Phone'],
+            'reference': ['Details', 'Account', 'BillRefNumber', 'Reference'],
+            'status': ['Transaction Status', 'Status'],
+        },
+        'date_formats': ['%Y-%m-%d %H:%M:%S', '%d-%m-%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%Y%m%d%H%M%S', '%Y-%m-%d'],
+    },
+    'bank': {
+        'method': 'bank_transfer',
+        'columns': {
+            'receipt': ['Reference', 'Transaction Reference', 'Ref'],
+            'date': ['Value Date', 'Transaction Date', 'Date'],
+            'amount': ['Credit', 'Money In', 'Amount'],
+            'phone': ['Phone'],
+            'reference': ['Description', 'Narrative', 'Details'],
+            'status': [],
+        },
+        'date_formats': ['%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d %b %Y'],
+    },
+}
+
+ACCOUNT_REFERENCE_RE = re.compile(r'RENT-(\d+)', re.I)
+PHONE_RE = re.compile(r'(?<!\d)(?:\+?254|0)?([17]\d{8})(?!\d)')
+
+MATCHED = 'matched'
+MATCHED_FUZZY = 'matched_fuzzy'
+CREATED = 'created'
+MISSING = 'missing'
+UNMATCHED = 'unmatched'
+DUPLICATE = 'duplicate'
+SKIPPED = 'skipped'
+INVALID = 'invalid'
+
+
+class StatementError(ValueError):
+    pass
+
+
+@dataclass
+class StatementLine:
+    line_no: int
+    receipt: str
+    date: object
+    amount: Decimal
+    phone: str = ''
+    tenant_id: int = None
+    reference: str = ''
+
+
+@dataclass
+class LineResult:
+    line_no: int
+    outcome: str
+    receipt: str = ''
+    amount: object = ''
+    date: object = ''
+    payment_id: int = None
+    tenant_id: int = None
+    note: str = ''
+
+
+@dataclass
+class ReconciliationSummary:
+    counts: dict = field(default_factory=lambda: defaultdict(int))
+    amounts: dict = field(default_factory=lambda: defaultdict(Decimal))
+
+    def add(self, result):
+        self.counts[result.outcome] += 1
+        if result.amount != '':
+            self.amounts[result.outcome] += result.amount
+
+
+def phone_key(value):
+    """Last nine digits of a Kenyan mobile number, the part every format has in common."""
+    match = PHONE_RE.search(re.sub(r'(?<=\d)[\s-](?=\d)', '', str(value or '')))
+    return match.group(1) if match else ''
+
+
+def _parse_amount(value):
+    value = (value or '').replace(',', '').replace('KES', '').strip()
+    if not value:
+        return None
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise StatementError(f'Invalid amount: {value!r}')
+
+
+def _parse_date(value, formats):
+    value = (value or '').strip()
+    try:
+        # ISO dates are most statements' format; fromisoformat is much faster than strptime
+        return datetime.fromisoformat(value).date()
+    except ValueError:
+        pass
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise StatementError(f'Invalid date: {value!r}')
+
+
+def _resolve_columns(fieldnames, statement_format):
+    headers = {name.strip().lower(): name for name in fieldnames or []}
+    columns = {}
+    for canonical, candidates in statement_format['columns'].items():
+        columns[canonical] = next((headers[c.lower()] for c in candidates if c.lower() in headers), None)
+    missing = [name for name in ('date', 'amount') if columns[name] is None]
+    if missing:
+        raise StatementError(f"Statement has no {' or '.join(missing)} column (headers: {', '.join(fieldnames or [])})")
+    return columns
+
+
+class Reconciler:
+    def __init__(self, statement_format='mpesa', date_window=3, amount_tolerance=Decimal('0'),
+                 create_missing=False, chunk_size=5000, user=None):
+        try:
+            self.format = STATEMENT_FORMATS[statement_format]
+        except KeyError:
+            raise StatementError(f'Unknown statement format: {statement_format}')
+        self.date_window = timedelta(days=date_window)
+        self.amount_tolerance = Decimal(amount_tolerance)
+        self.create_missing = create_missing
+        self.chunk_size = chunk_size
+        self.user = user
+        self.summary = ReconciliationSummary()
+        self._seen_receipts = set()
+        self._claimed_payments = set()
+        self._tenants_by_phone = None
+        self._known_tenants = None
+
+    def _load_tenants(self):
+        """phone key -> tenant id; active tenants win over past ones with the same number."""
+        by_phone = {}
+        known = set()
+        for pk, phone, status in Tenant.objects.order_by('pk').values_list('pk', 'phone', 'status').iterator():
+            known.add(pk)
+            key = phone_key(phone)
+            if key and (key not in by_phone or status == 'active'):
+                by_phone[key] = pk
+        self._tenants_by_phone = by_phone
+        self._known_tenants = known
+
+    def _lines(self, rows, columns):
+        status_column = columns['status']
+        for line_no, row in rows:
+            if status_column and row.get(status_column, '').strip().lower() not in ('', 'completed', 'success'):
+                yield LineResult(line_no, SKIPPED, note=f'status {row[status_column]}')
+                continue
+            try:
+                amount = _parse_amount(row.get(columns['amount']))
+                if amount is None or amount <= 0:
+                    yield LineResult(line_no, SKIPPED, note='not a credit')
+                    continue
+                date = _parse_date(row.get(columns['date']), self.format['date_formats'])
+            except StatementError as e:
+                yield LineResult(line_no, INVALID, note=str(e))
+                continue
+            reference = row.get(columns['reference'] or '', '') or ''
+            phone = phone_key(row.get(columns['phone'] or '', '')) or phone_key(reference)
+            account = ACCOUNT_REFERENCE_RE.search(reference)
+            tenant_id = int(account.group(1)) if account else self._tenants_by_phone.get(phone)
+            if tenant_id not in self._known_tenants:
+                tenant_id = None
+            yield StatementLine(
+                line_no=line_no, receipt=(row.get(columns['receipt'] or '', '') or '').strip(),
+                date=date, amount=amount, phone=phone, tenant_id=tenant_id, reference=reference,
+            )
+
+    def _candidates(self, lines):
+        """Hash indexes over the payments a chunk of lines can match."""
+        first = min(line.date for line in lines) - self.date_window
+        last = max(line.date for line in lines) + self.date_window
+        # Archived payments keep their ids, so both tables can share one index
+        models = [Payment, PaymentArchive] if reaches_archive(first, last) else [Payment]
+
+        receipts = {line.receipt for line in lines if line.receipt}
+        by_receipt = defaultdict(list)
+        for model in models:
+            for row in model.objects.filter(reference_number__in=receipts).values(
+                    'pk', 'tenant_id', 'amount', 'payment_date', 'reference_number'):
+                by_receipt[row['reference_number']].append(row)
+
+        tenant_ids = {line.tenant_id for line in lines if line.tenant_id}
+        by_tenant = defaultdict(list)
+        if tenant_ids:
+            for model in models:
+                for row in model.objects.filter(
+                        payment_date__range=(first, last), tenant_id__in=tenant_ids,
+                        ).exclude(status__in=['failed', 'refunded']).values(
+                        'pk', 'tenant_id', 'amount', 'payment_date', 'reference_number'):
+                    by_tenant[row['tenant_id']].append(row)
+        return by_receipt, by_tenant
+
+    def _fuzzy_match(self, line, candidates):
+        best = None
+        for payment in candidates:
+            if payment['pk'] in self._claimed_payments:
+                continue
+            if abs(payment['amount'] - line.amount) > self.amount_tolerance:
+                continue
+            distance = abs(payment['payment_date'] - line.date)
+            if distance > self.date_window:
+                continue
+            if best is None or distance < best[0]:
+                best = (distance, payment)
+        return best[1] if best else None
+
+    def _match(self, line, by_receipt, by_tenant):
+        result = LineResult(line.line_no, UNMATCHED, line.receipt, line.amount, line.date, tenant_id=line.tenant_id)
+        if line.receipt:
+            if line.receipt in self._seen_receipts:
+                result.outcome = DUPLICATE
+                result.note = 'receipt appears earlier in the statement'
+                return result
+            self._seen_receipts.add(line.receipt)
+
+            payments = by_receipt.get(line.receipt)
+            if payments:
+                result.outcome = MATCHED if len(payments) == 1 else DUPLICATE
+                result.payment_id = payments[0]['pk']
+                result.tenant_id = payments[0]['tenant_id']
+                if len(payments) > 1:
+                    result.note = f"recorded {len(payments)} times: {', '.join(str(p['pk']) for p in payments)}"
+                elif abs(payments[0]['amount'] - line.amount) > self.amount_tolerance:
+                    result.note = f"amount differs: recorded {payments[0]['amount']}"
+                self._claimed_payments.update(p['pk'] for p in payments)
+                return result
+
+        if line.tenant_id:
+            payment = self._fuzzy_match(line, by_tenant.get(line.tenant_id, ()))
+            if payment:
+                self._claimed_payments.add(payment['pk'])
+                result.outcome = MATCHED_FUZZY
+                result.payment_id = payment['pk']
+                if payment['reference_number'] and line.receipt:
+                    result.note = f"recorded with reference {payment['reference_number']}"
+                return result
+            result.outcome = MISSING
+            result.note = 'no payment recorded for this tenant'
+        else:
+            result.note = 'no tenant with this phone number or account reference'
+        return result
+
+    def _new_payment(self, line):
+        return Payment(
+            tenant_id=line.tenant_id,
+            amount=line.amount,
+            payment_type='rent',
+            payment_method=self.format['method'],
+            payment_date=line.date,
+            reference_number=line.receipt,
+            description=f'Added by statement reconciliation (line {line.line_no})',
+            status='completed',
+        )
+
+    def _reconcile_chunk(self, items):
+        lines = [item for item in items if isinstance(item, StatementLine)]
+        by_receipt, by_tenant = self._candidates(lines) if lines else ({}, {})
+
+        results = []
+        missing = []
+        for item in items:
+            if isinstance(item, LineResult):
+                results.append(item)
+                continue
+            result = self._match(item, by_receipt, by_tenant)
+            if result.outcome == MISSING and self.create_missing:
+                missing.append((result, self._new_payment(item)))
+            results.append(result)
+
+        if missing:
+            with transaction.atomic():
+                created = Payment.objects.bulk_create([payment for _, payment in missing])
+                # bulk_create sends no post_save, which the audit trail is otherwise recorded from
+                if settings.AUDIT_ENABLED:
+                    with audit.acting_as(self.user):
+                        for payment in created:
+                            audit.record_save(payment, created=True)
+            for (result, _), payment in zip(missing, created):
+                result.outcome = CREATED
+                result.payment_id = payment.pk
+                result.note = ''
+            # Not counted if an enclosing transaction (reconcile_statement --dry-run) rolls back
+            transaction.on_commit(partial(record_payments_created, [p.payment_method for p in created]))
+
+        for result in results:
+            self.summary.add(result)
+        return results
+
+    def reconcile(self, stream):
+        """
+        Reconcile a text stream of CSV, yielding one LineResult per statement line.
+        The summary is complete once the generator is exhausted.
+        """
+        reader = csv.DictReader(stream)
+        columns = _resolve_columns(reader.fieldnames, self.format)
+        self._load_tenants()
+        # Line numbers count the header as line 1, like a spreadsheet
+        lines = self._lines(enumerate(reader, start=2), columns)
+        created_any = False
+        while True:
+            chunk = list(islice(lines, self.chunk_size))
+            if not chunk:
+                break
+            for result in self._reconcile_chunk(chunk):
+                created_any = created_any or result.outcome == CREATED
+                yield result
+        if created_any:
+            transaction.on_commit(partial(bump_model_version, Payment))
+
+
+REPORT_COLUMNS = ['line', 'outcome', 'receipt', 'date', 'amount', 'payment_id', 'tenant_id', 'note']
+
+
+def write_report(results, out):
+    """Stream LineResults to `out` as CSV."""
+    writer = csv.writer(out)
+    writer.writerow(REPORT_COLUMNS)
+    for r in results:
+        writer.writerow([r.line_no, r.outcome, r.receipt, r.date, r.amount,
+                         r.payment_id or '', r.tenant_id or '', r.note])
@@ -0,0 +1,156 @@
+"""
+Portfolio-wide rent adjustments: a percentage or fixed change to the rents of the units
+and leases matching a property, unit type and lease start date.
+
+preview() totals the matching rents before and after the change with one aggregate
+query. apply_adjustment() makes the change with F() expression updates in one
+transaction and records a RentSchedule row, effective from the adjustment's date, for
+every unit and lease whose rent changed. rent_amount always holds the current rent;
+charges for earlier periods use the schedules' previous amounts (see forecasting.py).
+An adjustment dated in the future is only saved, and applied on its effective date by
+apply_due_adjustments() (the apply_rent_adjustments job).
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Round
+from django.utils import timezone
+
+from . import audit
+from .backends import invalidate_cached_user
+from .caching import bump_model_version
+from .fields import MoneyField
+from .models import Unit, Tenant, RentAdjustment, RentSchedule
+
+
+def new_rent(adjustment, rent):
+    """Expression for `rent` after the adjustment, rounded to the cent and never negative."""
+    if adjustment.kind == 'percent':
+        # Rents are whole cents (MoneyField), so rounding to an integer rounds to the cent
+        changed = Round(rent * Value(1 + adjustment.amount / 100))
+    else:
+        changed = rent + Value(adjustment.amount, output_field=MoneyField())
+    return Greatest(changed, Value(0), output_field=MoneyField())
+
+
+def lease_rent():
+    """A lease's rent: its own, or its unit's when the lease has none."""
+    return Coalesce(F('rent_amount'), Subquery(Unit.objects.filter(pk=OuterRef('unit_id')).values('rent_amount')[:1]))
+
+
+def scope(adjustment):
+    """
+    The units and the active leases the adjustment covers, as (units, leases) querysets.
+    The lease start date only narrows the leases.
+    """
+    units = Unit.objects.order_by()
+    leases = Tenant.objects.filter(status='active', unit__isnull=False).order_by()
+    if adjustment.property_id:
+        units = units.filter(property_id=adjustment.property_id)
+        leases = leases.filter(unit__property_id=adjustment.property_id)
+    if adjustment.unit_type:
+        units = units.filter(unit_type=adjustment.unit_type)
+        leases = leases.filter(unit__unit_type=adjustment.unit_type)
+    if adjustment.lease_started_before:
+        leases = leases.filter(lease_start_date__lt=adjustment.lease_started_before)
+    return units, leases
+
+
+def preview(adjustment):
+    """
+    Number of units and leases covered, and their monthly rent before and after the
+    adjustment, e.g. {'units': 40, 'units_before': ..., 'units_after': ..., 'leases': 31, ...}.
+    """
+    units, leases = scope(adjustment)
+    aggregates = {}
+    if adjustment.applies_to != 'leases':
+        aggregates.update(
+            units=Count('pk'),
+            units_before=Sum('rent_amount'),
+            units_after=Sum(new_rent(adjustment, F('rent_amount'))),
+        )
+    if adjustment.applies_to != 'units':
+        # Per-unit lease totals, summed over the units in the same query
+        per_unit = leases.filter(unit_id=OuterRef('pk')).values('unit_id')
+        units = units.annotate(
+            lease_count=Subquery(per_unit.annotate(n=Count('pk')).values('n')),
+            lease_before=Subquery(per_unit.annotate(total=Sum(lease_rent())).values('total')),
+            lease_after=Subquery(per_unit.annotate(total=Sum(new_rent(adjustment, lease_rent()))).values('total')),
+        )
+        aggregates.update(leases=Sum('lease_count'), leases_before=Sum('lease_before'), leases_after=Sum('lease_after'))
+    totals = dict.fromkeys(['units', 'leases'], 0)
+    totals.update(dict.fromkeys(['units_before', 'units_after', 'leases_before', 'leases_after'], Decimal('0')))
+    totals.update({name: value for name, value in units.aggregate(**aggregates).items() if value is not None})
+    return totals
+
+
+def _adjust(adjustment, queryset, rent, *fields):
+    """
+    Apply the adjustment to `queryset` with one update and schedule the changed rents.
+    Returns {pk: {field: value}} of the changed rows, including `fields`.
+    """
+    model = queryset.model
+    rows = queryset.select_for_update(of=('self',)).annotate(current_rent=rent)
+    before = {row.pop('pk'): row for row in rows.values('pk', 'rent_amount', 'current_rent', *fields)}
+    if not before:
+        return {}
+    queryset.update(rent_amount=new_rent(adjustment, rent), updated_at=timezone.now())
+    after = dict(queryset.values_list('pk', 'rent_amount'))
+    changed = {pk: row for pk, row in before.items() if after[pk] != row['current_rent']}
+
+    RentSchedule.objects.bulk_create([
+        RentSchedule(**{f'{model._meta.model_name}_id': pk}, adjustment=adjustment,
+                     effective_from=adjustment.effective_from,
+                     previous_amount=row['current_rent'], rent_amount=after[pk])
+        for pk, row in changed.items()
+    ], batch_size=1000)
+    audit.record_updates(model, changed, {pk: {'rent_amount': after[pk]} for pk in changed})
+    bump_model_version(model)
+    return changed
+
+
+@transaction.atomic
+def apply_adjustment(adjustment):
+    """
+    Save `adjustment` (an unsaved RentAdjustment) and, unless it takes effect after today,
+    change the rents it covers. Returns the adjustment with the numbers of units and
+    leases changed.
+    """
+    adjustment.save()
+    if adjustment.effective_from <= timezone.localdate():
+        _apply(adjustment)
+    return adjustment
+
+
+def apply_due_adjustments(today=None):
+    """
+    Apply the adjustments saved ahead of their effective date once it has come, oldest
+    first and each in its own transaction. Returns the number applied.
+    """
+    due = RentAdjustment.objects.filter(applied_at__isnull=True, effective_from__lte=today or timezone.localdate())
+    applied = 0
+    for pk in due.order_by('effective_from', 'created_at').values_list('pk', flat=True):
+        with transaction.atomic():
+            adjustment = RentAdjustment.objects.select_for_update().filter(pk=pk, applied_at__isnull=True).first()
+            if adjustment is None:
+                continue
+            with audit.acting_as(adjustment.created_by_id):
+                _apply(adjustment)
+        applied += 1
+    return applied
+
+
+def _apply(adjustment):
+    # Leases first, so those without a rent of their own start from their unit's old rent
+    units, leases = scope(adjustment)
+    if adjustment.applies_to != 'units':
+        changed = _adjust(adjustment, leases, lease_rent(), 'user_id')
+        # Cached session users carry their tenant profile
+        for row in changed.values():
+            invalidate_cached_user(row['user_id'])
+        adjustment.leases_changed = len(changed)
+    if adjustment.applies_to != 'leases':
+        adjustment.units_changed = len(_adjust(adjustment, units, F('rent_amount')))
+    adjustment.applied_at = timezone.now()
+    adjustment.save(update_fields=['units_changed', 'leases_changed', 'applied_at'])
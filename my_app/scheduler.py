@@ -0,0 +1,345 @@
+"""
+Scheduled jobs that run exactly once across any number of app nodes.
+
+Jobs are functions registered with @scheduled() (see jobs.py) and run by
+`manage.py run_scheduler` workers, as many as you like on as many nodes, all sharing
+the database. They coordinate through one JobLease row per job and shard, which is only
+ever changed by single conditional UPDATEs, so this works the same on SQLite and
+Postgres without advisory locks or a separate lock server:
+
+- When a job's latest scheduled time (its slot) has passed, the first worker to notice
+  moves every shard of the job to that slot as 'pending', unless a shard is still running
+  an earlier slot. For sharded jobs it also splits the property ids into one range per
+  shard at that point, so every worker sees the same ranges.
+- A worker claims a pending shard by making itself the owner until an expiry time,
+  which a heartbeat thread keeps pushing back while the job runs. If the worker dies, the
+  lease expires and another worker takes the shard over, up to SCHEDULER_MAX_ATTEMPTS
+  runs in all.
+- A finished shard is 'done', or 'failed' with the traceback, until the next slot.
+
+Each shard runs once per slot unless a worker stalls for longer than its lease; long
+jobs should call run.check() between batches to stop when that happens. Missed slots
+are not replayed: a worker starting after several went by runs only the latest one.
+Lease times come from each node's clock, so keep the clocks in sync.
+"""
+import bisect
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection
+from django.db.models import BigIntegerField, Case, Exists, F, Q, Value, When
+from django.utils import timezone
+
+from .models import JobLease, Property
+
+logger = logging.getLogger(__name__)
+
+ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+# (low, high) of minute, hour, day of month, month and day of week (0 and 7 are Sunday)
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+# Far enough back to find a February 29th
+MAX_LOOKBACK_DAYS = 366 * 8
+
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(','):
+        spec, _, step = part.partition('/')
+        try:
+            if spec == '*':
+                start, end = low, high
+            elif '-' in spec:
+                start, end = map(int, spec.split('-', 1))
+            else:
+                start = int(spec)
+                end = high if step else start
+            step = int(step) if step else 1
+        except ValueError:
+            raise ValueError(f"Invalid cron field '{text}'")
+        if not low <= start <= end <= high or step < 1:
+            raise ValueError(f"Cron field '{text}' is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronSchedule:
+    """
+    A cron expression: minute, hour, day of month, month and day of week, e.g.
+    '30 1 * * *' or '0 */6 * * 1-5', or an alias such as '@daily'. Times are in TIME_ZONE.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression '{expression}' must have five fields")
+        minutes, hours, self.days, self.months, weekdays = (
+            _parse_field(text, low, high) for text, (low, high) in zip(fields, FIELD_RANGES)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        # As in cron, a day matches either day field when both are restricted
+        self.either_day = not fields[2].startswith('*') and not fields[4].startswith('*')
+        self.times = sorted((hour, minute) for hour in hours for minute in minutes)
+
+    def __str__(self):
+        return self.expression
+
+    def matches_day(self, day):
+        if day.month not in self.months:
+            return False
+        by_date = day.day in self.days
+        by_weekday = (day.weekday() + 1) % 7 in self.weekdays
+        return by_date or by_weekday if self.either_day else by_date and by_weekday
+
+    def previous(self, moment):
+        """The latest scheduled time at or before `moment`, or None if there is none."""
+        local = timezone.localtime(moment)
+        day, latest = local.date(), (local.hour, local.minute)
+        for _ in range(MAX_LOOKBACK_DAYS):
+            if self.matches_day(day):
+                index = bisect.bisect_right(self.times, latest)
+                if index:
+                    return timezone.make_aware(datetime(day.year, day.month, day.day, *self.times[index - 1]))
+            day -= timedelta(days=1)
+            latest = (23, 59)
+        return None
+
+
+@dataclass
+class Job:
+    name: str
+    schedule: CronSchedule
+    func: object
+    shards: int = 1
+    lease_seconds: int = None
+
+
+JOBS = {}
+
+
+def scheduled(name, schedule, shards=1, lease_seconds=None):
+    """
+    Register the decorated function as job `name`, run at the times of the cron expression
+    `schedule`. It is called with a Run; with `shards` > 1, once per shard, each covering
+    a range of property ids (see Run.properties()). `lease_seconds` defaults to
+    SCHEDULER_LEASE_SECONDS.
+    """
+    def register(func):
+        JOBS[name] = Job(name, CronSchedule(schedule), func, shards, lease_seconds)
+        return func
+    return register
+
+
+def registered_jobs():
+    from . import jobs  # noqa: F401
+    return JOBS
+
+
+class LeaseLost(Exception):
+    """Another worker may have taken over the shard this one is running."""
+
+
+@dataclass
+class Run:
+    """One shard of a job's run, as passed to the job function."""
+    job: Job
+    slot: datetime
+    shard: int = 0
+    range_start: int = None
+    range_end: int = None
+    lost: threading.Event = field(default_factory=threading.Event)
+
+    def properties(self, queryset, lookup='pk'):
+        """`queryset` narrowed to this shard's property ids, found through `lookup`."""
+        if self.range_start is not None:
+            queryset = queryset.filter(**{f'{lookup}__gte': self.range_start})
+        if self.range_end is not None:
+            queryset = queryset.filter(**{f'{lookup}__lt': self.range_end})
+        return queryset
+
+    def check(self):
+        """Raise LeaseLost once the lease could not be kept; call it between batches."""
+        if self.lost.is_set():
+            raise LeaseLost(f'{self.job.name}[{self.shard}] lost its lease')
+
+
+def shard_ranges(shards):
+    """Split the property ids into `shards` ranges with about as many properties each."""
+    if shards == 1:
+        return [(None, None)]
+    ids = list(Property.all_objects.order_by('pk').values_list('pk', flat=True))
+    bounds = [ids[len(ids) * k // shards] for k in range(1, shards)] if ids else [0] * (shards - 1)
+    # The first and last ranges are open, so properties added later still belong to a shard
+    return list(zip([None, *bounds], [*bounds, None]))
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def sync_leases(jobs):
+    """Create the lease rows of new jobs and shards, and drop those of shards no longer configured."""
+    JobLease.objects.bulk_create(
+        [JobLease(job=job.name, shard=shard) for job in jobs for shard in range(job.shards)],
+        ignore_conflicts=True,
+    )
+    for job in jobs:
+        JobLease.objects.filter(job=job.name, shard__gte=job.shards).delete()
+
+
+def open_slot(job, slot, now):
+    """Move every shard of `job` on to `slot`. Returns False if it already was, or is still busy."""
+    leases = JobLease.objects.filter(job=job.name)
+    behind = leases.filter(Q(slot__isnull=True) | Q(slot__lt=slot))
+    if not behind.exists():
+        return False
+    ranges = shard_ranges(job.shards)
+    # The row's own slot is re-checked under its lock, so two workers cannot both open it
+    return behind.filter(
+        ~Exists(leases.filter(slot__gte=slot)),
+        ~Exists(leases.filter(status='running', expires_at__gt=now)),
+    ).update(
+        slot=slot, status='pending', owner='', expires_at=None, heartbeat_at=None, attempts=0,
+        started_at=None, finished_at=None, error='',
+        range_start=Case(*[When(shard=shard, then=Value(start)) for shard, (start, _) in enumerate(ranges)],
+                         output_field=BigIntegerField()),
+        range_end=Case(*[When(shard=shard, then=Value(end)) for shard, (_, end) in enumerate(ranges)],
+                       output_field=BigIntegerField()),
+    ) > 0
+
+
+def claim(job, shard, slot, worker, now):
+    """Take shard `shard` of `job` for `worker` if it is pending, or its owner's lease expired."""
+    return JobLease.objects.filter(
+        Q(status='pending') | Q(status='running', expires_at__lte=now),
+        job=job.name, shard=shard, slot=slot, attempts__lt=settings.SCHEDULER_MAX_ATTEMPTS,
+    ).update(
+        status='running', owner=worker, attempts=F('attempts') + 1, started_at=now, heartbeat_at=now,
+        expires_at=now + timedelta(seconds=job.lease_seconds or settings.SCHEDULER_LEASE_SECONDS),
+    ) == 1
+
+
+class Heartbeat:
+    """Extends a lease from a daemon thread, every third of its length, until the block exits."""
+
+    def __init__(self, lease, run, seconds):
+        self.lease = lease
+        self.run = run
+        self.seconds = seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, name=f'heartbeat-{run.job.name}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _beat(self):
+        try:
+            while not self._stop.wait(self.seconds / 3):
+                now = timezone.now()
+                try:
+                    kept = JobLease.objects.filter(pk=self.lease.pk, owner=self.lease.owner, status='running').update(
+                        expires_at=now + timedelta(seconds=self.seconds), heartbeat_at=now,
+                    )
+                except DatabaseError:
+                    # e.g. SQLite busy with the job's own writes; the next beat tries again
+                    logger.warning('Heartbeat of %s failed', self.lease, exc_info=True)
+                    continue
+                if not kept:
+                    self.run.lost.set()
+                    return
+        finally:
+            connection.close()
+
+
+def execute(job, lease, log=None):
+    """Run the claimed `lease` of `job`, keeping the lease alive, and record the outcome."""
+    run = Run(job, lease.slot, lease.shard, lease.range_start, lease.range_end)
+    label = f'{job.name}[{lease.shard}] for {timezone.localtime(lease.slot):%Y-%m-%d %H:%M}'
+    started = time.perf_counter()
+    with Heartbeat(lease, run, job.lease_seconds or settings.SCHEDULER_LEASE_SECONDS):
+        try:
+            result = job.func(run)
+        except Exception:
+            logger.exception('Job %s failed', label)
+            status, error, result = 'failed', traceback.format_exc(), None
+        else:
+            status, error = 'done', ''
+    finished = JobLease.objects.filter(pk=lease.pk, owner=lease.owner, status='running').update(
+        status=status, error=error, owner='', expires_at=None, finished_at=timezone.now(),
+    )
+    if not finished:
+        logger.warning('Job %s finished after losing its lease', label)
+    if log:
+        log(f'  {label}: {status}{f" ({result})" if result is not None else ""} '
+            f'in {time.perf_counter() - started:.1f}s')
+    return status
+
+
+def run_pending(jobs, worker, log=None):
+    """Run every due shard of `jobs` that no other worker holds. Returns the number run."""
+    ran = 0
+    for job in jobs:
+        now = timezone.now()
+        slot = job.schedule.previous(now)
+        if slot is None:
+            continue
+        open_slot(job, slot, now)
+        # Shards whose worker died too often are given up on
+        JobLease.objects.filter(
+            job=job.name, status='running', expires_at__lte=now, attempts__gte=settings.SCHEDULER_MAX_ATTEMPTS,
+        ).update(status='failed', owner='', finished_at=now, error='Lease expired on every attempt')
+        free = list(JobLease.objects.filter(
+            Q(status='pending') | Q(status='running', expires_at__lte=now),
+            job=job.name, slot=slot, attempts__lt=settings.SCHEDULER_MAX_ATTEMPTS,
+        ).values_list('shard', flat=True))
+        # Workers start at different shards, so they rarely race for the same one
+        offset = hash(worker) % len(free) if free else 0
+        for shard in free[offset:] + free[:offset]:
+            if claim(job, shard, slot, worker, timezone.now()):
+                execute(job, JobLease.objects.get(job=job.name, shard=shard), log)
+                ran += 1
+    return ran
+
+
+def run_worker(names=None, worker=None, once=False, poll=None, stop=None, log=None):
+    """
+    Run due jobs (all, or those named) until `stop` (a threading.Event) is set, polling
+    every `poll` (SCHEDULER_POLL_SECONDS) seconds; with `once`, run what is due and return.
+    Returns the number of shards run.
+    """
+    jobs = registered_jobs()
+    unknown = set(names or ()) - set(jobs)
+    if unknown:
+        raise ValueError(f"Unknown job(s): {', '.join(sorted(unknown))}")
+    jobs = [job for name, job in jobs.items() if not names or name in names]
+    worker = worker or worker_name()
+    stop = stop or threading.Event()
+    sync_leases(jobs)
+    total = 0
+    while True:
+        close_old_connections()
+        ran = run_pending(jobs, worker, log)
+        total += ran
+        # Go round again straight away after running something: other shards may be due by now
+        if once or stop.wait(0 if ran else poll or settings.SCHEDULER_POLL_SECONDS):
+            return total
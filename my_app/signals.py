@@ -0,0 +1,63 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import audit, photos
+from .backends import invalidate_cached_user
+from .caching import bump_model_version
+from .metrics import record_payments_created
+from .models import Property, Unit, Tenant, Payment, Photo
+
+
+@receiver([post_save, post_delete], sender=User)
+def drop_cached_user(sender, instance, **kwargs):
+    invalidate_cached_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Tenant)
+def drop_cached_tenant_user(sender, instance, **kwargs):
+    invalidate_cached_user(instance.user_id)
+    # A re-link must also drop the previously linked user's cache entry
+    previous_user_id = instance.loaded_value('user_id')
+    if previous_user_id != instance.user_id:
+        invalidate_cached_user(previous_user_id)
+
+
+@receiver([post_save, post_delete], sender=Property)
+@receiver([post_save, post_delete], sender=Unit)
+@receiver([post_save, post_delete], sender=Tenant)
+@receiver([post_save, post_delete], sender=Payment)
+def bump_version(sender, **kwargs):
+    bump_model_version(sender)
+
+
+@receiver(post_save, sender=Property)
+@receiver(post_save, sender=Unit)
+@receiver(post_save, sender=Tenant)
+@receiver(post_save, sender=Payment)
+def audit_save(sender, instance, created, update_fields, raw, using, **kwargs):
+    if settings.AUDIT_ENABLED and not raw:
+        audit.record_save(instance, created, update_fields, using)
+
+
+@receiver(post_delete, sender=Property)
+@receiver(post_delete, sender=Unit)
+@receiver(post_delete, sender=Tenant)
+@receiver(post_delete, sender=Payment)
+def audit_delete(sender, instance, using, **kwargs):
+    if settings.AUDIT_ENABLED:
+        audit.record_delete(instance, using)
+
+
+@receiver(post_save, sender=Payment)
+def count_created_payment(sender, instance, created, **kwargs):
+    if created:
+        record_payments_created([instance.payment_method])
+
+
+@receiver(post_delete, sender=Photo)
+def discard_photo_files(sender, instance, **kwargs):
+    photo_files = [(instance.image.name, instance.digest, instance.renditions)]
+    transaction.on_commit(lambda: photos.discard(photo_files))
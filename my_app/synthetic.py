@@ -0,0 +1,352 @@
+"""
+Seeded synthetic portfolio for load tests and benchmarks.
+
+Everything is written in batches (bulk_create, and executemany for payments), so the
+per-save signals do not fire; generate_portfolio() bumps the cached model versions
+itself when it is done.
+"""
+import calendar
+import random
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from itertools import islice
+from zoneinfo import ZoneInfo
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import photos
+from .caching import bump_model_version
+from .fields import to_cents
+from .models import (
+    Property, Unit, Tenant, Payment, PaymentArchive, PaymentRollup, UnitStatusChange, OccupancySnapshot,
+    RentAdjustment, RentSchedule, AuditLog, Photo, StkPush,
+)
+
+CITIES = [
+    ('Nairobi', 'Nairobi'), ('Mombasa', 'Mombasa'), ('Kisumu', 'Kisumu'),
+    ('Nakuru', 'Nakuru'), ('Eldoret', 'Uasin Gishu'), ('Thika', 'Kiambu'),
+    ('Machakos', 'Machakos'), ('Nyeri', 'Nyeri'), ('Kitale', 'Trans Nzoia'),
+]
+ESTATES = ['Greenview', 'Riverside', 'Sunrise', 'Kilimani', 'Lavington', 'Parklands',
+           'Westlands', 'Hillcrest', 'Garden', 'Jacaranda', 'Acacia', 'Baobab']
+FIRST_NAMES = ['Wanjiku', 'Achieng', 'Kamau', 'Otieno', 'Njeri', 'Mwangi', 'Akinyi', 'Kiprop',
+               'Chebet', 'Mutua', 'Nduta', 'Omondi', 'Wairimu', 'Kipchoge', 'Atieno', 'Njoroge']
+LAST_NAMES = ['Kariuki', 'Odhiambo', 'Wambui', 'Mutiso', 'Koech', 'Ochieng', 'Nyambura',
+              'Kimani', 'Wafula', 'Cheruiyot', 'Muthoni', 'Ouma', 'Gitau', 'Rotich']
+
+# unit type -> (weight, bedrooms, bathrooms, monthly rent range in KES)
+UNIT_PROFILES = {
+    'studio': (15, 0, 1, (8000, 15000)),
+    '1br': (30, 1, 1, (12000, 25000)),
+    '2br': (30, 2, 1, (20000, 45000)),
+    '3br': (15, 3, 2, (35000, 80000)),
+    '4br': (4, 4, 3, (60000, 150000)),
+    'penthouse': (1, 4, 4, (150000, 350000)),
+    'commercial': (5, 0, 1, (40000, 200000)),
+}
+
+# Daraja timestamps (e.g. TransactionDate) are East Africa Time
+NAIROBI = ZoneInfo('Africa/Nairobi')
+
+PAYMENT_COLUMNS = (
+    'tenant', 'amount', 'payment_type', 'payment_method', 'payment_date', 'reference_number',
+    'description', 'status', 'checkout_request_id', 'period_start', 'period_end',
+    'created_at', 'updated_at',
+)
+
+DEFAULT_METHOD_MIX = {'mpesa': 0.7, 'bank_transfer': 0.2, 'cash': 0.1}
+
+
+@dataclass
+class PortfolioSpec:
+    properties: int = 50
+    units_per_property: int = 40
+    years: int = 5
+    occupancy: float = 0.85
+    managers: int = 0
+    method_mix: dict = field(default_factory=lambda: dict(DEFAULT_METHOD_MIX))
+    seed: int = 42
+    batch_size: int = 5000
+
+
+def parse_method_mix(value):
+    """Parse 'mpesa=0.7,bank_transfer=0.2,cash=0.1' into a dict of Payment.PAYMENT_METHODS weights."""
+    methods = dict(Payment.PAYMENT_METHODS)
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in methods:
+            raise ValueError(f"Unknown payment method '{name}'. Choose from: {', '.join(methods)}")
+        mix[name] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError('Payment method weights must add up to more than zero')
+    return mix
+
+
+def _month_start(day):
+    return day.replace(day=1)
+
+
+def _add_months(day, months):
+    month = day.month - 1 + months
+    year = day.year + month // 12
+    month = month % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def _receipt(rng, method):
+    if method == 'mpesa':
+        return f'{rng.getrandbits(40):010X}'
+    if method == 'bank_transfer':
+        return f'BT{rng.getrandbits(40):012d}'
+    return ''
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+class PortfolioGenerator:
+    def __init__(self, spec, stdout=None):
+        self.spec = spec
+        self.rng = random.Random(spec.seed)
+        self.today = date.today()
+        self.window_start = _month_start(_add_months(self.today, -12 * spec.years))
+        self.stdout = stdout
+        self.methods = list(spec.method_mix)
+        self.method_weights = list(spec.method_mix.values())
+        self.counts = {'managers': 0, 'properties': 0, 'units': 0, 'tenants': 0, 'payments': 0}
+
+    def log(self, message):
+        if self.stdout:
+            self.stdout.write(message)
+
+    def run(self):
+        with transaction.atomic():
+            managers = self.create_managers()
+            properties = self.create_properties(managers)
+            units = self.create_units(properties)
+            tenants = self.create_tenants(units)
+        # Payments are committed batch by batch to keep memory and transaction size bounded
+        self.create_payments(tenants)
+        for model in (Property, Unit, Tenant, Payment):
+            bump_model_version(model)
+        return self.counts
+
+    def create_managers(self):
+        if not self.spec.managers:
+            return []
+        offset = (User.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        users = []
+        for n in range(self.spec.managers):
+            user = User(username=f'manager{offset + n}', first_name=self.rng.choice(FIRST_NAMES),
+                        last_name=self.rng.choice(LAST_NAMES), is_staff=True)
+            user.set_unusable_password()
+            users.append(user)
+        users = User.objects.bulk_create(users, batch_size=self.spec.batch_size)
+        self.counts['managers'] = len(users)
+        return users
+
+    def create_properties(self, managers):
+        objs = []
+        for n in range(self.spec.properties):
+            city, county = self.rng.choice(CITIES)
+            objs.append(Property(
+                name=f'{self.rng.choice(ESTATES)} {self.rng.choice(["Court", "Apartments", "Heights", "Towers", "Plaza"])} {n + 1}',
+                property_type=self.rng.choices(['apartment', 'mixed', 'commercial', 'house'], [70, 15, 10, 5])[0],
+                address=f'{self.rng.randint(1, 400)} {self.rng.choice(ESTATES)} Road',
+                city=city,
+                county=county,
+                total_units=self.spec.units_per_property,
+                status=self.rng.choices(['active', 'maintenance', 'inactive'], [92, 5, 3])[0],
+                manager=managers[n % len(managers)] if managers else None,
+            ))
+        objs = Property.objects.bulk_create(objs, batch_size=self.spec.batch_size)
+        self.counts['properties'] = len(objs)
+        self.log(f'  {len(objs)} properties')
+        return objs
+
+    def create_units(self, properties):
+        types = list(UNIT_PROFILES)
+        weights = [UNIT_PROFILES[t][0] for t in types]
+        objs = []
+        for prop in properties:
+            for n in range(self.spec.units_per_property):
+                unit_type = self.rng.choices(types, weights)[0]
+                _, bedrooms, bathrooms, (low, high) = UNIT_PROFILES[unit_type]
+                rent = Decimal(self.rng.randrange(low, high, 500))
+                roll = self.rng.random()
+                if roll < self.spec.occupancy:
+                    status = 'occupied'
+                elif roll < self.spec.occupancy + (1 - self.spec.occupancy) * 0.2:
+                    status = 'maintenance'
+                else:
+                    status = 'available'
+                floor = n // 8
+                objs.append(Unit(
+                    property=prop, unit_number=f'{chr(65 + floor % 26)}{n % 8 + 1}{floor // 26 or ""}',
+                    unit_type=unit_type, floor=str(floor), bedrooms=bedrooms, bathrooms=bathrooms,
+                    rent_amount=rent, deposit_amount=rent, status=status,
+                    is_occupied=status == 'occupied',
+                ))
+        objs = Unit.objects.bulk_create(objs, batch_size=self.spec.batch_size)
+        self.counts['units'] = len(objs)
+        self.log(f'  {len(objs)} units')
+        return objs
+
+    def _tenancies_for(self, unit):
+        """Back-to-back leases covering the window; the last one is current if the unit is occupied."""
+        leases = []
+        start = _add_months(self.window_start, self.rng.randint(0, 6))
+        while start <= self.today:
+            end = _add_months(start, self.rng.choice([12, 12, 24, 36])) - timedelta(days=1)
+            leases.append((start, end))
+            # A month or two of vacancy between tenants
+            start = _add_months(end + timedelta(days=1), self.rng.choice([0, 0, 1, 2]))
+        if unit.status == 'occupied':
+            if not leases or leases[-1][1] < self.today:
+                start = leases[-1][1] + timedelta(days=1) if leases else self.window_start
+                leases.append((start, _add_months(start, 12) - timedelta(days=1)))
+        else:
+            leases = [(s, e) for s, e in leases if e < self.today]
+        return leases
+
+    def create_tenants(self, units):
+        offset = (Tenant.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+        objs = []
+        for unit in units:
+            leases = self._tenancies_for(unit)
+            for index, (start, end) in enumerate(leases):
+                n = offset + len(objs)
+                current = unit.status == 'occupied' and index == len(leases) - 1
+                first, last = self.rng.choice(FIRST_NAMES), self.rng.choice(LAST_NAMES)
+                rent = unit.rent_amount if current else unit.rent_amount * Decimal('0.9')
+                objs.append(Tenant(
+                    first_name=first, last_name=last,
+                    email=f'{first.lower()}.{last.lower()}.{n}@example.com',
+                    phone=f'07{self.rng.randint(10000000, 99999999)}',
+                    id_number=str(self.rng.randint(10000000, 39999999)),
+                    unit=unit, last_property_id=unit.property_id,
+                    lease_start_date=start, lease_end_date=end,
+                    rent_amount=rent.quantize(Decimal('1')), deposit_paid=unit.deposit_amount,
+                    status='active' if current else 'inactive',
+                ))
+        objs = Tenant.objects.bulk_create(objs, batch_size=self.spec.batch_size)
+        self.counts['tenants'] = len(objs)
+        self.log(f'  {len(objs)} tenants')
+        return objs
+
+    def _months(self):
+        """(start, end) of every month from the window start to the current month."""
+        months = []
+        month = self.window_start
+        while month <= self.today:
+            months.append((month, month.replace(day=calendar.monthrange(month.year, month.month)[1])))
+            month = _add_months(month, 1)
+        return months
+
+    def _payment_rows(self, tenants):
+        """Payment rows as tuples in PAYMENT_COLUMNS order."""
+        rng = self.rng
+        months = self._months()
+        current_month = months[-1][0]
+        month_index = {start: index for index, (start, _) in enumerate(months)}
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        for tenant in tenants:
+            method = rng.choices(self.methods, self.method_weights)[0]
+            yield (tenant.pk, to_cents(tenant.deposit_paid), 'deposit', method, tenant.lease_start_date,
+                   _receipt(rng, method), '', 'completed', '', None, None, now, now)
+
+            last_day = min(tenant.lease_end_date, self.today)
+            for start, end in months[month_index[_month_start(tenant.lease_start_date)]:]:
+                if start > last_day:
+                    break
+                # Most tenants pay on time; a tail pays up to three weeks late
+                days_late = 0 if rng.random() < 0.7 else min(int(rng.expovariate(1 / 6)), 27)
+                paid_on = start + timedelta(days=days_late)
+                if paid_on > self.today:
+                    break
+                if rng.random() > 0.9:
+                    method = rng.choices(self.methods, self.method_weights)[0]
+                roll = rng.random()
+                if start == current_month and roll < 0.15:
+                    status = 'pending'
+                elif roll < 0.01:
+                    status = 'failed'
+                else:
+                    status = 'completed'
+                yield (tenant.pk, to_cents(tenant.rent_amount), 'rent', method, paid_on,
+                       _receipt(rng, method), '', status, '', start, end, now, now)
+
+    def create_payments(self, tenants):
+        """
+        Payments are the bulk of the data, so they skip model instances altogether and
+        go in as plain parameter tuples with executemany, one transaction per batch.
+        """
+        table = connection.ops.quote_name(Payment._meta.db_table)
+        columns = ', '.join(connection.ops.quote_name(Payment._meta.get_field(name).column)
+                            for name in PAYMENT_COLUMNS)
+        placeholders = ', '.join(['%s'] * len(PAYMENT_COLUMNS))
+        sql = f'INSERT INTO {table} ({columns}) VALUES ({placeholders})'
+
+        for batch in _batched(self._payment_rows(tenants), self.spec.batch_size):
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, batch)
+            self.counts['payments'] += len(batch)
+            if self.counts['payments'] % (self.spec.batch_size * 20) == 0:
+                self.log(f'  {self.counts["payments"]} payments')
+        self.log(f'  {self.counts["payments"]} payments')
+
+
+def generate_portfolio(spec=None, stdout=None):
+    return PortfolioGenerator(spec or PortfolioSpec(), stdout=stdout).run()
+
+
+def clear_portfolio():
+    """
+    Delete every property, unit, tenant and payment, their photos, occupancy and rent
+    history and audit trail, with plain DELETEs (no per-row signals). STK pushes are kept,
+    unlinked from their tenants as a tenant delete would leave them.
+    """
+    quote = connection.ops.quote_name
+    photo_files = photos.files(Photo.objects.all())
+    audited = [model._meta.label_lower for model in (Property, Unit, Tenant, Payment)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        tenant_column = quote(StkPush._meta.get_field('tenant').column)
+        cursor.execute(f'UPDATE {quote(StkPush._meta.db_table)} SET {tenant_column} = NULL '
+                       f'WHERE {tenant_column} IS NOT NULL')
+        for model in (Payment, PaymentArchive, PaymentRollup, RentSchedule, RentAdjustment, Tenant,
+                      UnitStatusChange, OccupancySnapshot, Photo, Unit, Property):
+            cursor.execute(f'DELETE FROM {quote(model._meta.db_table)}')
+        placeholders = ', '.join(['%s'] * len(audited))
+        cursor.execute(f"DELETE FROM {quote(AuditLog._meta.db_table)} "
+                       f"WHERE {quote(AuditLog._meta.get_field('model').column)} IN ({placeholders})", audited)
+    photos.discard(photo_files)
+    for model in (Property, Unit, Tenant, Payment, PaymentArchive, PaymentRollup, OccupancySnapshot):
+        bump_model_version(model)
+
+
+def fake_stk_callback(phone, amount, checkout_request_id, receipt='', result_code=0):
+    """Body of a Daraja STK callback, as Safaricom would POST it to mpesa_callback."""
+    callback = {
+        'MerchantRequestID': f'mr-{checkout_request_id}',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0
+                      else 'Request cancelled by user',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt or checkout_request_id[-10:].upper()},
+            {'Name': 'TransactionDate', 'Value': int(datetime.now(NAIROBI).strftime('%Y%m%d%H%M%S'))},
+            {'Name': 'PhoneNumber', 'Value': int('254' + str(phone)[-9:])},
+        ]}
+    return {'Body': {'stkCallback': callback}}
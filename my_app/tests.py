@@ -1 +1,1357 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from decimal import Decimal
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    archive, audit, checks, deletion, lifecycle, mpesa, occupancy, photos, rent, scheduler, synthetic, vacancies,
+)
+from .audit import AuditUserMiddleware
+from .backends import user_cache_key
+from .caching import model_version
+from .fields import MoneyField, from_cents, to_cents
+from .forecasting import get_forecast
+from .forms import PaymentForm, PropertyForm, UnitForm
+from .metrics import REGISTRY, MetricsMiddleware
+from .models import (
+    AuditLog, JobLease, OccupancySnapshot, Payment, PaymentArchive, PaymentRollup, Photo, Property, RentAdjustment,
+    RentSchedule, StkPush, Tenant, Unit, UnitStatusChange, managed_property_ids,
+)
+from .profiling import ProfilerMiddleware
+from .reconciliation import Reconciler
+
+
+def make_property(name='Block', city='Nairobi', **fields):
+    return Property.objects.create(name=name, address='1 Road', city=city, **fields)
+
+
+def make_unit(prop, number, rent, **fields):
+    return Unit.objects.create(property=prop, unit_number=number, rent_amount=Decimal(rent), **fields)
+
+
+def make_tenant(name, phone='0700000000', **fields):
+    return Tenant.objects.create(first_name=name, last_name='Tenant', email=f'{name}@example.com', phone=phone, **fields)
+
+
+class MoneyFieldTests(TestCase):
+
+    def test_to_python_rounds_half_up_to_cents(self):
+        field = MoneyField()
+        self.assertEqual(field.to_python('12.345'), Decimal('12.35'))
+        self.assertEqual(field.to_python('12.344'), Decimal('12.34'))
+        self.assertEqual(field.to_python(0.1), Decimal('0.10'))
+        self.assertEqual(field.to_python(7), Decimal('7.00'))
+        self.assertIsNone(field.to_python(None))
+
+    def test_to_python_rejects_non_numbers(self):
+        with self.assertRaises(ValidationError):
+            MoneyField().to_python('ten')
+
+    def test_get_prep_value_is_whole_cents(self):
+        field = MoneyField()
+        self.assertEqual(field.get_prep_value(Decimal('12345.67')), 1234567)
+        self.assertEqual(field.get_prep_value('0.105'), 11)
+        self.assertEqual(field.get_prep_value(0.1), 10)
+        self.assertIsNone(field.get_prep_value(None))
+
+    def test_cents_round_trip(self):
+        for amount in ['0.00', '0.10', '12345.67', '99999999999999.99']:
+            self.assertEqual(from_cents(to_cents(Decimal(amount))), Decimal(amount))
+
+
+class MoneyMigrationTests(TransactionTestCase):
+    before = [('my_app', '0014_soft_delete_properties')]
+    after = [('my_app', '0015_money_in_cents')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_amounts_survive_forward_and_backward(self):
+        apps = self.migrate(self.before)
+        Property = apps.get_model('my_app', 'Property')
+        Unit = apps.get_model('my_app', 'Unit')
+        Tenant = apps.get_model('my_app', 'Tenant')
+        Payment = apps.get_model('my_app', 'Payment')
+        prop = Property.objects.create(name='P', address='A', city='Nairobi')
+        unit = Unit.objects.create(property=prop, unit_number='1', rent_amount=Decimal('12345.67'),
+                                   deposit_amount=Decimal('0.10'))
+        tenant = Tenant.objects.create(first_name='T', last_name='T', email='t@example.com', phone='1', unit=unit,
+                                       rent_amount=Decimal('999.99'))
+        payment = Payment.objects.create(tenant=tenant, amount=Decimal('0.01'), payment_date='2024-01-01')
+
+        self.migrate(self.after)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rent_amount, deposit_amount FROM my_app_unit WHERE id = %s', [unit.pk])
+            self.assertEqual(cursor.fetchone(), (1234567, 10))
+
+        apps = self.migrate(self.before)
+        unit = apps.get_model('my_app', 'Unit').objects.get(pk=unit.pk)
+        self.assertEqual(unit.rent_amount, Decimal('12345.67'))
+        self.assertEqual(unit.deposit_amount, Decimal('0.10'))
+        self.assertEqual(apps.get_model('my_app', 'Tenant').objects.get(pk=tenant.pk).rent_amount, Decimal('999.99'))
+        self.assertEqual(apps.get_model('my_app', 'Payment').objects.get(pk=payment.pk).amount, Decimal('0.01'))
+
+
+class VacancySearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        nairobi = make_property('Nairobi Heights', city='Nairobi')
+        mombasa = make_property('Mombasa Villas', city='Mombasa', property_type='house')
+        cls.units = [
+            make_unit(nairobi, 'N1', '10000', unit_type='1br', bedrooms=1),
+            make_unit(nairobi, 'N2', '15000', unit_type='2br', bedrooms=2),
+            make_unit(nairobi, 'N3', '15000', unit_type='2br', bedrooms=2),
+            make_unit(nairobi, 'N4', '30000', unit_type='3br', bedrooms=3),
+            make_unit(mombasa, 'M1', '15000', unit_type='2br', bedrooms=2),
+            make_unit(mombasa, 'M2', '20000', unit_type='1br', bedrooms=1),
+        ]
+        make_unit(nairobi, 'N5', '12000', status='occupied')
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, query=''):
+        return vacancies.parse_params(QueryDict(query))
+
+    def test_hostile_params_are_dropped(self):
+        search = self.search('min_rent=1e30&max_rent=1e400&bedrooms=two&sort=DROP&after=1e5.3')
+        self.assertEqual(search, {'selected': {}, 'min_rent': None, 'max_rent': None, 'sort': 'rent', 'after': None})
+        for value in ['NaN', '-Infinity', '-5', '10000000000000000', 'abc']:
+            self.assertIsNone(self.search(f'min_rent={value}')['min_rent'], value)
+        for value in ['99999999999999999999.1', '1.99999999999999999999', '-1.5', '1', '1.2.3']:
+            self.assertIsNone(self.search(f'after={value}')['after'], value)
+        self.assertEqual(self.search('min_rent=9999999999999999.99')['min_rent'], 999999999999999999)
+
+    def test_hostile_params_do_not_fail_the_page(self):
+        for query in ['min_rent=1e30', 'max_rent=1e400', 'min_rent=1e-400', 'after=99999999999999999999.1',
+                      'after=1.99999999999999999999', 'bedrooms=1e400']:
+            self.assertEqual(self.client.get(reverse('vacancy_search') + '?' + query).status_code, 200, query)
+
+    def test_facets_leave_out_their_own_filter(self):
+        facets, total = vacancies.facets(self.search('city=Nairobi&unit_type=2br'))
+        counts = {name: {row['value']: row['count'] for row in rows} for name, rows in facets.items()}
+        self.assertEqual(total, 2)
+        # Other cities still counted with the unit type filter, other types with the city filter
+        self.assertEqual(counts['city'], {'Nairobi': 2, 'Mombasa': 1})
+        self.assertEqual(counts['unit_type'], {'1br': 1, '2br': 2, '3br': 1})
+        self.assertEqual(counts['bedrooms'], {2: 2})
+        self.assertTrue(next(row for row in facets['city'] if row['value'] == 'Nairobi')['selected'])
+
+    def test_facets_within_rent_range(self):
+        facets, total = vacancies.facets(self.search('min_rent=15000&max_rent=20000'))
+        self.assertEqual(total, 4)
+        self.assertEqual({row['value']: row['count'] for row in facets['city']}, {'Nairobi': 2, 'Mombasa': 2})
+
+    def test_selected_value_without_matches_is_still_offered(self):
+        facets, total = vacancies.facets(self.search('city=Kisumu'))
+        self.assertEqual(total, 0)
+        self.assertIn({'value': 'Kisumu', 'label': 'Kisumu', 'count': 0, 'selected': True}, facets['city'])
+
+    def walk(self, sort):
+        seen = []
+        query = f'sort={sort}'
+        with self.settings(VACANCY_PAGE_SIZE=2):
+            while True:
+                units, cursor = vacancies.search_page(self.search(query))
+                self.assertLessEqual(len(units), 2)
+                seen += [unit.pk for unit in units]
+                if cursor is None:
+                    return seen
+                query = f'sort={sort}&after={cursor}'
+
+    def test_keyset_pages_walk_every_vacancy_once_in_order(self):
+        by_rent = sorted(self.units, key=lambda unit: (unit.rent_amount, unit.pk))
+        self.assertEqual(self.walk('rent'), [unit.pk for unit in by_rent])
+        self.assertEqual(self.walk('-rent'), [unit.pk for unit in reversed(by_rent)])
+
+    def test_cursor_skips_ties_already_shown(self):
+        tied = sorted(unit.pk for unit in self.units if unit.rent_amount == 15000)
+        units, _ = vacancies.search_page(self.search(f'after=1500000.{tied[0]}'))
+        self.assertEqual([unit.pk for unit in units][:2], tied[1:])
+
+
+class ScopingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user('alice', is_staff=True)
+        cls.bob = User.objects.create_user('bob', is_staff=True)
+        cls.boss = User.objects.create_superuser('boss')
+        cls.mine, cls.theirs = {}, {}
+        for user, rows in [(cls.alice, cls.mine), (cls.bob, cls.theirs)]:
+            rows['property'] = make_property(f'{user.username} court', manager=user)
+            rows['unit'] = make_unit(rows['property'], '1', '10000', status='occupied')
+            rows['tenant'] = make_tenant(user.username, unit=rows['unit'])
+            rows['payment'] = Payment.objects.create(tenant=rows['tenant'], amount=Decimal('10000'),
+                                                     payment_date=date(2024, 1, 1))
+        cls.applicant = make_tenant('applicant', status='pending')
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.alice)
+
+    def test_querysets_keep_the_managers_rows(self):
+        self.assertEqual(list(Property.objects.for_user(self.alice)), [self.mine['property']])
+        self.assertEqual(list(Unit.objects.for_user(self.alice)), [self.mine['unit']])
+        self.assertEqual(set(Tenant.objects.for_user(self.alice)), {self.mine['tenant'], self.applicant})
+        self.assertEqual(list(Payment.objects.for_user(self.alice)), [self.mine['payment']])
+        self.assertEqual(Property.objects.for_user(self.boss).count(), 2)
+        self.assertEqual(Payment.objects.in_scope(None).count(), 2)
+        self.assertFalse(Property.objects.for_user(AnonymousUser()).exists())
+
+    def test_scope_follows_a_change_of_manager(self):
+        self.assertEqual(managed_property_ids(self.alice), [self.mine['property'].pk])
+        self.theirs['property'].manager = self.alice
+        self.theirs['property'].save()
+        alice = User.objects.get(pk=self.alice.pk)
+        self.assertEqual(sorted(managed_property_ids(alice)), sorted([self.mine['property'].pk, self.theirs['property'].pk]))
+
+    def test_other_managers_rows_are_not_found(self):
+        for name, key in [('property_detail', 'property'), ('property_update', 'property'), ('property_delete', 'property'),
+                          ('unit_detail', 'unit'), ('unit_update', 'unit'), ('unit_delete', 'unit'),
+                          ('tenant_detail', 'tenant'), ('tenant_update', 'tenant'), ('tenant_delete', 'tenant'),
+                          ('tenant_dashboard_detail', 'tenant'),
+                          ('payment_detail', 'payment'), ('payment_update', 'payment'), ('payment_delete', 'payment')]:
+            self.assertEqual(self.client.get(reverse(name, args=[self.theirs[key].pk])).status_code, 404, name)
+            self.assertEqual(self.client.get(reverse(name, args=[self.mine[key].pk])).status_code, 200, name)
+
+    def test_lists_show_only_the_managers_rows(self):
+        for name, rows in [('property_list', 'properties'), ('unit_list', 'units'),
+                           ('tenant_list', 'tenants'), ('payment_list', 'payments')]:
+            listed = list(self.client.get(reverse(name)).context[rows])
+            key = {'properties': 'property', 'units': 'unit', 'tenants': 'tenant', 'payments': 'payment'}[rows]
+            self.assertIn(self.mine[key], listed, name)
+            self.assertNotIn(self.theirs[key], listed, name)
+
+    def test_dashboard_and_reports_count_the_managers_rows(self):
+        context = self.client.get(reverse('manager_dashboard')).context
+        self.assertEqual((context['total_properties'], context['total_units'], context['total_tenants']), (1, 1, 2))
+        self.assertEqual(list(context['properties']), [self.mine['property']])
+        context = self.client.get(reverse('financial_report')).context
+        self.assertEqual(context['total_revenue'], Decimal('10000'))
+        self.assertEqual(self.client.get(reverse('occupancy_report')).context['total_units'], 1)
+        self.client.force_login(self.boss)
+        self.assertEqual(self.client.get(reverse('manager_dashboard')).context['total_properties'], 2)
+
+    def test_removing_a_unit_keeps_its_tenants_with_the_property(self):
+        self.client.force_login(self.bob)
+        before = [self.client.get(reverse(name)).context[key] for name, key in
+                  [('payment_list', 'total_collected'), ('financial_report', 'total_revenue'),
+                   ('manager_dashboard', 'total_tenants')]]
+        self.client.force_login(self.alice)
+        self.client.post(reverse('unit_delete', args=[self.mine['unit'].pk]))
+        self.assertIsNone(Tenant.objects.get(pk=self.mine['tenant'].pk).unit_id)
+        self.assertEqual(set(Tenant.objects.for_user(self.alice)), {self.mine['tenant'], self.applicant})
+        self.assertEqual(list(Payment.objects.for_user(self.alice)), [self.mine['payment']])
+        self.client.force_login(self.bob)
+        cache.clear()
+        after = [self.client.get(reverse(name)).context[key] for name, key in
+                 [('payment_list', 'total_collected'), ('financial_report', 'total_revenue'),
+                  ('manager_dashboard', 'total_tenants')]]
+        self.assertEqual(after, before)
+        self.assertEqual(list(Payment.objects.for_user(self.bob)), [self.theirs['payment']])
+
+    def test_applicants_payments_count_for_no_manager(self):
+        Payment.objects.create(tenant=self.applicant, amount=Decimal('500'), payment_date=date(2024, 1, 2))
+        self.assertEqual(list(Payment.objects.for_user(self.alice)), [self.mine['payment']])
+        self.assertEqual(Payment.objects.for_user(self.boss).count(), 3)
+
+    def test_bulk_actions_leave_other_managers_rows_alone(self):
+        self.client.post(reverse('unit_bulk_action'), {'ids': str(self.theirs['unit'].pk), 'status': 'maintenance'})
+        self.assertEqual(Unit.objects.get(pk=self.theirs['unit'].pk).status, 'occupied')
+
+    def test_forms_offer_only_the_managers_choices(self):
+        self.assertEqual(list(UnitForm(user=self.alice).fields['property'].queryset), [self.mine['property']])
+        form = PaymentForm({'tenant': self.theirs['tenant'].pk, 'amount': '10', 'payment_type': 'rent',
+                            'payment_method': 'cash', 'payment_date': '2024-02-01', 'status': 'completed'},
+                           user=self.alice)
+        self.assertIn('tenant', form.errors)
+
+    def test_managers_cannot_hand_properties_to_someone_else(self):
+        self.assertEqual(list(PropertyForm(user=self.alice).fields['manager'].queryset), [self.alice])
+        data = {'name': 'New', 'property_type': 'apartment', 'address': 'x', 'city': 'Nairobi', 'total_units': 0,
+                'status': 'active', 'manager': self.bob.pk}
+        self.assertIn('manager', PropertyForm(data, user=self.alice).errors)
+        self.assertTrue(PropertyForm(data, user=self.boss).is_valid())
+        self.client.post(reverse('property_create'), {**data, 'manager': ''})
+        self.assertFalse(Property.objects.filter(name='New').exists())
+        self.client.post(reverse('property_create'), {**data, 'manager': self.alice.pk})
+        self.assertEqual(Property.objects.get(name='New').manager, self.alice)
+
+    def test_api_returns_only_the_managers_rows(self):
+        for resource, key in [('properties', 'property'), ('units', 'unit'), ('tenants', 'tenant'), ('payments', 'payment')]:
+            ids = [row['id'] for row in self.client.get(f'/api/v1/{resource}/').json()['results']]
+            self.assertIn(self.mine[key].pk, ids, resource)
+            self.assertNotIn(self.theirs[key].pk, ids, resource)
+            self.assertEqual(self.client.get(f'/api/v1/{resource}/{self.theirs[key].pk}/').status_code, 404, resource)
+
+    def test_forecast_is_computed_per_scope(self):
+        scoped = get_forecast(3, property_ids=[self.mine['property'].pk])
+        self.assertEqual([p['property_id'] for p in scoped['properties']], [self.mine['property'].pk])
+        self.assertEqual(len(get_forecast(3)['properties']), 2)
+
+    def test_manager_without_properties_gets_empty_reports(self):
+        self.client.force_login(User.objects.create_user('carol', is_staff=True))
+        self.assertEqual(self.client.get(reverse('financial_report')).status_code, 200)
+        self.assertEqual(self.client.get(reverse('occupancy_report')).context['total_units'], 0)
+        self.assertEqual(get_forecast(3, property_ids=[])['properties'], [])
+
+
+class MetricsAccessTests(TestCase):
+
+    def test_closed_by_default_even_from_loopback(self):
+        with self.settings(METRICS_TOKEN='', METRICS_ALLOWED_NETWORKS=[]):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+    def test_token(self):
+        with self.settings(METRICS_TOKEN='s3cret', METRICS_ALLOWED_NETWORKS=[]):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    def test_allowed_networks_are_opt_in(self):
+        with self.settings(METRICS_TOKEN='', METRICS_ALLOWED_NETWORKS=['10.0.0.0/8']):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+
+
+class AsyncMiddlewareTests(TestCase):
+
+    def test_middleware_follows_the_handler(self):
+        async def async_view(request):
+            return HttpResponse()
+
+        for middleware in (MetricsMiddleware, AuditUserMiddleware, ProfilerMiddleware):
+            self.assertTrue(iscoroutinefunction(middleware(async_view)), middleware)
+            self.assertFalse(iscoroutinefunction(middleware(lambda request: HttpResponse())), middleware)
+
+    async def test_audit_sees_the_request_of_an_async_view(self):
+        seen = []
+
+        async def view(request):
+            seen.append(await sync_to_async(audit.current_user_id)())
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.user = User(pk=7)
+        await AuditUserMiddleware(view)(request)
+        self.assertEqual(seen, [7])
+        self.assertIsNone(audit.current_user_id())
+
+    def test_async_view_through_the_whole_stack(self):
+        staff = User.objects.create_user('staff', password='pw', is_staff=True)
+        labels = {'view': 'mpesa_payment_status', 'method': 'GET', 'status': '200'}
+        before = REGISTRY.get_sample_value('ams_http_request_duration_seconds_count', labels) or 0
+
+        async def fetch():
+            await self.async_client.aforce_login(staff)
+            return await self.async_client.get('/mpesa/status/ws_CO_1/', {'_profile': 'sample'})
+
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROFILE_ENABLED=True, PROFILE_DIR=directory):
+            response = async_to_sync(fetch)()
+        self.assertEqual(response.json()['status'], 'pending')
+        self.assertIn('X-Profile-Id', response)
+        self.assertEqual(REGISTRY.get_sample_value('ams_http_request_duration_seconds_count', labels), before + 1)
+
+    def test_profiles_are_served_to_their_owner_only(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        other = User.objects.create_user('other', is_staff=True)
+        boss = User.objects.create_superuser('boss')
+        with tempfile.TemporaryDirectory() as directory, self.settings(PROFILE_ENABLED=True, PROFILE_DIR=directory):
+            self.client.force_login(staff)
+            profile_id = self.client.get(reverse('manager_dashboard'), {'_profile': 'sample'})['X-Profile-Id']
+            url = reverse('profile_download', args=[profile_id, 'json'])
+            self.assertEqual(json.loads(b''.join(self.client.get(url).streaming_content))['user_id'], staff.pk)
+            self.client.force_login(other)
+            self.assertEqual(self.client.get(url).status_code, 404)
+            self.client.force_login(boss)
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class PaymentStatusTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user('owner')
+        cls.other = User.objects.create_user('other')
+        tenant = make_tenant('owner', user=cls.owner)
+        cls.push = StkPush.objects.create(checkout_request_id='ws_CO_7', tenant=tenant, phone_number='0700000000',
+                                          amount=Decimal('500'))
+
+    def setUp(self):
+        cache.clear()
+
+    def status(self, user):
+        self.client.force_login(user)
+        return self.client.get(reverse('mpesa_payment_status', args=['ws_CO_7']))
+
+    def fail(self):
+        mpesa.record_stk_result({'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+                                 'MerchantRequestID': '', 'CheckoutRequestID': 'ws_CO_7'}, 'callback')
+
+    def test_pending_and_failed_statuses_belong_to_the_tenant(self):
+        self.assertEqual(self.status(self.owner).json()['status'], 'pending')
+        self.assertEqual(self.status(self.other).status_code, 404)
+        self.fail()
+        self.assertEqual(self.status(self.owner).json()['status'], 'failed')
+        self.assertNotIn('tenant_user_id', self.status(self.owner).json())
+        self.assertEqual(self.status(self.other).status_code, 404)
+
+    def test_unknown_push_is_only_shown_to_staff(self):
+        self.assertEqual(self.client.get(reverse('mpesa_payment_status', args=['ws_CO_8'])).status_code, 302)
+        self.client.force_login(self.owner)
+        self.assertEqual(self.client.get(reverse('mpesa_payment_status', args=['ws_CO_8'])).status_code, 404)
+        self.other.is_staff = True
+        self.other.save()
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(reverse('mpesa_payment_status', args=['ws_CO_8'])).json()['status'], 'pending')
+
+    def test_outcome_recorded_by_another_worker(self):
+        self.fail()
+        # That worker's cache is not this one's, and its notification does not reach here
+        cache.clear()
+        status = async_to_sync(mpesa.await_payment_status)('ws_CO_7')
+        self.assertEqual((status['status'], status['tenant_user_id']), ('failed', self.owner.pk))
+
+    async def test_waiter_sees_another_worker_without_notification(self):
+        async def answer_elsewhere():
+            await asyncio.sleep(0.1)
+            await StkPush.objects.filter(pk=self.push.pk).aupdate(status='failed', result_desc='Cancelled')
+
+        with self.settings(MPESA_STATUS_RECHECK_SECONDS=0.05):
+            status, _ = await asyncio.gather(mpesa.await_payment_status('ws_CO_7', timeout=5), answer_elsewhere())
+        self.assertEqual(status['status'], 'failed')
+
+
+class ConditionalGetTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+
+    def test_per_process_cache_fails_the_deploy_check(self):
+        self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['my_app.E001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with self.settings(CACHES=shared):
+            self.assertEqual(checks.check_shared_cache(None), [])
+
+    def test_validators_only_with_a_shared_cache(self):
+        self.client.force_login(self.staff)
+        url = reverse('financial_report')
+        response = self.client.get(url)
+        self.assertNotIn('ETag', response)
+        self.assertNotIn('Last-Modified', response)
+        with mock.patch('my_app.views.cache_is_shared', return_value=True):
+            etag = self.client.get(url)['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+
+class SessionUserTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(self.staff)
+
+    def dashboard_status(self):
+        return self.client.get(reverse('manager_dashboard')).status_code
+
+    def test_per_process_cache_keeps_sessions_and_users_in_the_database(self):
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.db')
+        with self.settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db'):
+            self.assertEqual([error.id for error in checks.check_shared_cache(None)], ['my_app.E001', 'my_app.E002'])
+        self.assertEqual(self.dashboard_status(), 200)
+        self.assertIsNone(cache.get(user_cache_key(self.staff.pk)))
+        # As another worker would: no signal reaches this process
+        User.objects.filter(pk=self.staff.pk).update(is_active=False)
+        self.assertEqual(self.dashboard_status(), 302)
+
+    def test_deactivation_ends_the_session(self):
+        for shared in [False, True]:
+            with self.subTest(shared=shared), mock.patch('my_app.backends.cache_is_shared', return_value=shared):
+                User.objects.filter(pk=self.staff.pk).update(is_active=True)
+                self.client.force_login(self.staff)
+                self.assertEqual(self.dashboard_status(), 200)
+                self.assertEqual(cache.get(user_cache_key(self.staff.pk)) is not None, shared)
+                user = User.objects.get(pk=self.staff.pk)
+                user.is_active = False
+                user.save()
+                self.assertEqual(self.dashboard_status(), 302)
+
+    def test_password_change_ends_the_session(self):
+        for shared in [False, True]:
+            with self.subTest(shared=shared), mock.patch('my_app.backends.cache_is_shared', return_value=shared):
+                self.client.force_login(User.objects.get(pk=self.staff.pk))
+                self.assertEqual(self.dashboard_status(), 200)
+                user = User.objects.get(pk=self.staff.pk)
+                user.set_password(f'changed-{shared}')
+                user.save()
+                self.assertEqual(self.dashboard_status(), 302)
+
+
+class OccupancyReportTests(TestCase):
+
+    def test_trends_cannot_break_out_of_the_script(self):
+        self.client.force_login(User.objects.create_superuser('boss'))
+        trends = {'months': ['</script><script>alert(1)</script>'], 'monthly': [], 'monthly_by_type': {},
+                  'years': [], 'yearly': []}
+        with mock.patch('my_app.views.occupancy_trends', return_value=trends):
+            content = self.client.get(reverse('occupancy_report')).content.decode()
+        self.assertIn('<script id="trends-data" type="application/json">', content)
+        self.assertNotIn('<script>alert(1)', content)
+
+
+class OccupancySnapshotTests(TestCase):
+
+    def at(self, day, hour):
+        return timezone.make_aware(datetime(2024, 3, day, hour))
+
+    def setUp(self):
+        prop = make_property()
+        self.first = make_unit(prop, '1', '10000')
+        self.first.status = 'occupied'
+        self.first.save()
+        second = make_unit(prop, '2', '10000')
+        changes = UnitStatusChange.objects.order_by('pk')
+        for change, moment in zip(changes, [self.at(1, 10), self.at(3, 12), self.at(2, 9)]):
+            changes.filter(pk=change.pk).update(changed_at=moment)
+
+    def counts(self, day):
+        return list(OccupancySnapshot.objects.filter(date=day)
+                    .values_list('total_units', 'occupied_units', 'available_units'))
+
+    def test_snapshots_of_past_days_come_from_the_status_history(self):
+        occupancy.take_snapshot(date(2024, 3, 1))
+        self.assertEqual(self.counts(date(2024, 3, 1)), [(1, 0, 1)])
+        self.assertEqual(occupancy.backfill_snapshots(date(2024, 3, 3)), 2)
+        self.assertEqual(self.counts(date(2024, 3, 2)), [(2, 0, 2)])
+        self.assertEqual(self.counts(date(2024, 3, 3)), [(2, 1, 1)])
+        # Only today's is taken again
+        self.assertEqual(occupancy.backfill_snapshots(date(2024, 3, 3)), 1)
+        self.assertEqual(occupancy.backfill_snapshots(date(2024, 3, 10), max_days=2), 3)
+        self.assertEqual(sorted(set(OccupancySnapshot.objects.values_list('date', flat=True))),
+                         [date(2024, 3, day) for day in (1, 2, 3, 8, 9, 10)])
+
+    def test_removed_units_count_until_their_removal(self):
+        Unit.all_objects.filter(pk=self.first.pk).update(deleted_at=self.at(3, 8))
+        occupancy.take_snapshot(date(2024, 3, 2))
+        occupancy.take_snapshot(date(2024, 3, 3))
+        self.assertEqual(self.counts(date(2024, 3, 2)), [(2, 0, 2)])
+        self.assertEqual(self.counts(date(2024, 3, 3)), [(1, 0, 1)])
+
+
+class RentAdjustmentTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.boss = User.objects.create_superuser('boss')
+        cls.unit = make_unit(make_property(), '1', '10000')
+
+    def adjust(self, effective_from):
+        self.client.force_login(self.boss)
+        self.client.post(reverse('rent_adjustment'), {
+            'kind': 'percent', 'amount': '10', 'applies_to': 'units', 'effective_from': effective_from, 'apply': '1',
+        })
+        return RentAdjustment.objects.latest('pk')
+
+    def rent(self):
+        return Unit.objects.get(pk=self.unit.pk).rent_amount
+
+    def test_adjustment_effective_today_is_applied_at_once(self):
+        adjustment = self.adjust(timezone.localdate())
+        self.assertIsNotNone(adjustment.applied_at)
+        self.assertEqual((adjustment.units_changed, self.rent()), (1, Decimal('11000')))
+
+    def test_future_adjustment_waits_for_its_date(self):
+        effective_from = timezone.localdate() + timedelta(days=30)
+        adjustment = self.adjust(effective_from)
+        self.assertIsNone(adjustment.applied_at)
+        self.assertEqual(self.rent(), Decimal('10000'))
+        self.assertFalse(RentSchedule.objects.exists())
+
+        self.assertEqual(rent.apply_due_adjustments(effective_from - timedelta(days=1)), 0)
+        self.assertEqual(rent.apply_due_adjustments(effective_from), 1)
+        self.assertEqual(self.rent(), Decimal('11000'))
+        schedule = RentSchedule.objects.get()
+        self.assertEqual((schedule.effective_from, schedule.previous_amount), (effective_from, Decimal('10000')))
+        # Applied once only
+        self.assertEqual(rent.apply_due_adjustments(effective_from), 0)
+        self.assertEqual(self.rent(), Decimal('11000'))
+
+
+class PaymentBatchApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+        prop = make_property(manager=cls.staff)
+        cls.tenant = make_tenant('mine', unit=make_unit(prop, '1', '10000'))
+        cls.other = make_tenant('other', unit=make_unit(make_property('Other'), '1', '10000'))
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def item(self, **fields):
+        return {'tenant': self.tenant.pk, 'amount': '10000', 'payment_type': 'rent', 'payment_method': 'cash',
+                'payment_date': '2024-03-01', 'status': 'completed', **fields}
+
+    def post(self, body):
+        return self.client.post(reverse('api_payment_batch'), body, content_type='application/json')
+
+    def test_created_payments_are_audited(self):
+        with mock.patch.object(audit.writer, 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            response = self.post({'payments': [self.item(), self.item(amount='500')]})
+        self.assertEqual(response.status_code, 201)
+        ids = [result['id'] for result in response.json()['results']]
+        self.assertEqual(Payment.objects.filter(pk__in=ids).count(), 2)
+        entries = [call.args[0] for call in add.call_args_list]
+        self.assertEqual(sorted((entry[2], entry[3], entry[4]) for entry in entries),
+                         sorted(('create', 'my_app.payment', pk) for pk in ids))
+        self.assertEqual({entry[1] for entry in entries}, {self.staff.pk})
+
+    def test_invalid_items_are_reported_by_index(self):
+        response = self.post({'payments': [
+            self.item(), self.item(tenant=self.other.pk), self.item(tenant=10 ** 30), self.item(tenant='x'),
+            self.item(amount='1e20'), self.item(payment_date='2024-13-01'),
+        ]})
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (1, 5))
+        errors = {result['index']: result['errors'] for result in body['results'] if not result['ok']}
+        self.assertEqual(sorted(errors), [1, 2, 3, 4, 5])
+        self.assertTrue(all('tenant' in errors[index] for index in (1, 2, 3)))
+        self.assertIn('amount', errors[4])
+        self.assertIn('payment_date', errors[5])
+
+    def test_all_or_nothing(self):
+        response = self.post({'payments': [self.item(), self.item(amount='abc')], 'all_or_nothing': True})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['created'], 0)
+        self.assertFalse(Payment.objects.exists())
+
+    def test_malformed_bodies(self):
+        for body in ['not json', {'payments': 'x'}, {'payments': [1]}, [], {'payments': [self.item()] * 1001}]:
+            response = self.client.post(reverse('api_payment_batch'), body if isinstance(body, str) else json.dumps(body),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400, body if isinstance(body, str) else str(body)[:40])
+
+
+class ResourceListApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+        prop = make_property(manager=cls.staff)
+        cls.units = [make_unit(prop, str(number), '10000') for number in range(5)]
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def get(self, **params):
+        return self.client.get('/api/v1/units/', params)
+
+    def test_cursor_walks_every_row_once(self):
+        seen, cursor = [], None
+        while True:
+            body = self.get(limit=2, **({'cursor': cursor} if cursor else {})).json()
+            seen += [row['id'] for row in body['results']]
+            cursor = body['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, [unit.pk for unit in self.units])
+
+    def test_hostile_cursors_are_rejected(self):
+        for after in [10 ** 30, -1, 'x', None, [1], 'Infinity']:
+            cursor = base64.urlsafe_b64encode(json.dumps({'after': after}).encode()).decode().rstrip('=')
+            self.assertEqual(self.get(cursor=cursor).status_code, 400, after)
+        infinite = base64.urlsafe_b64encode(b'{"after": Infinity}').decode().rstrip('=')
+        for cursor in [infinite, '!!!', 'e30', base64.urlsafe_b64encode(b'[]').decode()]:
+            self.assertEqual(self.get(cursor=cursor).status_code, 400, cursor)
+
+    def test_fields_and_limit_are_validated(self):
+        self.assertEqual(list(self.get(fields='rent_amount').json()['results'][0]), ['id', 'rent_amount'])
+        self.assertEqual(self.get(fields='password').status_code, 400)
+        self.assertEqual(self.get(limit='x').status_code, 400)
+        self.assertEqual(len(self.get(limit=10 ** 30).json()['results']), 5)
+        self.assertEqual(len(self.get(limit=-5).json()['results']), 1)
+        self.assertEqual(self.client.get('/api/v1/users/').status_code, 404)
+        self.assertEqual(len(self.get(property=self.units[0].property_id).json()['results']), 5)
+        for resource, param in [('units', 'property'), ('tenants', 'property'), ('payments', 'tenant')]:
+            for value in ['x', '1.5', '-1', '0', str(2 ** 63), '9' * 30]:
+                response = self.client.get(f'/api/v1/{resource}/', {param: value})
+                self.assertEqual(response.status_code, 400, (resource, value))
+                self.assertEqual(response.json(), {'error': f'{param} must be an id'})
+        self.assertEqual(self.client.get(reverse('unit_list'), {'property': 'x'}).status_code, 400)
+
+
+class FakeDaraja:
+    """Answers STK pushes with sequential checkout ids, and STK queries from `answers`."""
+
+    def __init__(self, answers=None, response_code='0'):
+        self.answers = answers or {}
+        self.response_code = response_code
+        self.pushes = []
+
+    def access_token(self):
+        return 'token'
+
+    def stk_push(self, **request):
+        self.pushes.append(request)
+        return SimpleNamespace(response_code=self.response_code, checkout_request_id=f'ws_CO_{len(self.pushes)}',
+                               merchant_request_id='m')
+
+    def stk_query(self, checkout_request_id):
+        return SimpleNamespace(json=lambda: self.answers.get(checkout_request_id, {'errorCode': '500.001.1001'}))
+
+
+class StkPushTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenant = make_tenant('payer')
+
+    def setUp(self):
+        cache.clear()
+        self.daraja = FakeDaraja()
+
+    def push(self, amount, tenant=None):
+        return mpesa.send_stk_push((tenant or self.tenant).pk, '254700000000', amount, 'A1', 'Rent',
+                                   'https://example.com/cb', client=self.daraja)
+
+    def test_repeated_push_returns_the_one_in_flight(self):
+        checkout_request_id, response = self.push(500)
+        self.assertIsNotNone(response)
+        self.assertEqual(self.push(500), (checkout_request_id, None))
+        self.assertEqual(len(self.daraja.pushes), 1)
+        self.assertNotEqual(self.push(600)[0], checkout_request_id)
+        self.assertEqual(StkPush.objects.count(), 2)
+
+    def test_answered_push_can_be_repeated(self):
+        checkout_request_id, _ = self.push(500)
+        mpesa.record_stk_result({'ResultCode': 1032, 'ResultDesc': 'Cancelled', 'MerchantRequestID': 'm',
+                                 'CheckoutRequestID': checkout_request_id}, 'callback')
+        self.assertNotEqual(self.push(500)[0], checkout_request_id)
+        self.assertEqual(len(self.daraja.pushes), 2)
+
+    def test_refused_push_frees_the_amount(self):
+        self.daraja.response_code = '1'
+        self.push(500)
+        self.daraja.response_code = '0'
+        self.assertIsNotNone(self.push(500)[1])
+        self.assertEqual(len(self.daraja.pushes), 2)
+
+    def test_tenant_and_global_limits(self):
+        with self.settings(MPESA_STK_TENANT_LIMIT=(2, 1), MPESA_STK_GLOBAL_LIMIT=(3, 1)):
+            self.push(100)
+            self.push(200)
+            with self.assertRaises(mpesa.StkPushThrottled) as throttled:
+                self.push(300)
+            self.assertGreater(throttled.exception.retry_after, 0)
+            self.push(300, make_tenant('neighbour'))
+            with self.assertRaises(mpesa.StkPushThrottled):
+                self.push(400, make_tenant('third'))
+        self.assertEqual(len(self.daraja.pushes), 3)
+        # A refused push does not hold the amount for the dedup window
+        self.assertIsNone(cache.get(mpesa._inflight_key(self.tenant.pk, 300)))
+
+
+class StkPollerTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.tenant = make_tenant('payer')
+
+    def setUp(self):
+        cache.clear()
+        for checkout_request_id in ['ws_CO_paid', 'ws_CO_cancelled', 'ws_CO_silent', 'ws_CO_new']:
+            StkPush.objects.create(checkout_request_id=checkout_request_id, tenant=self.tenant,
+                                   phone_number='254700000000', amount=Decimal('500'))
+        StkPush.objects.exclude(checkout_request_id='ws_CO_new').update(
+            created_at=timezone.now() - timedelta(minutes=10))
+        self.daraja = FakeDaraja({
+            'ws_CO_paid': {'ResultCode': '0', 'ResultDesc': 'Processed', 'MerchantRequestID': 'm'},
+            'ws_CO_cancelled': {'ResultCode': '1032', 'ResultDesc': 'Cancelled', 'MerchantRequestID': 'm'},
+        })
+
+    def callback(self, checkout_request_id):
+        return mpesa.record_stk_callback({'Body': {'stkCallback': {
+            'MerchantRequestID': 'm', 'CheckoutRequestID': checkout_request_id, 'ResultCode': 0,
+            'ResultDesc': 'Processed', 'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 500}, {'Name': 'MpesaReceiptNumber', 'Value': 'R1'},
+            ]},
+        }}})
+
+    def test_answers_are_recorded_and_the_rest_retried(self):
+        self.assertEqual(mpesa.poll_stk_pushes(client=self.daraja), {'completed': 1, 'failed': 1, 'pending': 1})
+        statuses = dict(StkPush.objects.values_list('checkout_request_id', 'status'))
+        self.assertEqual(statuses, {'ws_CO_paid': 'completed', 'ws_CO_cancelled': 'failed',
+                                    'ws_CO_silent': 'pending', 'ws_CO_new': 'pending'})
+        self.assertEqual(Payment.objects.get().checkout_request_id, 'ws_CO_paid')
+        # The callback Safaricom sends late does not record the payment again
+        self.assertEqual(self.callback('ws_CO_paid')['status'], 'completed')
+        self.assertEqual(Payment.objects.count(), 1)
+        # A push just looked up waits MPESA_STK_QUERY_AFTER_SECONDS before the next query
+        self.assertEqual(mpesa.poll_stk_pushes(client=self.daraja), {})
+
+    def test_unanswered_push_expires_but_a_late_callback_still_counts(self):
+        with self.settings(MPESA_STK_QUERY_MAX_ATTEMPTS=1):
+            self.assertEqual(mpesa.poll_stk_pushes(client=self.daraja)['expired'], 1)
+        self.assertEqual(StkPush.objects.get(checkout_request_id='ws_CO_silent').status, 'expired')
+        self.assertEqual(self.callback('ws_CO_silent')['status'], 'completed')
+        self.assertTrue(Payment.objects.filter(checkout_request_id='ws_CO_silent').exists())
+
+
+class SchedulerTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.job = scheduler.Job('test_job', scheduler.CronSchedule('*/5 * * * *'),
+                                 lambda run: self.calls.append(run.slot), lease_seconds=60)
+        scheduler.sync_leases([self.job])
+        self.slot = self.job.schedule.previous(timezone.now())
+
+    def lease(self):
+        return JobLease.objects.get(job='test_job', shard=0)
+
+    def expire(self):
+        JobLease.objects.filter(job='test_job').update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_slot_runs_once_across_workers(self):
+        self.assertEqual(scheduler.run_pending([self.job], 'a'), 1)
+        self.assertEqual(scheduler.run_pending([self.job], 'b'), 0)
+        self.assertEqual(self.calls, [self.slot])
+        self.assertEqual((self.lease().status, self.lease().slot), ('done', self.slot))
+
+    def test_expired_lease_is_taken_over(self):
+        now = timezone.now()
+        scheduler.open_slot(self.job, self.slot, now)
+        self.assertTrue(scheduler.claim(self.job, 0, self.slot, 'a', now))
+        stale = self.lease()
+        self.assertFalse(scheduler.claim(self.job, 0, self.slot, 'b', now))
+        self.expire()
+        self.assertTrue(scheduler.claim(self.job, 0, self.slot, 'b', timezone.now()))
+        # The worker that stalled, finishing late, leaves the lease to the one that took over
+        scheduler.execute(self.job, stale)
+        self.assertEqual((self.lease().status, self.lease().owner), ('running', 'b'))
+        scheduler.execute(self.job, self.lease())
+        self.assertEqual((self.lease().status, self.lease().attempts), ('done', 2))
+
+    def test_gives_up_after_max_attempts(self):
+        now = timezone.now()
+        scheduler.open_slot(self.job, self.slot, now)
+        with self.settings(SCHEDULER_MAX_ATTEMPTS=2):
+            for worker in ['a', 'b']:
+                self.assertTrue(scheduler.claim(self.job, 0, self.slot, worker, timezone.now()))
+                self.expire()
+            self.assertEqual(scheduler.run_pending([self.job], 'c'), 0)
+        self.assertEqual((self.lease().status, self.lease().error), ('failed', 'Lease expired on every attempt'))
+        self.assertEqual(self.calls, [])
+
+    def test_running_shard_holds_back_the_next_slot(self):
+        earlier = self.slot - timedelta(minutes=5)
+        now = timezone.now()
+        scheduler.open_slot(self.job, earlier, now)
+        scheduler.claim(self.job, 0, earlier, 'a', now)
+        self.assertFalse(scheduler.open_slot(self.job, self.slot, now))
+        self.expire()
+        self.assertTrue(scheduler.open_slot(self.job, self.slot, timezone.now()))
+        self.assertEqual((self.lease().status, self.lease().slot, self.lease().attempts), ('pending', self.slot, 0))
+
+    def test_shards_split_the_properties(self):
+        ids = [make_property(f'P{n}').pk for n in range(7)]
+        job = scheduler.Job('test_sharded', scheduler.CronSchedule('@daily'), lambda run: None, shards=3)
+        scheduler.sync_leases([job])
+        scheduler.open_slot(job, job.schedule.previous(timezone.now()), timezone.now())
+        covered = []
+        for lease in JobLease.objects.filter(job='test_sharded').order_by('shard'):
+            run = scheduler.Run(job, lease.slot, lease.shard, lease.range_start, lease.range_end)
+            covered += list(run.properties(Property.all_objects.order_by('pk')).values_list('pk', flat=True))
+        self.assertEqual(covered, ids)
+
+
+class PropertyDeletionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.boss = User.objects.create_superuser('boss')
+        cls.prop = make_property('Doomed')
+        cls.units = [make_unit(cls.prop, str(number), '10000') for number in range(3)]
+        cls.former = make_tenant('former', unit=cls.units[0], status='inactive')
+        Payment.objects.create(tenant=cls.former, amount=Decimal('10000'), payment_date=date(2024, 1, 1))
+        for unit in cls.units:
+            UnitStatusChange.objects.create(unit=unit, new_status='available')
+            RentSchedule.objects.create(unit=unit, effective_from=date(2024, 1, 1), previous_amount=Decimal('9000'),
+                                        rent_amount=Decimal('10000'))
+        OccupancySnapshot.objects.create(property=cls.prop, date=date(2024, 1, 1), unit_type='studio', total_units=3)
+        cls.kept = make_property('Kept')
+        cls.kept_unit = make_unit(cls.kept, '1', '10000')
+
+    def test_delete_hides_the_property_and_its_units(self):
+        self.client.force_login(self.boss)
+        self.client.post(reverse('property_delete', args=[self.prop.pk]))
+        self.assertEqual(list(Property.objects.all()), [self.kept])
+        self.assertEqual(list(Unit.objects.all()), [self.kept_unit])
+        self.assertEqual(Unit.all_objects.filter(property=self.prop).count(), 3)
+        self.assertEqual(self.client.get(reverse('property_detail', args=[self.prop.pk])).status_code, 404)
+        self.assertEqual(deletion.restore_properties(Property.all_objects.filter(pk=self.prop.pk)), 1)
+        self.assertEqual(Unit.objects.filter(property=self.prop).count(), 3)
+
+    def test_active_tenants_block_the_delete(self):
+        self.client.force_login(self.boss)
+        make_tenant('current', unit=self.units[1])
+        self.client.post(reverse('property_delete', args=[self.prop.pk]))
+        self.assertTrue(Property.objects.filter(pk=self.prop.pk).exists())
+
+    def test_purge_after_the_grace_period(self):
+        deletion.soft_delete_properties(Property.objects.filter(pk=self.prop.pk))
+        self.assertFalse(deletion.purgeable().exists())
+        Property.all_objects.filter(pk=self.prop.pk).update(deleted_at=timezone.now() - timedelta(days=31))
+        self.assertEqual(list(deletion.purgeable()), [self.prop])
+
+        with mock.patch.object(audit.writer, 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            deletion.purge_property(self.prop.pk, batch_size=2)
+        self.assertEqual(add.call_args.args[0][2:5], ('delete', 'my_app.property', self.prop.pk))
+        self.assertFalse(Property.all_objects.filter(pk=self.prop.pk).exists())
+        self.assertFalse(Unit.all_objects.filter(pk__in=[unit.pk for unit in self.units]).exists())
+        self.assertFalse(UnitStatusChange.objects.filter(unit_id__in=[unit.pk for unit in self.units]).exists())
+        self.assertFalse(RentSchedule.objects.exists())
+        self.assertFalse(OccupancySnapshot.objects.filter(property_id=self.prop.pk).exists())
+        # Tenants and their payments outlive the unit they rented
+        former = Tenant.objects.get(pk=self.former.pk)
+        self.assertIsNone(former.unit_id)
+        self.assertEqual(former.payments.count(), 1)
+        self.assertEqual(list(Unit.objects.all()), [self.kept_unit])
+
+
+class PaymentArchiveTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.boss = User.objects.create_superuser('boss')
+        cls.tenant = make_tenant('payer', unit=make_unit(make_property(), '1', '10000'))
+        cls.payments = {}
+        for name, day, status in [('old', date(2021, 5, 1), 'completed'), ('old_pending', date(2021, 6, 1), 'pending'),
+                                  ('last_archived', date(2022, 12, 31), 'completed'),
+                                  ('first_live', date(2023, 1, 1), 'completed'), ('new', date(2024, 2, 1), 'completed')]:
+            cls.payments[name] = Payment.objects.create(tenant=cls.tenant, amount=Decimal('1000'), payment_date=day,
+                                                        status=status, reference_number=name)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cutoff_is_a_whole_number_of_months_back(self):
+        self.assertEqual(archive.archive_cutoff(24, date(2025, 1, 15)), date(2023, 1, 1))
+        self.assertEqual(archive.archive_cutoff(1, date(2025, 1, 31)), date(2024, 12, 1))
+        self.assertEqual(archive.archive_cutoff(0, date(2025, 3, 2)), date(2025, 3, 1))
+
+    def test_archives_completed_payments_before_the_cutoff(self):
+        self.assertIsNone(archive.archive_boundary())
+        self.assertEqual(archive.archive_payments(date(2023, 1, 1), batch_size=1)[0], 2)
+        archived = {self.payments['old'].pk, self.payments['last_archived'].pk}
+        self.assertEqual(set(PaymentArchive.objects.values_list('pk', flat=True)), archived)
+        self.assertFalse(Payment.objects.filter(pk__in=archived).exists())
+        self.assertTrue(Payment.objects.filter(pk=self.payments['old_pending'].pk).exists())
+        self.assertEqual(sorted(PaymentRollup.objects.values_list('year', 'total')),
+                         [(2021, Decimal('1000')), (2022, Decimal('1000'))])
+        self.assertEqual(archive.archive_payments(date(2023, 1, 1)), (0, 0))
+
+        self.assertEqual(archive.archive_boundary(), date(2022, 12, 31))
+        self.assertTrue(archive.reaches_archive(date(2022, 12, 31), date(2024, 1, 1)))
+        self.assertTrue(archive.reaches_archive(None, date(2024, 1, 1)))
+        self.assertTrue(archive.reaches_archive(date(2023, 1, 1), None))
+        self.assertFalse(archive.reaches_archive(date(2023, 1, 1), date(2024, 1, 1)))
+
+    def test_listing_across_the_boundary_merges_in_date_order(self):
+        archive.archive_payments(date(2023, 1, 1))
+        self.client.force_login(self.boss)
+        listed = self.client.get(reverse('payment_list'), {'from': '2022-12-31'}).context['payments']
+        self.assertEqual([p.reference_number for p in listed], ['new', 'first_live', 'last_archived'])
+        listed = self.client.get(reverse('payment_list'), {'from': '2023-01-01'}).context['payments']
+        self.assertEqual([p.reference_number for p in listed], ['new', 'first_live'])
+        listed = self.client.get(reverse('payment_list'), {'to': '2023-01-01'}).context['payments']
+        self.assertEqual([p.reference_number for p in listed], ['first_live', 'last_archived', 'old_pending', 'old'])
+        context = self.client.get(reverse('payment_list')).context
+        self.assertEqual(len(context['payments']), 5)
+        self.assertEqual((context['total_payments'], context['total_collected']), (5, Decimal('4000')))
+
+    def test_api_pages_through_live_and_archived_payments(self):
+        archive.archive_payments(date(2023, 1, 1))
+        self.client.force_login(self.boss)
+        seen, cursor = [], None
+        while True:
+            body = self.client.get('/api/v1/payments/', {'limit': 2, 'fields': 'reference_number',
+                                                         **({'cursor': cursor} if cursor else {})}).json()
+            seen += [row['reference_number'] for row in body['results']]
+            cursor = body['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(seen, list(self.payments))
+        body = self.client.get('/api/v1/payments/', {'from': '2023-01-01', 'to': '2024-12-31'}).json()
+        self.assertEqual([row['id'] for row in body['results']], [self.payments['first_live'].pk, self.payments['new'].pk])
+        old = self.payments['old'].pk
+        self.assertEqual(self.client.get(f'/api/v1/payments/{old}/').json()['id'], old)
+
+    def test_merge_totals_adds_by_key(self):
+        merged = archive.merge_totals([{'type': 'rent', 'total': Decimal('5')}, {'type': 'fee', 'total': None}],
+                                      [{'type': 'rent', 'total': Decimal('2')}, {'type': 'deposit', 'total': Decimal('9')}],
+                                      'type')
+        self.assertEqual(merged, [{'type': 'deposit', 'total': Decimal('9')}, {'type': 'rent', 'total': Decimal('7')},
+                                  {'type': 'fee', 'total': Decimal('0')}])
+
+
+class ReconciliationTests(TestCase):
+
+    HEADER = 'Receipt No.,Completion Time,Paid In,Other Party Info,Details,Transaction Status'
+    # receipt, date, amount, phone, details, status -> expected outcome
+    LINES = [
+        ('QA1', '2024-03-01 10:00:00', '10000', '254712345678', 'Rent', 'Completed', 'matched'),
+        ('QF9', '2024-04-03 09:00:00', '5000', '254712345678', 'Rent', 'Completed', 'matched_fuzzy'),
+        ('QA1', '2024-03-01 10:00:00', '10000', '254712345678', 'Rent', 'Completed', 'duplicate'),
+        ('QD1', '2024-05-01 12:00:00', '7000', '254722000000', 'Rent', 'Completed', 'duplicate'),
+        ('QOLD', '2021-01-10 08:00:00', '8000', '254712345678', 'Rent', 'Completed', 'matched'),
+        ('QM1', '2024-06-01 08:00:00', '3000', '254712345678', 'Rent', 'Completed', 'missing'),
+        ('QU1', '2024-06-01 08:00:00', '100', '254799999999', 'Rent', 'Completed', 'unmatched'),
+        ('QS1', '2024-06-01 08:00:00', '100', '254712345678', 'Rent', 'Failed', 'skipped'),
+        # Same tenant and amount as QF9, whose payment is already claimed
+        ('', '2024-04-04 09:00:00', '5000', '', 'RENT-{tenant}', 'Completed', 'missing'),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+        prop = make_property()
+        cls.tenant = make_tenant('payer', unit=make_unit(prop, '1', '10000'), phone='0712345678')
+        cls.other = make_tenant('other', unit=make_unit(prop, '2', '7000'), phone='0722000000')
+        cls.payments = {}
+        for name, tenant, amount, day, reference in [
+                ('receipt', cls.tenant, '10000', date(2024, 3, 1), 'QA1'),
+                ('cash', cls.tenant, '5000', date(2024, 4, 2), ''),
+                ('twice', cls.other, '7000', date(2024, 5, 1), 'QD1'),
+                ('again', cls.other, '7000', date(2024, 5, 1), 'QD1'),
+                ('old', cls.tenant, '8000', date(2021, 1, 10), 'QOLD')]:
+            cls.payments[name] = Payment.objects.create(tenant=tenant, amount=Decimal(amount), payment_date=day,
+                                                        reference_number=reference)
+
+    def setUp(self):
+        cache.clear()
+        archive.archive_payments(date(2022, 1, 1))
+
+    def csv(self, lines=None):
+        rows = [','.join(line[:6]).format(tenant=self.tenant.pk) for line in lines or self.LINES]
+        return '\n'.join([self.HEADER, *rows]) + '\n'
+
+    def reconcile(self, **options):
+        reconciler = Reconciler(**options)
+        return reconciler, list(reconciler.reconcile(io.StringIO(self.csv())))
+
+    def statement(self):
+        handle = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with handle:
+            handle.write(self.csv())
+        self.addCleanup(os.remove, handle.name)
+        return handle.name
+
+    def test_every_line_gets_its_outcome_whatever_the_chunk_size(self):
+        expected = [line[6] for line in self.LINES]
+        for chunk_size in [5000, 3, 1]:
+            with self.subTest(chunk_size=chunk_size):
+                reconciler, results = self.reconcile(chunk_size=chunk_size)
+                self.assertEqual([result.outcome for result in results], expected)
+                self.assertEqual([result.line_no for result in results], list(range(2, len(expected) + 2)))
+                matched = {result.receipt: result.payment_id for result in results if result.outcome.startswith('matched')}
+                self.assertEqual(matched, {'QA1': self.payments['receipt'].pk, 'QF9': self.payments['cash'].pk,
+                                           'QOLD': self.payments['old'].pk})
+                self.assertEqual(results[2].note, 'receipt appears earlier in the statement')
+                recorded, ids = results[3].note.split(': ')
+                self.assertEqual(recorded, 'recorded 2 times')
+                self.assertEqual(set(ids.split(', ')), {str(self.payments['twice'].pk), str(self.payments['again'].pk)})
+                self.assertEqual(results[8].tenant_id, self.tenant.pk)
+                self.assertEqual(reconciler.summary.counts['missing'], 2)
+                self.assertEqual(reconciler.summary.amounts['missing'], Decimal('8000'))
+
+    def test_fuzzy_match_respects_amount_tolerance_and_date_window(self):
+        line = [('', '2024-04-05 09:00:00', '4990', '254712345678', 'Rent', 'Completed')]
+        for options, outcome in [({}, 'missing'), ({'amount_tolerance': 10}, 'missing'),
+                                 ({'date_window': 3}, 'missing'),
+                                 ({'amount_tolerance': 10, 'date_window': 3}, 'matched_fuzzy')]:
+            with self.subTest(**options):
+                options = {'date_window': 2, **options}
+                result, = Reconciler(**options).reconcile(io.StringIO(self.csv(line)))
+                self.assertEqual(result.outcome, outcome)
+
+    def test_create_missing_records_the_missing_payments(self):
+        version = model_version(Payment)
+        before = REGISTRY.get_sample_value('ams_payments_created_total', {'method': 'mpesa'}) or 0
+        with mock.patch.object(audit.writer, 'add'), self.captureOnCommitCallbacks(execute=True):
+            reconciler, results = self.reconcile(create_missing=True, chunk_size=2)
+        created = [result for result in results if result.outcome == 'created']
+        self.assertEqual([result.receipt for result in created], ['QM1', ''])
+        payments = Payment.objects.filter(pk__in=[result.payment_id for result in created]).order_by('pk')
+        self.assertEqual([(p.tenant_id, p.amount, p.payment_date, p.status) for p in payments],
+                         [(self.tenant.pk, Decimal('3000'), date(2024, 6, 1), 'completed'),
+                          (self.tenant.pk, Decimal('5000'), date(2024, 4, 4), 'completed')])
+        self.assertGreater(model_version(Payment), version)
+        self.assertEqual(REGISTRY.get_sample_value('ams_payments_created_total', {'method': 'mpesa'}), before + 2)
+
+    def test_created_payments_are_audited_as_the_commands_user(self):
+        with mock.patch.object(audit.writer, 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            call_command('reconcile_statement', self.statement(), '--create-missing', '--user', 'staff',
+                         stdout=io.StringIO())
+        payment = Payment.objects.get(reference_number='QM1')
+        self.assertEqual((payment.tenant, payment.amount), (self.tenant, Decimal('3000')))
+        entries = [call.args[0] for call in add.call_args_list]
+        self.assertEqual([entry[1:5] for entry in entries if entry[4] == payment.pk],
+                         [(self.staff.pk, 'create', 'my_app.payment', payment.pk)])
+
+    def test_dry_run_leaves_no_trace(self):
+        count = Payment.objects.count()
+        with mock.patch('my_app.reconciliation.bump_model_version') as bump, \
+                mock.patch('my_app.reconciliation.record_payments_created') as record, \
+                mock.patch.object(audit.writer, 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            out = io.StringIO()
+            call_command('reconcile_statement', self.statement(), '--create-missing', '--dry-run', stdout=out)
+        self.assertRegex(out.getvalue(), r'created +2 ')
+        self.assertEqual(Payment.objects.count(), count)
+        bump.assert_not_called()
+        record.assert_not_called()
+        add.assert_not_called()
+
+
+class LifecycleTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.prop = make_property()
+        cls.units = {number: make_unit(cls.prop, number, '10000', status=status)
+                     for number, status in [('1', 'occupied'), ('2', 'occupied'), ('3', 'available'), ('4', 'available')]}
+        cls.user = User.objects.create_user('resident')
+        cls.first = make_tenant('first', unit=cls.units['1'], user=cls.user, rent_amount=Decimal('10000'),
+                                lease_start_date=date(2024, 1, 1), lease_end_date=date(2024, 12, 31))
+        cls.second = make_tenant('second', unit=cls.units['2'], rent_amount=Decimal('10000'),
+                                 lease_start_date=date(2024, 1, 1), lease_end_date=date(2024, 12, 31))
+        cls.applicant = make_tenant('applicant', status='pending')
+
+    def setUp(self):
+        cache.clear()
+        self.first_change = UnitStatusChange.objects.order_by('pk').last().pk + 1
+
+    def run_action(self, action, *args):
+        """(result, audit entries as (action, model, pk, changes)) of a lifecycle action."""
+        with mock.patch.object(audit.writer, 'add') as add, self.captureOnCommitCallbacks(execute=True):
+            result = action(*args)
+        return result, [call.args[0][2:] for call in add.call_args_list]
+
+    def status_changes(self):
+        return sorted(UnitStatusChange.objects.filter(pk__gte=self.first_change)
+                      .values_list('unit__unit_number', 'old_status', 'new_status'))
+
+    def assert_units_consistent(self):
+        for unit in Unit.objects.filter(property=self.prop):
+            lived_in = unit.tenants.filter(status='active').exists()
+            self.assertEqual(unit.is_occupied, unit.status == 'occupied', unit.unit_number)
+            self.assertEqual(unit.status == 'occupied', lived_in, unit.unit_number)
+
+    def test_move_out_frees_the_unit(self):
+        cache.set(user_cache_key(self.user.pk), self.user)
+        version = model_version(Tenant)
+        (moved, freed), entries = self.run_action(lifecycle.move_out, Tenant.objects.filter(pk=self.first.pk), date(2024, 6, 30))
+        self.assertEqual((moved, freed), (1, 1))
+        tenant = Tenant.objects.get(pk=self.first.pk)
+        self.assertEqual((tenant.status, tenant.lease_end_date, tenant.unit_id), ('inactive', date(2024, 6, 30), self.units['1'].pk))
+        self.assertEqual(self.status_changes(), [('1', 'occupied', 'available')])
+        self.assertIn(('update', 'my_app.tenant', self.first.pk,
+                       {'status': ('active', 'inactive'), 'lease_end_date': (date(2024, 12, 31), date(2024, 6, 30))}), entries)
+        self.assertIn(('update', 'my_app.unit', self.units['1'].pk,
+                       {'status': ('occupied', 'available'), 'is_occupied': (True, False)}), entries)
+        self.assertIsNone(cache.get(user_cache_key(self.user.pk)))
+        self.assertGreater(model_version(Tenant), version)
+        self.assert_units_consistent()
+        self.assertEqual(lifecycle.move_out(Tenant.objects.filter(pk=self.first.pk)), (0, 0))
+
+    def test_renewal_extends_leases_and_schedules_the_new_rent(self):
+        tenants = Tenant.objects.filter(pk__in=[self.first.pk, self.second.pk])
+        Tenant.objects.filter(pk=self.second.pk).update(lease_start_date=date(2026, 1, 1))
+        renewed, entries = self.run_action(lifecycle.renew_leases, tenants, date(2025, 12, 31), Decimal('11000'))
+        self.assertEqual(renewed, 1)
+        tenant = Tenant.objects.get(pk=self.first.pk)
+        self.assertEqual((tenant.lease_end_date, tenant.rent_amount), (date(2025, 12, 31), Decimal('11000')))
+        self.assertEqual(Tenant.objects.get(pk=self.second.pk).lease_end_date, date(2024, 12, 31))
+        self.assertEqual(list(RentSchedule.objects.filter(tenant=self.first).values_list('previous_amount', 'rent_amount')),
+                         [(Decimal('10000'), Decimal('11000'))])
+        self.assertEqual(entries, [('update', 'my_app.tenant', self.first.pk,
+                                    {'lease_end_date': (date(2024, 12, 31), date(2025, 12, 31)),
+                                     'rent_amount': (Decimal('10000'), Decimal('11000'))})])
+        self.assertEqual(self.status_changes(), [])
+
+    def test_unit_status_skips_lived_in_units(self):
+        units = Unit.objects.filter(pk__in=[self.units['2'].pk, self.units['3'].pk])
+        (changed, skipped), entries = self.run_action(lifecycle.set_unit_status, units, 'reserved')
+        self.assertEqual((changed, skipped), (1, 1))
+        self.assertEqual(self.status_changes(), [('3', 'available', 'reserved')])
+        self.assertEqual(entries, [('update', 'my_app.unit', self.units['3'].pk, {'status': ('available', 'reserved')})])
+        (changed, skipped), _ = self.run_action(lifecycle.set_unit_status, units, 'maintenance')
+        self.assertEqual((changed, skipped), (2, 0))
+        self.assertEqual(Unit.objects.get(pk=self.units['2'].pk).is_occupied, False)
+
+    def test_assignment_houses_tenants_in_vacant_units(self):
+        tenants = Tenant.objects.filter(pk__in=[self.applicant.pk, self.second.pk])
+        (assigned, left_over), entries = self.run_action(lifecycle.assign_to_vacant_units, tenants, self.prop)
+        self.assertEqual((assigned, left_over), (2, 0))
+        # By name onto the units by number: applicant -> 3, second -> 4
+        housed = dict(Tenant.objects.filter(pk__in=[self.applicant.pk, self.second.pk]).values_list('pk', 'unit_id'))
+        self.assertEqual(housed, {self.applicant.pk: self.units['3'].pk, self.second.pk: self.units['4'].pk})
+        self.assertEqual(set(Tenant.objects.filter(pk__in=housed).values_list('status', 'last_property_id')),
+                         {('active', self.prop.pk)})
+        self.assertEqual(self.status_changes(), [('2', 'occupied', 'available'), ('3', 'available', 'occupied'),
+                                                 ('4', 'available', 'occupied')])
+        self.assertIn(('update', 'my_app.tenant', self.applicant.pk,
+                       {'unit_id': (None, self.units['3'].pk), 'status': ('pending', 'active')}), entries)
+        self.assert_units_consistent()
+        # Moving house frees the unit left behind
+        self.assertEqual(lifecycle.assign_to_vacant_units(Tenant.objects.filter(pk=self.first.pk), self.prop), (1, 0))
+        self.assertEqual(Tenant.objects.get(pk=self.first.pk).unit_id, self.units['2'].pk)
+        self.assertEqual(Unit.objects.get(pk=self.units['1'].pk).status, 'available')
+        self.assert_units_consistent()
+        # One unit (1) left for three tenants
+        self.assertEqual(lifecycle.assign_to_vacant_units(Tenant.objects.filter(unit__property=self.prop), self.prop), (1, 2))
+        self.assert_units_consistent()
+
+
+class PhotoProcessingTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.prop = make_property()
+        buffer = io.BytesIO()
+        Image.new('RGBA', (16, 8), (200, 30, 30, 128)).save(buffer, 'PNG')
+        cls.png = buffer.getvalue()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = self.settings(MEDIA_ROOT=directory.name, PHOTO_WORKERS=0, PHOTO_WIDTHS=[4, 8, 32])
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_photo(self, data=None):
+        return Photo.objects.create(property=self.prop, image=ContentFile(data or self.png, name='upload.png'))
+
+    def rendition_names(self, photo):
+        return [name for sources in photo.renditions.values() for _, _, name in sources]
+
+    def test_process_makes_renditions_once(self):
+        photo = self.make_photo()
+        self.assertEqual(photos.process(photo.pk), 'ready')
+        photo.refresh_from_db()
+        self.assertEqual((photo.status, photo.attempts, photo.digest), ('ready', 1, hashlib.sha256(self.png).hexdigest()))
+        # Never wider than the original
+        self.assertEqual({kind: [source[:2] for source in sources] for kind, sources in photo.renditions.items()},
+                         {'webp': [[4, 2], [8, 4], [16, 8]], 'jpeg': [[4, 2], [8, 4], [16, 8]]})
+        self.assertTrue(all(default_storage.exists(name) for name in self.rendition_names(photo)))
+        self.assertFalse(photos.claim(photo.pk))
+        self.assertIsNone(photos.process(photo.pk))
+
+    def test_stale_claims_are_taken_over(self):
+        stale, fresh = self.make_photo(), self.make_photo()
+        long_ago = timezone.now() - timedelta(seconds=settings.PHOTO_PROCESSING_TIMEOUT + 1)
+        Photo.objects.filter(pk=stale.pk).update(status='processing', processing_started_at=long_ago, attempts=1)
+        self.assertTrue(photos.claim(fresh.pk))
+        self.assertFalse(photos.claim(fresh.pk))
+        self.assertEqual(photos.process_pending(), {'ready': 1})
+        self.assertEqual(dict(Photo.objects.values_list('pk', 'status')), {stale.pk: 'ready', fresh.pk: 'processing'})
+        self.assertEqual(Photo.objects.get(pk=stale.pk).attempts, 2)
+
+    def test_photos_fail_after_max_attempts(self):
+        broken = self.make_photo(b'not an image')
+        with self.assertLogs('my_app.photos', 'ERROR'):
+            outcomes = [photos.process(broken.pk) for _ in range(settings.PHOTO_MAX_ATTEMPTS)]
+        self.assertEqual(outcomes, ['pending'] * (settings.PHOTO_MAX_ATTEMPTS - 1) + ['failed'])
+        broken.refresh_from_db()
+        self.assertEqual(broken.attempts, settings.PHOTO_MAX_ATTEMPTS)
+        self.assertTrue(broken.error.startswith('UnidentifiedImageError'))
+        self.assertIsNone(photos.process(broken.pk))
+
+        # A worker that died on its last attempt
+        abandoned = self.make_photo()
+        long_ago = timezone.now() - timedelta(seconds=settings.PHOTO_PROCESSING_TIMEOUT + 1)
+        Photo.objects.filter(pk=abandoned.pk).update(status='processing', processing_started_at=long_ago,
+                                                     attempts=settings.PHOTO_MAX_ATTEMPTS)
+        self.assertEqual(photos.process_pending(), {})
+        self.assertEqual(Photo.objects.get(pk=abandoned.pk).status, 'failed')
+
+    def test_discard_keeps_renditions_another_photo_uses(self):
+        first, second = self.make_photo(), self.make_photo()
+        photos.process(first.pk)
+        photos.process(second.pk)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.renditions, second.renditions)
+        self.assertNotEqual(first.image.name, second.image.name)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(default_storage.exists(first.image.name))
+        self.assertTrue(all(default_storage.exists(name) for name in self.rendition_names(second)))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(second.image.name))
+        self.assertFalse(any(default_storage.exists(name) for name in self.rendition_names(second)))
+
+
+class ClearPortfolioTests(TestCase):
+
+    def test_nothing_is_left_pointing_at_the_cleared_rows(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        prop = make_property()
+        tenant = make_tenant('payer', unit=make_unit(prop, '1', '10000'))
+        Payment.objects.create(tenant=tenant, amount=Decimal('10000'), payment_date=date(2024, 1, 1))
+        push = StkPush.objects.create(checkout_request_id='ws_CO_1', tenant=tenant, phone_number='0700000000',
+                                      amount=Decimal('10000'))
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(buffer, 'PNG')
+        with self.settings(MEDIA_ROOT=directory.name, PHOTO_WORKERS=0, PHOTO_WIDTHS=[4]):
+            photo = Photo.objects.create(property=prop, image=ContentFile(buffer.getvalue(), name='upload.png'))
+            photos.process(photo.pk)
+            photo.refresh_from_db()
+            for model in ('my_app.tenant', 'my_app.payment', 'auth.user'):
+                AuditLog.objects.create(created_at=timezone.now(), action='create', model=model, object_id=1)
+
+            synthetic.clear_portfolio()
+            self.assertFalse(any(default_storage.exists(name) for name in
+                                 [photo.image.name, *(name for _, _, name in photo.renditions['webp'])]))
+        connection.check_constraints()
+        self.assertFalse(Photo.objects.exists())
+        self.assertIsNone(StkPush.objects.get(pk=push.pk).tenant_id)
+        self.assertEqual(list(AuditLog.objects.values_list('model', flat=True)), ['auth.user'])
+        self.assertFalse(Tenant.objects.exists() or Payment.objects.exists() or Property.all_objects.exists())
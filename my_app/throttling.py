@@ -0,0 +1,63 @@
+"""
+Token-bucket rate limits kept in the cache.
+
+A bucket holds up to `capacity` tokens and gains `per_minute` of them a minute; every
+request takes one and is refused while the bucket is empty, so short bursts get through
+and sustained traffic is held to the refill rate. A bucket's state, (tokens, time), is
+kept in the default cache, so the limit is shared by every process on that cache: all
+nodes with a shared backend (CACHE_BACKEND), or each process on its own with the
+local-memory default. Updates are serialized with a short lock taken with cache.add(),
+which every backend does atomically. When the lock stays taken the request is refused
+rather than let through unchecked.
+"""
+import time
+
+from django.core.cache import cache
+
+from . import metrics
+
+LOCK_TIMEOUT = 2
+LOCK_ATTEMPTS = 20
+LOCK_WAIT = 0.005
+
+
+class TokenBucket:
+
+    def __init__(self, name, capacity, per_minute):
+        self.name = name
+        self.capacity = capacity
+        self.rate = per_minute / 60
+
+    def _key(self, key):
+        return f'throttle:{self.name}:{key}'
+
+    def take(self, key=''):
+        """
+        Take a token from the bucket of `key` (e.g. a tenant id). Returns 0 if there was
+        one, or the number of seconds until there will be.
+        """
+        state_key = self._key(key)
+        lock_key = f'{state_key}:lock'
+        for _ in range(LOCK_ATTEMPTS):
+            if cache.add(lock_key, 1, LOCK_TIMEOUT):
+                break
+            time.sleep(LOCK_WAIT)
+        else:
+            metrics.record_rate_limit(self.name, 'contended')
+            return 1.0
+        try:
+            now = time.time()
+            tokens, updated = cache.get(state_key) or (self.capacity, now)
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            if not wait:
+                tokens -= 1
+            # A full bucket is the same as no state at all, so it can expire once refilled
+            cache.set(state_key, (tokens, now), int((self.capacity - tokens) / self.rate) + 1)
+        finally:
+            cache.delete(lock_key)
+        metrics.record_rate_limit(self.name, 'limited' if wait else 'allowed')
+        return wait
+
+    def reset(self, key=''):
+        cache.delete(self._key(key))
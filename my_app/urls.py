@@ -1,5 +1,5 @@
 from django.urls import path
-from . import views
+from . import api, metrics, views
 
 urlpatterns = [
     path('', views.login_view, name='login'),
@@ -12,20 +12,30 @@ urlpatterns = [
     path('tenant-dashboard/', views.tenant_dashboard, name='tenant_dashboard'),
     path('tenant-dashboard/<int:pk>/', views.tenant_dashboard, name='tenant_dashboard_detail'),
     
+    path('vacancies/', views.vacancy_search, name='vacancy_search'),
+    
     path('properties/', views.property_list, name='property_list'),
     path('properties/create/', views.property_create, name='property_create'),
     path('properties/<int:pk>/', views.property_detail, name='property_detail'),
     path('properties/<int:pk>/edit/', views.property_update, name='property_update'),
     path('properties/<int:pk>/delete/', views.property_delete, name='property_delete'),
+    path('properties/<int:pk>/photos/', views.property_photo_upload, name='property_photo_upload'),
     
     path('units/', views.unit_list, name='unit_list'),
     path('units/create/', views.unit_create, name='unit_create'),
+    path('units/bulk/', views.unit_bulk_action, name='unit_bulk_action'),
+    path('units/rent-adjustment/', views.rent_adjustment, name='rent_adjustment'),
     path('units/<int:pk>/', views.unit_detail, name='unit_detail'),
     path('units/<int:pk>/edit/', views.unit_update, name='unit_update'),
     path('units/<int:pk>/delete/', views.unit_delete, name='unit_delete'),
+    path('units/<int:pk>/photos/', views.unit_photo_upload, name='unit_photo_upload'),
+    
+    path('photos/<int:pk>/delete/', views.photo_delete, name='photo_delete'),
+    path('media/photos/r/<path:name>', views.photo_rendition, name='photo_rendition'),
     
     path('tenants/', views.tenant_list, name='tenant_list'),
     path('tenants/create/', views.tenant_create, name='tenant_create'),
+    path('tenants/bulk/', views.tenant_bulk_action, name='tenant_bulk_action'),
     path('tenants/<int:pk>/', views.tenant_detail, name='tenant_detail'),
     path('tenants/<int:pk>/edit/', views.tenant_update, name='tenant_update'),
     path('tenants/<int:pk>/delete/', views.tenant_delete, name='tenant_delete'),
@@ -42,4 +52,12 @@ urlpatterns = [
     path('mpesa/payment/<int:tenant_id>/', views.mpesa_payment, name='mpesa_payment'),
     path('mpesa/stk-push/', views.mpesa_stk_push, name='mpesa_stk_push'),
     path('mpesa/callback/', views.mpesa_callback, name='mpesa_callback'),
+    path('mpesa/status/<str:checkout_request_id>/', views.mpesa_payment_status, name='mpesa_payment_status'),
+    
+    path('metrics', metrics.metrics_view, name='metrics'),
+    path('profiles/<str:profile_id>.<str:kind>', views.profile_download, name='profile_download'),
+    
+    path('api/v1/payments/batch/', api.payment_batch, name='api_payment_batch'),
+    path('api/v1/<str:resource>/', api.resource_list, name='api_resource_list'),
+    path('api/v1/<str:resource>/<int:pk>/', api.resource_detail, name='api_resource_detail'),
 ]
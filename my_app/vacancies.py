@@ -0,0 +1,168 @@
+"""
+Public search of available units.
+
+Only units and their properties are read, never tenants or payments. The facet counts
+(how many vacancies each city, property type, unit type and bedroom count would leave)
+come from one GROUP BY over all four at once. Each facet's counts apply every selected
+filter but its own, so the other choices stay visible. The grouped rows are cached per
+rent range under the data version of units and properties, so they are recomputed only
+after a change. Results are paginated by keyset, (rent, id) after the last unit shown,
+so a deep page costs the same index range scan as the first.
+"""
+from collections import Counter
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Prefetch, Q
+
+from .caching import data_version
+from .fields import MAX_AMOUNT, from_cents, to_cents
+from .metrics import record_cache
+from .models import Photo, Property, Unit
+
+# Filter parameter: unit field
+FACETS = {
+    'city': 'property__city',
+    'property_type': 'property__property_type',
+    'unit_type': 'unit_type',
+    'bedrooms': 'bedrooms',
+}
+FACET_LABELS = {
+    'property_type': dict(Property.PROPERTY_TYPES),
+    'unit_type': dict(Unit.UNIT_TYPES),
+}
+# ?sort=: keyset ordering
+SORTS = {
+    'rent': ('rent_amount', 'id'),
+    '-rent': ('-rent_amount', '-id'),
+}
+# Fields a public page may show
+PUBLIC_FIELDS = [
+    'unit_number', 'unit_type', 'floor', 'bedrooms', 'bathrooms', 'rent_amount', 'deposit_amount',
+    'property__name', 'property__city', 'property__county', 'property__property_type',
+]
+
+
+def vacancies():
+    return Unit.objects.filter(status='available', property__status='active', property__deleted_at__isnull=True)
+
+
+def _money(value):
+    try:
+        amount = Decimal(value)
+    except (InvalidOperation, TypeError, ValueError):
+        return None
+    # Beyond what MoneyField stores, the filter itself would fail
+    return to_cents(amount) if amount.is_finite() and 0 <= amount <= MAX_AMOUNT else None
+
+
+def parse_params(params):
+    """The search in query parameters `params`, with invalid values dropped."""
+    selected = {name: params.get(name, '').strip() for name in FACETS}
+    try:
+        selected['bedrooms'] = int(selected['bedrooms'])
+    except ValueError:
+        selected['bedrooms'] = ''
+    return {
+        'selected': {name: value for name, value in selected.items() if value != ''},
+        'min_rent': _money(params.get('min_rent')),
+        'max_rent': _money(params.get('max_rent')),
+        'sort': params.get('sort') if params.get('sort') in SORTS else 'rent',
+        'after': _cursor(params.get('after', '')),
+    }
+
+
+def _cursor(value):
+    try:
+        rent, pk = value.split('.')
+        rent, pk = int(rent), int(pk)
+    except ValueError:
+        return None
+    if not (0 <= rent <= to_cents(MAX_AMOUNT) and 0 <= pk < 2 ** 63):
+        return None
+    return rent, pk
+
+
+def _rent_filter(search):
+    condition = Q()
+    if search['min_rent'] is not None:
+        condition &= Q(rent_amount__gte=from_cents(search['min_rent']))
+    if search['max_rent'] is not None:
+        condition &= Q(rent_amount__lte=from_cents(search['max_rent']))
+    return condition
+
+
+def facet_groups(search):
+    """[(city, property type, unit type, bedrooms, count), ...] of the vacancies in the rent range."""
+    version = data_version(Unit, Property).timestamp()
+    key = f"vacancies:facets:{version}:{search['min_rent']}:{search['max_rent']}"
+    groups = cache.get(key)
+    record_cache('vacancy_facets', groups is not None)
+    if groups is None:
+        groups = list(
+            vacancies().filter(_rent_filter(search)).order_by()
+            .values_list(*FACETS.values()).annotate(count=Count('pk'))
+        )
+        cache.set(key, groups, settings.VACANCY_FACET_CACHE_TIMEOUT)
+    return groups
+
+
+def facets(search):
+    """
+    ({facet: [{'value', 'label', 'count', 'selected'}, ...]}, number of matching units)
+    for the search.
+    """
+    selected = search['selected']
+    names = list(FACETS)
+    counts = {name: Counter() for name in names}
+    total = 0
+    for *values, count in facet_groups(search):
+        row = dict(zip(names, values))
+        misses = [name for name in selected if row[name] != selected[name]]
+        if not misses:
+            total += count
+        for name in names:
+            # Counted under its own facet when every other selected filter matches
+            if not misses or misses == [name]:
+                counts[name][row[name]] += count
+    result = {}
+    for name in names:
+        if name in selected:
+            # Still offered, to be unselected, when nothing matches
+            counts[name][selected[name]] += 0
+        labels = FACET_LABELS.get(name, {})
+        order = list(labels)
+        result[name] = [
+            {'value': value, 'label': labels.get(value, value), 'count': count, 'selected': selected.get(name) == value}
+            for value, count in sorted(counts[name].items(),
+                                       key=lambda item: (order.index(item[0]) if item[0] in order else len(order), item[0]))
+        ]
+    return result, total
+
+
+def search_page(search):
+    """(units, cursor of the next page or None) for the search."""
+    units = vacancies().filter(_rent_filter(search), **{FACETS[name]: value for name, value in search['selected'].items()})
+    ordering = SORTS[search['sort']]
+    if search['after']:
+        rent, pk = from_cents(search['after'][0]), search['after'][1]
+        # The >= on rent alone lets the index seek straight to the cursor
+        if search['sort'] == 'rent':
+            units = units.filter(Q(rent_amount__gte=rent) & (Q(rent_amount__gt=rent) | Q(pk__gt=pk)))
+        else:
+            units = units.filter(Q(rent_amount__lte=rent) & (Q(rent_amount__lt=rent) | Q(pk__lt=pk)))
+    covers = Photo.objects.filter(status='ready')[:1]
+    units = list(
+        units.select_related('property').only(*PUBLIC_FIELDS).order_by(*ordering)
+        .prefetch_related(Prefetch('photos', queryset=covers, to_attr='cover_photos'),
+                          Prefetch('property__photos', queryset=covers, to_attr='cover_photos'))
+        [:settings.VACANCY_PAGE_SIZE + 1]
+    )
+    for unit in units:
+        # Its own photo, or else one of its property
+        unit.cover = (unit.cover_photos or unit.property.cover_photos or [None])[0]
+    if len(units) <= settings.VACANCY_PAGE_SIZE:
+        return units, None
+    units = units[:settings.VACANCY_PAGE_SIZE]
+    return units, f'{to_cents(units[-1].rent_amount)}.{units[-1].pk}'
@@ -2,15 +2,42 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Count, Sum
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Q, Count, Sum, Max, Prefetch
+from django.urls import reverse
 from django.utils import timezone
-from datetime import timedelta
+from django.utils.http import url_has_allowed_host_and_scheme
+from datetime import datetime, time, timedelta
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, JsonResponse
+from django.views.decorators.cache import cache_control
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_POST
+from django_daraja.mpesa.exceptions import MpesaConnectionError
+import hashlib
 import json
-from .models import Property, Unit, Tenant, Payment
-from .forms import PropertyForm, UnitForm, TenantForm, PaymentForm
+import logging
+import math
+from . import deletion, lifecycle, mpesa, photos, profiling, rent, vacancies
+from .archive import archive_boundary, archived_totals, merge_payments, merge_totals, reaches_archive
+from .caching import cache_is_shared, data_version
+from .metrics import record_cache
+from .forecasting import get_forecast
+from .filters import filter_properties, filter_units, filter_tenants, filter_payments, date_param
+from .models import (
+    Property, Unit, Tenant, Payment, PaymentArchive, PaymentRollup, OccupancySnapshot, RentAdjustment, Photo,
+    managed_property_ids, scope_key,
+)
+from .occupancy import occupancy_trends
+from .forms import (
+    PropertyForm, UnitForm, TenantForm, PaymentForm, TenantBulkActionForm, UnitBulkActionForm, RentAdjustmentForm,
+    PhotoUploadForm,
+)
+
+logger = logging.getLogger(__name__)
 
 
 def login_view(request):
@@ -44,11 +71,11 @@ def redirect_user_dashboard(user):
     if user.is_staff or user.is_superuser:
         return redirect('manager_dashboard')
     
-    try:
-        tenant = Tenant.objects.get(user=user)
+    # tenant_profile comes preloaded with users served by CachedModelBackend
+    tenant = getattr(user, 'tenant_profile', None)
+    if tenant:
         return redirect('tenant_dashboard_detail', pk=tenant.pk)
-    except Tenant.DoesNotExist:
-        return redirect('access_denied')
+    return redirect('access_denied')
 
 
 def access_denied(request):
@@ -66,29 +93,41 @@ def staff_required(view_func):
     return wrapper
 
 
+@cache_control(public=True, max_age=settings.VACANCY_MAX_AGE)
+def vacancy_search(request):
+    # Public: reads units and properties only, and leaves the session alone so shared
+    # caches may keep the page
+    search = vacancies.parse_params(request.GET)
+    facets, total = vacancies.facets(search)
+    units, next_cursor = vacancies.search_page(search)
+    
+    context = {
+        'units': units,
+        'facets': facets,
+        'total': total,
+        'next_cursor': next_cursor,
+        'min_rent': request.GET.get('min_rent', '') if search['min_rent'] is not None else '',
+        'max_rent': request.GET.get('max_rent', '') if search['max_rent'] is not None else '',
+        'sort': search['sort'],
+        'is_first_page': search['after'] is None,
+    }
+    return render(request, 'vacancies/search.html', context)
+
+
 @staff_required
 def property_list(request):
-    properties = Property.objects.all()
+    # Only the cover photo of each property, never the whole gallery
+    cover = Prefetch('photos', queryset=Photo.objects.filter(status='ready')[:1], to_attr='cover_photos')
+    managed = Property.objects.for_user(request.user)
+    properties = filter_properties(managed.prefetch_related(cover), request.GET)
     
     search_query = request.GET.get('search', '')
-    if search_query:
-        properties = properties.filter(
-            Q(name__icontains=search_query) |
-            Q(address__icontains=search_query) |
-            Q(city__icontains=search_query)
-        )
-    
     status_filter = request.GET.get('status', '')
-    if status_filter:
-        properties = properties.filter(status=status_filter)
-    
     type_filter = request.GET.get('type', '')
-    if type_filter:
-        properties = properties.filter(property_type=type_filter)
     
-    total_properties = Property.objects.count()
-    total_units = Property.objects.aggregate(total=Sum('total_units'))['total'] or 0
-    active_properties = Property.objects.filter(status='active').count()
+    total_properties = managed.count()
+    total_units = managed.aggregate(total=Sum('total_units'))['total'] or 0
+    active_properties = managed.filter(status='active').count()
     
     context = {
         'properties': properties,
@@ -98,7 +137,7 @@ def property_list(request):
         'total_properties': total_properties,
         'total_units': total_units,
         'active_properties': active_properties,
-        'form': PropertyForm(),
+        'form': PropertyForm(user=request.user),
     }
     return render(request, 'properties/properties.html', context)
 
@@ -106,7 +145,7 @@ def property_list(request):
 @staff_required
 def property_create(request):
     if request.method == 'POST':
-        form = PropertyForm(request.POST)
+        form = PropertyForm(request.POST, user=request.user)
         if form.is_valid():
             prop = form.save()
             messages.success(request, f'Added {prop.name}')
@@ -114,7 +153,7 @@ def property_create(request):
         else:
             messages.error(request, 'Check the form for errors.')
     else:
-        form = PropertyForm()
+        form = PropertyForm(initial={'manager': request.user.pk}, user=request.user)
     
     context = {'form': form}
     return render(request, 'properties/property_form.html', context)
@@ -122,17 +161,87 @@ def property_create(request):
 
 @staff_required
 def property_detail(request, pk):
-    property_obj = get_object_or_404(Property, pk=pk)
-    context = {'property': property_obj}
+    property_obj = get_object_or_404(Property.objects.for_user(request.user), pk=pk)
+    context = {'property': property_obj, **_gallery(property_obj, 'property_photo_upload')}
     return render(request, 'properties/property_detail.html', context)
 
 
+def _gallery(owner, upload_view):
+    """Template context for the photo gallery of a property or unit."""
+    owner_photos = list(owner.photos.all())
+    return {
+        'photos': [photo for photo in owner_photos if photo.status == 'ready'],
+        'photos_failed': [photo for photo in owner_photos if photo.status == 'failed'],
+        'photos_processing': sum(photo.status in ('pending', 'processing') for photo in owner_photos),
+        'photo_form': PhotoUploadForm(),
+        'photo_upload_url': reverse(upload_view, args=[owner.pk]),
+    }
+
+
+def _upload_photos(request, detail_view, owner_pk, **owner):
+    form = PhotoUploadForm(request.POST, request.FILES)
+    if not form.is_valid():
+        messages.error(request, ' '.join(e for errors in form.errors.values() for e in errors))
+        return redirect(detail_view, pk=owner_pk)
+    
+    # Only the originals are stored here; the renditions are made in the background
+    with transaction.atomic():
+        last = Photo.objects.filter(**owner).aggregate(last=Max('position'))['last']
+        start = 0 if last is None else last + 1
+        uploaded = [
+            Photo.objects.create(image=image, caption=form.cleaned_data['caption'], position=start + i, **owner)
+            for i, image in enumerate(form.cleaned_data['images'])
+        ]
+        photos.enqueue(photo.pk for photo in uploaded)
+    messages.success(request, f'{len(uploaded)} photo(s) uploaded. They will show here once resized.')
+    return redirect(detail_view, pk=owner_pk)
+
+
+@staff_required
+@require_POST
+def property_photo_upload(request, pk):
+    property_obj = get_object_or_404(Property.objects.for_user(request.user), pk=pk)
+    return _upload_photos(request, 'property_detail', pk, property=property_obj)
+
+
+@staff_required
+@require_POST
+def unit_photo_upload(request, pk):
+    unit = get_object_or_404(Unit.objects.for_user(request.user), pk=pk)
+    return _upload_photos(request, 'unit_detail', pk, unit=unit)
+
+
+@staff_required
+@require_POST
+def photo_delete(request, pk):
+    photo = get_object_or_404(Photo.objects.for_user(request.user), pk=pk)
+    # The files go once the row is gone (signals.discard_photo_files)
+    photo.delete()
+    messages.success(request, 'Photo deleted')
+    if photo.unit_id:
+        return redirect('unit_detail', pk=photo.unit_id)
+    return redirect('property_detail', pk=photo.property_id)
+
+
+@cache_control(public=True, max_age=365 * 24 * 60 * 60, immutable=True)
+def photo_rendition(request, name):
+    # Renditions are named after their content, so a name always stands for the same bytes.
+    # Originals are never served.
+    if not photos.RENDITION_NAME.fullmatch(name):
+        raise Http404('Photo not found')
+    try:
+        image = default_storage.open(f'{photos.RENDITION_DIR}/{name}', 'rb')
+    except FileNotFoundError:
+        raise Http404('Photo not found')
+    return FileResponse(image, content_type='image/webp' if name.endswith('.webp') else 'image/jpeg')
+
+
 @staff_required
 def property_update(request, pk):
-    property_obj = get_object_or_404(Property, pk=pk)
+    property_obj = get_object_or_404(Property.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
-        form = PropertyForm(request.POST, instance=property_obj)
+        form = PropertyForm(request.POST, instance=property_obj, user=request.user)
         if form.is_valid():
             form.save()
             messages.success(request, f'Updated {property_obj.name}')
@@ -140,7 +249,7 @@ def property_update(request, pk):
         else:
             messages.error(request, 'Fix the errors and try again.')
     else:
-        form = PropertyForm(instance=property_obj)
+        form = PropertyForm(instance=property_obj, user=request.user)
     
     context = {
         'form': form,
@@ -152,48 +261,40 @@ def property_update(request, pk):
 
 @staff_required
 def property_delete(request, pk):
-    property_obj = get_object_or_404(Property, pk=pk)
+    property_obj = get_object_or_404(Property.objects.for_user(request.user), pk=pk)
+    active_tenants = Tenant.objects.filter(unit__property=property_obj, status='active').count()
     
-    if request.method == 'POST':
-        pname = property_obj.name
-        property_obj.delete()
-        messages.success(request, f'{pname} deleted')
+    # Tenants must be moved out first; the page says so instead of offering the delete
+    if request.method == 'POST' and not active_tenants:
+        deletion.soft_delete_properties(Property.objects.filter(pk=pk))
+        messages.success(request, f'{property_obj.name} deleted')
         return redirect('property_list')
     
-    context = {'property': property_obj}
+    context = {
+        'property': property_obj,
+        'active_tenants': active_tenants,
+        'purge_after_days': settings.PROPERTY_PURGE_AFTER_DAYS,
+    }
     return render(request, 'properties/property_confirm_delete.html', context)
 
 
 @staff_required
 def unit_list(request):
-    units = Unit.objects.select_related('property').all()
+    managed = Unit.objects.for_user(request.user)
+    units = filter_units(managed.select_related('property'), request.GET)
     
     search_query = request.GET.get('search', '')
-    if search_query:
-        units = units.filter(
-            Q(unit_number__icontains=search_query) |
-            Q(property__name__icontains=search_query)
-        )
-    
     property_filter = request.GET.get('property', '')
-    if property_filter:
-        units = units.filter(property_id=property_filter)
-    
     status_filter = request.GET.get('status', '')
-    if status_filter:
-        units = units.filter(status=status_filter)
-    
     type_filter = request.GET.get('type', '')
-    if type_filter:
-        units = units.filter(unit_type=type_filter)
     
-    total_units = Unit.objects.count()
-    occupied_units = Unit.objects.filter(is_occupied=True).count()
-    available_units = Unit.objects.filter(status='available').count()
+    total_units = managed.count()
+    occupied_units = managed.filter(is_occupied=True).count()
+    available_units = managed.filter(status='available').count()
     
     context = {
         'units': units,
-        'properties': Property.objects.all(),
+        'properties': Property.objects.for_user(request.user),
         'search_query': search_query,
         'property_filter': property_filter,
         'status_filter': status_filter,
@@ -201,15 +302,71 @@ def unit_list(request):
         'total_units': total_units,
         'occupied_units': occupied_units,
         'available_units': available_units,
-        'form': UnitForm(),
+        'form': UnitForm(user=request.user),
     }
     return render(request, 'units/units.html', context)
 
 
+def _redirect_back(request, default):
+    next_url = request.POST.get('next', '')
+    if url_has_allowed_host_and_scheme(next_url, allowed_hosts={request.get_host()}):
+        return redirect(next_url)
+    return redirect(default)
+
+
+@staff_required
+@require_POST
+def unit_bulk_action(request):
+    form = UnitBulkActionForm(request.POST)
+    if not form.is_valid():
+        messages.error(request, ' '.join(e for errors in form.errors.values() for e in errors))
+        return _redirect_back(request, 'unit_list')
+    
+    status = form.cleaned_data['status']
+    units = Unit.objects.for_user(request.user).filter(pk__in=form.cleaned_data['ids'])
+    changed, skipped = lifecycle.set_unit_status(units, status)
+    label = dict(Unit.STATUS_CHOICES)[status]
+    messages.success(request, f'{changed} unit(s) set to {label}')
+    if skipped:
+        messages.warning(request, f'{skipped} unit(s) with an active tenant were left unchanged')
+    return _redirect_back(request, 'unit_list')
+
+
+@staff_required
+def rent_adjustment(request):
+    preview = None
+    if request.method == 'POST':
+        form = RentAdjustmentForm(request.POST, user=request.user)
+        if form.is_valid():
+            adjustment = form.save(commit=False)
+            if 'apply' in request.POST:
+                adjustment.created_by = request.user
+                rent.apply_adjustment(adjustment)
+                if adjustment.applied_at:
+                    messages.success(request, f'Rent adjustment {adjustment} applied to '
+                                              f'{adjustment.leases_changed} lease(s) and {adjustment.units_changed} unit(s)')
+                else:
+                    messages.success(request, f'Rent adjustment {adjustment} scheduled; the rents change on '
+                                              f'{adjustment.effective_from:%b %d, %Y}')
+                return redirect('rent_adjustment')
+            preview = rent.preview(adjustment)
+            preview['leases_change'] = preview['leases_after'] - preview['leases_before']
+            preview['units_change'] = preview['units_after'] - preview['units_before']
+    else:
+        form = RentAdjustmentForm(initial={'effective_from': timezone.localdate()}, user=request.user)
+    
+    context = {
+        'form': form,
+        'preview': preview,
+        'adjustments': RentAdjustment.objects.for_user(request.user).select_related('property', 'created_by')[:10],
+    }
+    return render(request, 'units/rent_adjustment.html', context)
+
+
 @staff_required
 def unit_create(request):
     if request.method == 'POST':
-        form = UnitForm(request.POST)
+        form = UnitForm(request.POST, user=request.user)
         if form.is_valid():
             u = form.save()
             messages.success(request, f'Unit {u.unit_number} added')
@@ -217,25 +374,25 @@ def unit_create(request):
         else:
             messages.error(request, 'Something went wrong. Check the form.')
     else:
-        form = UnitForm()
+        form = UnitForm(user=request.user)
     
     return render(request, 'units/unit_form.html', {'form': form})
 
 
 @staff_required
 def unit_detail(request, pk):
-    unit = get_object_or_404(Unit, pk=pk)
-    form = UnitForm(instance=unit)
-    context = {'unit': unit, 'form': form, 'is_detail': True}
+    unit = get_object_or_404(Unit.objects.for_user(request.user), pk=pk)
+    form = UnitForm(instance=unit, user=request.user)
+    context = {'unit': unit, 'form': form, 'is_detail': True, **_gallery(unit, 'unit_photo_upload')}
     return render(request, 'units/unit_form.html', context)
 
 
 @staff_required
 def unit_update(request, pk):
-    unit = get_object_or_404(Unit, pk=pk)
+    unit = get_object_or_404(Unit.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
-        form = UnitForm(request.POST, instance=unit)
+        form = UnitForm(request.POST, instance=unit, user=request.user)
         if form.is_valid():
             form.save()
             messages.success(request, f'Unit {unit.unit_number} updated')
@@ -243,7 +400,7 @@ def unit_update(request, pk):
         else:
             messages.error(request, 'Fix errors below')
     else:
-        form = UnitForm(instance=unit)
+        form = UnitForm(instance=unit, user=request.user)
     
     ctx = {'form': form, 'unit': unit, 'is_edit': True}
     return render(request, 'units/unit_form.html', ctx)
@@ -251,7 +408,7 @@ def unit_update(request, pk):
 
 @staff_required
 def unit_delete(request, pk):
-    unit = get_object_or_404(Unit, pk=pk)
+    unit = get_object_or_404(Unit.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
         num = unit.unit_number
@@ -264,43 +421,55 @@ def unit_delete(request, pk):
 
 @staff_required
 def tenant_list(request):
-    tenants = Tenant.objects.select_related('unit', 'unit__property').all()
+    managed = Tenant.objects.for_user(request.user)
+    tenants = filter_tenants(managed.select_related('unit', 'unit__property'), request.GET)
     
     search_query = request.GET.get('search', '')
-    if search_query:
-        tenants = tenants.filter(
-            Q(first_name__icontains=search_query) |
-            Q(last_name__icontains=search_query) |
-            Q(email__icontains=search_query) |
-            Q(phone__icontains=search_query)
-        )
-    
     status_filter = request.GET.get('status', '')
-    if status_filter:
-        tenants = tenants.filter(status=status_filter)
-    
     property_filter = request.GET.get('property', '')
-    if property_filter:
-        tenants = tenants.filter(unit__property_id=property_filter)
     
-    total_tenants = Tenant.objects.count()
-    active_tenants = Tenant.objects.filter(status='active').count()
-    pending_tenants = Tenant.objects.filter(status='pending').count()
+    total_tenants = managed.count()
+    active_tenants = managed.filter(status='active').count()
+    pending_tenants = managed.filter(status='pending').count()
     
     context = {
         'tenants': tenants,
-        'properties': Property.objects.all(),
+        'properties': Property.objects.for_user(request.user),
         'search_query': search_query,
         'status_filter': status_filter,
         'property_filter': property_filter,
         'total_tenants': total_tenants,
         'active_tenants': active_tenants,
         'pending_tenants': pending_tenants,
-        'form': TenantForm(),
+        'form': TenantForm(user=request.user),
     }
     return render(request, 'tenants.html', context)
 
 
+@staff_required
+@require_POST
+def tenant_bulk_action(request):
+    form = TenantBulkActionForm(request.POST, user=request.user)
+    if not form.is_valid():
+        messages.error(request, ' '.join(e for errors in form.errors.values() for e in errors))
+        return _redirect_back(request, 'tenant_list')
+    
+    data = form.cleaned_data
+    tenants = Tenant.objects.for_user(request.user).filter(pk__in=data['ids'])
+    if data['action'] == 'move_out':
+        moved, freed = lifecycle.move_out(tenants, data['date'])
+        messages.success(request, f'{moved} tenant(s) moved out, {freed} unit(s) now available')
+    elif data['action'] == 'renew':
+        renewed = lifecycle.renew_leases(tenants, data['date'], data['rent_amount'])
+        messages.success(request, f'{renewed} lease(s) renewed until {data["date"]:%b %d, %Y}')
+    else:
+        assigned, left = lifecycle.assign_to_vacant_units(tenants, data['property'])
+        messages.success(request, f'{assigned} tenant(s) assigned to units in {data["property"].name}')
+        if left:
+            messages.warning(request, f'{left} tenant(s) not assigned: not enough vacant units')
+    return _redirect_back(request, 'tenant_list')
+
+
 @staff_required
 def tenant_create(request):
     if request.method == 'POST':
@@ -314,7 +483,7 @@ def tenant_create(request):
         if user_selection == 'create_new':
             post_data['user'] = ''  # Clear the invalid value
         
-        form = TenantForm(post_data)
+        form = TenantForm(post_data, user=request.user)
         
         new_user = None
         if user_selection == 'create_new':
@@ -377,7 +546,7 @@ def tenant_create(request):
                 new_user.delete()
             messages.error(request, 'Please correct the errors below.')
     else:
-        form = TenantForm()
+        form = TenantForm(user=request.user)
     
     context = {'form': form}
     return render(request, 'tenants/tenant_form.html', context)
@@ -385,15 +554,15 @@ def tenant_create(request):
 
 @staff_required
 def tenant_detail(request, pk):
-    tenant = get_object_or_404(Tenant, pk=pk)
-    form = TenantForm(instance=tenant)
+    tenant = get_object_or_404(Tenant.objects.for_user(request.user), pk=pk)
+    form = TenantForm(instance=tenant, user=request.user)
     context = {'tenant': tenant, 'form': form, 'is_detail': True}
     return render(request, 'tenants/tenant_form.html', context)
 
 
 @staff_required
 def tenant_update(request, pk):
-    tenant = get_object_or_404(Tenant, pk=pk)
+    tenant = get_object_or_404(Tenant.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
         post_data = request.POST.copy()
@@ -406,7 +575,7 @@ def tenant_update(request, pk):
         if user_selection == 'create_new':
             post_data['user'] = ''
         
-        form = TenantForm(post_data, instance=tenant)
+        form = TenantForm(post_data, instance=tenant, user=request.user)
         
         new_user = None
         if user_selection == 'create_new':
@@ -473,7 +642,7 @@ def tenant_update(request, pk):
                 new_user.delete()
             messages.error(request, 'Please correct the errors below.')
     else:
-        form = TenantForm(instance=tenant)
+        form = TenantForm(instance=tenant, user=request.user)
     
     context = {
         'form': form,
@@ -485,7 +654,7 @@ def tenant_update(request, pk):
 
 @staff_required
 def tenant_delete(request, pk):
-    tenant = get_object_or_404(Tenant, pk=pk)
+    tenant = get_object_or_404(Tenant.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
         name = tenant.full_name
@@ -501,48 +670,46 @@ def tenant_delete(request, pk):
 
 @staff_required
 def payment_list(request):
-    payments = Payment.objects.select_related('tenant', 'tenant__unit', 'tenant__unit__property').all()
+    related = ('tenant', 'tenant__unit', 'tenant__unit__property')
+    property_ids = managed_property_ids(request.user)
+    managed = Payment.objects.in_scope(property_ids)
+    payments = filter_payments(managed.select_related(*related), request.GET)
+    
+    date_from = date_param(request.GET, 'from')
+    date_to = date_param(request.GET, 'to')
+    # Old completed payments live in the archive; only read it when the dates reach them
+    if reaches_archive(date_from, date_to):
+        archived = filter_payments(PaymentArchive.objects.in_scope(property_ids).select_related(*related), request.GET)
+        payments = merge_payments(payments, archived)
     
     search_query = request.GET.get('search', '')
-    if search_query:
-        payments = payments.filter(
-            Q(tenant__first_name__icontains=search_query) |
-            Q(tenant__last_name__icontains=search_query) |
-            Q(reference_number__icontains=search_query)
-        )
-    
     tenant_filter = request.GET.get('tenant', '')
-    if tenant_filter:
-        payments = payments.filter(tenant_id=tenant_filter)
-    
     type_filter = request.GET.get('type', '')
-    if type_filter:
-        payments = payments.filter(payment_type=type_filter)
-    
     method_filter = request.GET.get('method', '')
-    if method_filter:
-        payments = payments.filter(payment_method=method_filter)
-    
     status_filter = request.GET.get('status', '')
-    if status_filter:
-        payments = payments.filter(status=status_filter)
     
-    total_payments = Payment.objects.count()
-    total_collected = Payment.objects.filter(status='completed').aggregate(total=Sum('amount'))['total'] or 0
-    pending_payments = Payment.objects.filter(status='pending').count()
+    archived_all = archived_totals(property_ids)
+    total_payments = managed.count() + archived_all['count']
+    total_collected = (
+        managed.filter(status='completed').aggregate(total=Sum('amount'))['total'] or 0
+    ) + archived_all['total']
+    pending_payments = managed.filter(status='pending').count()
     
     context = {
         'payments': payments,
-        'tenants': Tenant.objects.filter(status='active'),
+        'tenants': Tenant.objects.in_scope(property_ids).filter(status='active'),
         'search_query': search_query,
         'tenant_filter': tenant_filter,
         'type_filter': type_filter,
         'method_filter': method_filter,
         'status_filter': status_filter,
+        'date_from': date_from,
+        'date_to': date_to,
+        'archive_boundary': archive_boundary(),
         'total_payments': total_payments,
         'total_collected': total_collected,
         'pending_payments': pending_payments,
-        'form': PaymentForm(),
+        'form': PaymentForm(user=request.user),
     }
     return render(request, 'payments/payments.html', context)
 
@@ -550,39 +717,39 @@ def payment_list(request):
 @staff_required
 def payment_create(request):
     if request.method == 'POST':
-        form = PaymentForm(request.POST)
+        form = PaymentForm(request.POST, user=request.user)
         if form.is_valid():
             p = form.save()
             messages.success(request, f'Payment of KES {p.amount} recorded')
             return redirect('payment_list')
         messages.error(request, 'Check the form')
     else:
-        form = PaymentForm()
+        form = PaymentForm(user=request.user)
     
     return render(request, 'payments/payment_form.html', {'form': form})
 
 
 @staff_required
 def payment_detail(request, pk):
-    payment = get_object_or_404(Payment, pk=pk)
-    form = PaymentForm(instance=payment)
+    payment = get_object_or_404(Payment.objects.for_user(request.user), pk=pk)
+    form = PaymentForm(instance=payment, user=request.user)
     context = {'payment': payment, 'form': form, 'is_detail': True}
     return render(request, 'payments/payment_form.html', context)
 
 
 @staff_required
 def payment_update(request, pk):
-    payment = get_object_or_404(Payment, pk=pk)
+    payment = get_object_or_404(Payment.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
-        form = PaymentForm(request.POST, instance=payment)
+        form = PaymentForm(request.POST, instance=payment, user=request.user)
         if form.is_valid():
             form.save()
             messages.success(request, 'Payment updated')
             return redirect('payment_list')
         messages.error(request, 'Fix the errors')
     else:
-        form = PaymentForm(instance=payment)
+        form = PaymentForm(instance=payment, user=request.user)
     
     return render(request, 'payments/payment_form.html', {
         'form': form, 'payment': payment, 'is_edit': True
@@ -591,7 +758,7 @@ def payment_update(request, pk):
 
 @staff_required
 def payment_delete(request, pk):
-    payment = get_object_or_404(Payment, pk=pk)
+    payment = get_object_or_404(Payment.objects.for_user(request.user), pk=pk)
     
     if request.method == 'POST':
         payment.delete()
@@ -602,50 +769,61 @@ def payment_delete(request, pk):
     return render(request, 'payments/payment_confirm_delete.html', context)
 
 
+def _dashboard_figures(property_ids):
+    """The manager dashboard's counts and sums over `property_ids`, cached per scope until the data changes."""
+    today = timezone.now().date()
+    version = data_version(Property, Unit, Tenant, Payment).timestamp()
+    key = f'dashboard:{scope_key(property_ids)}:{version}:{today:%Y-%m}'
+    figures = cache.get(key)
+    record_cache('dashboard', figures is not None)
+    if figures is not None:
+        return figures
+    
+    properties = Property.objects.in_scope(property_ids)
+    units = Unit.objects.in_scope(property_ids)
+    tenants = Tenant.objects.in_scope(property_ids)
+    payments = Payment.objects.in_scope(property_ids)
+    
+    total_units = units.count()
+    occupied_units = units.filter(status='occupied').count()
+    pending = payments.filter(status='pending').aggregate(count=Count('id'), total=Sum('amount'))
+    figures = {
+        'total_properties': properties.count(),
+        'active_properties': properties.filter(status='active').count(),
+        'total_units': total_units,
+        'occupied_units': occupied_units,
+        'available_units': units.filter(status='available').count(),
+        'occupancy_rate': round((occupied_units / total_units * 100), 1) if total_units > 0 else 0,
+        'total_tenants': tenants.count(),
+        'active_tenants': tenants.filter(status='active').count(),
+        'monthly_collections': payments.filter(
+            payment_date__gte=today.replace(day=1),
+            status='completed'
+        ).aggregate(total=Sum('amount'))['total'] or 0,
+        'pending_payments': pending['count'],
+        'pending_amount': pending['total'] or 0,
+    }
+    cache.set(key, figures, settings.DASHBOARD_CACHE_TIMEOUT)
+    return figures
+
+
 @staff_required
 def manager_dashboard(request):
-    total_properties = Property.objects.count()
-    active_properties = Property.objects.filter(status='active').count()
+    property_ids = managed_property_ids(request.user)
     
-    total_units = Unit.objects.count()
-    occupied_units = Unit.objects.filter(status='occupied').count()
-    available_units = Unit.objects.filter(status='available').count()
-    occupancy_rate = round((occupied_units / total_units * 100), 1) if total_units > 0 else 0
-    
-    total_tenants = Tenant.objects.count()
-    active_tenants = Tenant.objects.filter(status='active').count()
+    recent_payments = (Payment.objects.in_scope(property_ids).select_related('tenant')
+                       .order_by('-payment_date', '-created_at')[:5])
     
-    today = timezone.now().date()
-    first_day_of_month = today.replace(day=1)
-    monthly_collections = Payment.objects.filter(
-        payment_date__gte=first_day_of_month,
-        status='completed'
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    pending_payments = Payment.objects.filter(status='pending').count()
-    pending_amount = Payment.objects.filter(status='pending').aggregate(total=Sum('amount'))['total'] or 0
-    
-    recent_payments = Payment.objects.select_related('tenant').order_by('-payment_date', '-created_at')[:5]
-    
-    properties = Property.objects.annotate(
+    properties = Property.objects.in_scope(property_ids).annotate(
         unit_count=Count('units'),
         occupied_count=Count('units', filter=Q(units__status='occupied'))
     )
     
-    recent_tenants = Tenant.objects.select_related('unit', 'unit__property').order_by('-created_at')[:5]
+    recent_tenants = (Tenant.objects.in_scope(property_ids).select_related('unit', 'unit__property')
+                      .order_by('-created_at')[:5])
     
     context = {
-        'total_properties': total_properties,
-        'active_properties': active_properties,
-        'total_units': total_units,
-        'occupied_units': occupied_units,
-        'available_units': available_units,
-        'occupancy_rate': occupancy_rate,
-        'total_tenants': total_tenants,
-        'active_tenants': active_tenants,
-        'monthly_collections': monthly_collections,
-        'pending_payments': pending_payments,
-        'pending_amount': pending_amount,
+        **_dashboard_figures(property_ids),
         'recent_payments': recent_payments,
         'properties': properties,
         'recent_tenants': recent_tenants,
@@ -653,24 +831,90 @@ def manager_dashboard(request):
     return render(request, 'dashboard/manager_dashboard.html', context)
 
 
+def _start_of_today():
+    # Pages show month-to-date figures, so they must never look older than today
+    return timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+
+
+def _etag(*parts):
+    return hashlib.md5('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def report_last_modified(request, *args, **kwargs):
+    if not cache_is_shared():
+        return None
+    return max(data_version(Property, Unit, Tenant, Payment, PaymentRollup, OccupancySnapshot), _start_of_today())
+
+
+def report_etag(request, *args, **kwargs):
+    if not cache_is_shared():
+        return None
+    return _etag(
+        request.resolver_match.url_name, request.user.pk, request.GET.urlencode(),
+        report_last_modified(request).isoformat(),
+    )
+
+
+def _tenant_dashboard_state(request, pk=None):
+    """Version of everything tenant_dashboard renders, computed once per request."""
+    if not hasattr(request, '_tenant_dashboard_state'):
+        state = None
+        if not cache_is_shared():
+            tenant_id = None
+        elif hasattr(request.user, 'tenant_profile'):
+            tenant_id = request.user.tenant_profile.pk
+        elif pk and (request.user.is_staff or request.user.is_superuser):
+            tenant_id = pk
+        else:
+            tenant_id = None
+        
+        if tenant_id:
+            payments = Payment.objects.filter(tenant_id=tenant_id).aggregate(
+                latest=Max('updated_at'), count=Count('id')
+            )
+            last_modified = max(
+                payments['latest'] or _start_of_today(),
+                data_version(Property, Unit, Tenant, PaymentRollup),
+                _start_of_today(),
+            )
+            state = (tenant_id, payments['count'], last_modified)
+        request._tenant_dashboard_state = state
+    return request._tenant_dashboard_state
+
+
+def tenant_dashboard_last_modified(request, pk=None):
+    state = _tenant_dashboard_state(request, pk)
+    return state[2] if state else None
+
+
+def tenant_dashboard_etag(request, pk=None):
+    state = _tenant_dashboard_state(request, pk)
+    if not state:
+        return None
+    tenant_id, payment_count, last_modified = state
+    return _etag('tenant_dashboard', request.user.pk, tenant_id, payment_count, last_modified.isoformat())
+
+
 @login_required(login_url='login')
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=tenant_dashboard_etag, last_modified_func=tenant_dashboard_last_modified)
 def tenant_dashboard(request, pk=None):
     tenant = None
     
     if hasattr(request.user, 'tenant_profile'):
         tenant = request.user.tenant_profile
     elif pk and (request.user.is_staff or request.user.is_superuser):
-        tenant = get_object_or_404(Tenant, pk=pk)
+        tenant = get_object_or_404(Tenant.objects.for_user(request.user), pk=pk)
     else:
         messages.warning(request, 'No tenant profile linked to your account. Please contact the administrator.')
         return redirect('login')
     
     payments = Payment.objects.filter(tenant=tenant).order_by('-payment_date')[:10]
     
-    total_paid = Payment.objects.filter(
+    total_paid = (Payment.objects.filter(
         tenant=tenant, 
         status='completed'
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    ).aggregate(total=Sum('amount'))['total'] or 0) + archived_totals(tenant=tenant)['total']
     
     pending_amount = Payment.objects.filter(
         tenant=tenant, 
@@ -715,29 +959,34 @@ def tenant_dashboard(request, pk=None):
 
 
 @staff_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=report_etag, last_modified_func=report_last_modified)
 def financial_report(request):
     from django.db.models.functions import TruncMonth
     from datetime import datetime, timedelta
     
     year = request.GET.get('year', timezone.now().year)
+    property_ids = managed_property_ids(request.user)
+    payments = Payment.objects.in_scope(property_ids)
+    rollups = PaymentRollup.objects.in_scope(property_ids)
     
-    total_revenue = Payment.objects.filter(
+    total_revenue = (payments.filter(
         status='completed'
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    ).aggregate(total=Sum('amount'))['total'] or 0) + archived_totals(property_ids)['total']
     
     current_month = timezone.now().month
     current_year = timezone.now().year
-    monthly_revenue = Payment.objects.filter(
+    monthly_revenue = payments.filter(
         status='completed',
         payment_date__month=current_month,
         payment_date__year=current_year
     ).aggregate(total=Sum('amount'))['total'] or 0
     
-    pending_payments = Payment.objects.filter(
+    pending_payments = payments.filter(
         status='pending'
     ).aggregate(total=Sum('amount'))['total'] or 0
     
-    monthly_data = Payment.objects.filter(
+    monthly_data = payments.filter(
         status='completed',
         payment_date__year=current_year
     ).annotate(
@@ -745,27 +994,39 @@ def financial_report(request):
     ).values('month').annotate(
         total=Sum('amount')
     ).order_by('month')
+    if reaches_archive(datetime(current_year, 1, 1).date(), datetime(current_year, 12, 31).date()):
+        archived_months = PaymentArchive.objects.in_scope(property_ids).filter(
+            status='completed',
+            payment_date__year=current_year
+        ).annotate(
+            month=TruncMonth('payment_date')
+        ).values('month').annotate(
+            total=Sum('amount')
+        ).order_by()
+        monthly_data = sorted(merge_totals(monthly_data, archived_months, 'month'), key=lambda row: row['month'])
+    
+    payment_by_type = merge_totals(
+        payments.filter(status='completed').values('payment_type').annotate(total=Sum('amount')).order_by(),
+        rollups.values('payment_type').annotate(total=Sum('total')).order_by(),
+        'payment_type',
+    )
     
-    payment_by_type = Payment.objects.filter(
-        status='completed'
-    ).values('payment_type').annotate(
-        total=Sum('amount')
-    ).order_by('-total')
+    recent_payments = payments.select_related('tenant').order_by('-payment_date')[:10]
     
-    recent_payments = Payment.objects.select_related('tenant').order_by('-payment_date')[:10]
+    property_revenue = merge_totals(
+        payments.filter(status='completed').values('tenant__unit__property__name').annotate(
+            total=Sum('amount')
+        ).order_by(),
+        rollups.values('tenant__unit__property__name').annotate(total=Sum('total')).order_by(),
+        'tenant__unit__property__name',
+    )[:5]
     
-    property_revenue = Payment.objects.filter(
-        status='completed'
-    ).values(
-        'tenant__unit__property__name'
-    ).annotate(
-        total=Sum('amount')
-    ).order_by('-total')[:5]
-    
-    total_expected_rent = Unit.objects.filter(status='occupied').aggregate(
+    total_expected_rent = Unit.objects.in_scope(property_ids).filter(status='occupied').aggregate(
         total=Sum('rent_amount')
     )['total'] or 0
     
+    forecast = get_forecast(settings.FORECAST_MONTHS, property_ids=property_ids)
+    
     context = {
         'total_revenue': total_revenue,
         'monthly_revenue': monthly_revenue,
@@ -776,31 +1037,42 @@ def financial_report(request):
         'property_revenue': list(property_revenue),
         'total_expected_rent': total_expected_rent,
         'current_year': current_year,
+        'forecast': forecast,
+        'forecast_rows': list(zip(
+            forecast['months'], forecast['portfolio']['scheduled'], forecast['portfolio']['expected']
+        )),
+        'forecast_properties': forecast['properties'][:10],
     }
     return render(request, 'reports/financial_report.html', context)
 
 
 @staff_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=report_etag, last_modified_func=report_last_modified)
 def occupancy_report(request):
-    total_units = Unit.objects.count()
-    occupied_units = Unit.objects.filter(status='occupied').count()
-    available_units = Unit.objects.filter(status='available').count()
-    maintenance_units = Unit.objects.filter(status='maintenance').count()
+    property_ids = managed_property_ids(request.user)
+    units = Unit.objects.in_scope(property_ids)
+    tenants = Tenant.objects.in_scope(property_ids)
+    
+    total_units = units.count()
+    occupied_units = units.filter(status='occupied').count()
+    available_units = units.filter(status='available').count()
+    maintenance_units = units.filter(status='maintenance').count()
     
     occupancy_rate = round((occupied_units / total_units * 100), 1) if total_units > 0 else 0
     
-    properties = Property.objects.annotate(
+    properties = Property.objects.in_scope(property_ids).annotate(
         total_units_count=Count('units'),
         occupied_count=Count('units', filter=Q(units__status='occupied')),
         available_count=Count('units', filter=Q(units__status='available')),
     )
     
     for prop in properties:
-        prop.occupancy_rate = round(
+        prop.occupancy_percent = round(
             (prop.occupied_count / prop.total_units_count * 100), 1
         ) if prop.total_units_count > 0 else 0
     
-    unit_type_stats = Unit.objects.values('unit_type').annotate(
+    unit_type_stats = units.values('unit_type').annotate(
         total=Count('id'),
         occupied=Count('id', filter=Q(status='occupied')),
     )
@@ -810,12 +1082,12 @@ def occupancy_report(request):
             (stat['occupied'] / stat['total'] * 100), 1
         ) if stat['total'] > 0 else 0
     
-    total_tenants = Tenant.objects.count()
-    active_tenants = Tenant.objects.filter(is_active=True).count()
+    total_tenants = tenants.count()
+    active_tenants = tenants.filter(status='active').count()
     
     today = timezone.now().date()
     thirty_days = today + timedelta(days=30)
-    expiring_leases = Tenant.objects.filter(
+    expiring_leases = tenants.filter(
         lease_end_date__gte=today,
         lease_end_date__lte=thirty_days
     ).select_related('unit', 'unit__property')
@@ -831,6 +1103,7 @@ def occupancy_report(request):
         'total_tenants': total_tenants,
         'active_tenants': active_tenants,
         'expiring_leases': expiring_leases,
+        'trends': occupancy_trends(property_ids=property_ids),
     }
     return render(request, 'reports/occupancy_report.html', context)
 
@@ -861,8 +1134,6 @@ def mpesa_stk_push(request):
         return JsonResponse({'error': 'POST method required'}, status=405)
     
     try:
-        from django_daraja.mpesa.core import MpesaClient
-        
         data = json.loads(request.body)
         phone_number = data.get('phone_number')
         amount = data.get('amount')
@@ -871,6 +1142,10 @@ def mpesa_stk_push(request):
         if not all([phone_number, amount, tenant_id]):
             return JsonResponse({'success': False, 'error': 'Missing required fields'}, status=400)
         
+        # Checked before the push goes out, so it can be saved against the tenant
+        if not str(tenant_id).isdigit() or not Tenant.objects.filter(pk=tenant_id).exists():
+            return JsonResponse({'success': False, 'error': 'Unknown tenant'}, status=400)
+        
         phone_number = str(phone_number).strip()
         if phone_number.startswith('0'):
             phone_number = '254' + phone_number[1:]
@@ -885,20 +1160,22 @@ def mpesa_stk_push(request):
         if amount < 1:
             return JsonResponse({'success': False, 'error': 'Amount must be at least 1 KES'}, status=400)
         
-        cl = MpesaClient()
         account_reference = f'RENT-{tenant_id}'
         transaction_desc = f'Rent Payment for Tenant {tenant_id}'
-        callback_url = 'https://mydomain.com/mpesa/callback/'
+        callback_url = settings.MPESA_CALLBACK_URL
         
-        response = cl.stk_push(
-            phone_number=phone_number,
-            amount=amount,
-            account_reference=account_reference,
-            transaction_desc=transaction_desc,
-            callback_url=callback_url
+        checkout_request_id, response = mpesa.send_stk_push(
+            tenant_id, phone_number, amount, account_reference, transaction_desc, callback_url
         )
         
-        if hasattr(response, 'response_code') and response.response_code == '0':
+        if response is None:
+            return JsonResponse({
+                'success': True,
+                'message': 'A payment request for this amount was already sent. Please check your phone and enter your M-Pesa PIN.',
+                'checkout_request_id': checkout_request_id,
+                'duplicate': True,
+            })
+        elif hasattr(response, 'response_code') and response.response_code == '0':
             return JsonResponse({
                 'success': True,
                 'message': 'STK Push sent successfully! Please check your phone and enter your M-Pesa PIN.',
@@ -917,12 +1194,24 @@ def mpesa_stk_push(request):
                 'debug': str(response_dict)
             })
         
-    except Exception as e:
-        import traceback
+    except mpesa.StkPushThrottled as e:
+        response = JsonResponse({
+            'success': False,
+            'error': 'Too many payment requests. Please wait a moment and try again.'
+        }, status=429)
+        response['Retry-After'] = str(math.ceil(e.retry_after))
+        return response
+    except MpesaConnectionError:
+        logger.exception('STK push to Daraja failed')
+        return JsonResponse({
+            'success': False,
+            'error': 'Could not reach M-Pesa. Please try again in a moment.'
+        }, status=502)
+    except Exception:
+        logger.exception('STK push failed')
         return JsonResponse({
-            'success': False, 
-            'error': f'Error: {str(e)}',
-            'trace': traceback.format_exc()
+            'success': False,
+            'error': 'Something went wrong while starting the payment. Please try again.'
         }, status=500)
 
 
@@ -931,43 +1220,45 @@ def mpesa_callback(request):
     if request.method == 'POST':
         try:
             data = json.loads(request.body)
-            
-            result_code = data.get('Body', {}).get('stkCallback', {}).get('ResultCode')
-            result_desc = data.get('Body', {}).get('stkCallback', {}).get('ResultDesc')
-            checkout_request_id = data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID')
-            
-            if result_code == 0:
-                callback_metadata = data.get('Body', {}).get('stkCallback', {}).get('CallbackMetadata', {}).get('Item', [])
-                
-                amount = None
-                mpesa_receipt = None
-                phone_number = None
-                
-                for item in callback_metadata:
-                    if item.get('Name') == 'Amount':
-                        amount = item.get('Value')
-                    elif item.get('Name') == 'MpesaReceiptNumber':
-                        mpesa_receipt = item.get('Value')
-                    elif item.get('Name') == 'PhoneNumber':
-                        phone_number = item.get('Value')
-                
-                tenant = Tenant.objects.filter(phone__endswith=str(phone_number)[-9:]).first()
-                
-                if tenant and amount:
-                    Payment.objects.create(
-                        tenant=tenant,
-                        amount=amount,
-                        payment_type='rent',
-                        payment_method='mpesa',
-                        payment_date=timezone.now().date(),
-                        reference_number=mpesa_receipt or '',
-                        description=f'M-Pesa payment - {checkout_request_id}',
-                        status='completed'
-                    )
-            
+            mpesa.record_stk_callback(data)
             return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Success'})
             
         except Exception as e:
+            logger.exception('Could not record M-Pesa callback')
             return JsonResponse({'ResultCode': 1, 'ResultDesc': str(e)})
     
     return JsonResponse({'error': 'Invalid request'}, status=400)
+
+
+@login_required(login_url='login')
+async def mpesa_payment_status(request, checkout_request_id):
+    """
+    JSON status of an STK push. With ?wait=N the request is held open for up to N seconds
+    until the callback for this checkout request arrives.
+    """
+    try:
+        wait = min(max(float(request.GET.get('wait', 0)), 0), settings.MPESA_STATUS_MAX_WAIT)
+    except ValueError:
+        return JsonResponse({'error': 'wait must be a number of seconds'}, status=400)
+    
+    status = dict(await mpesa.await_payment_status(checkout_request_id, wait))
+    
+    user = await request.auser()
+    tenant_user_id = status.pop('tenant_user_id', None)
+    if tenant_user_id != user.pk and not (user.is_staff or user.is_superuser):
+        return JsonResponse({'error': 'Not found'}, status=404)
+    
+    return JsonResponse(status)
+
+
+@staff_required
+def profile_download(request, profile_id, kind):
+    try:
+        # Profiles hold the SQL, with parameters, of someone's request
+        if not request.user.is_superuser and profiling.profile_owner(profile_id) != request.user.pk:
+            raise FileNotFoundError(profile_id)
+        path = profiling.profile_path(profile_id, kind)
+        return FileResponse(open(path, 'rb'), as_attachment=True,
+                            content_type=profiling.PROFILE_FILES[kind])
+    except FileNotFoundError:
+        raise Http404('Profile not found')